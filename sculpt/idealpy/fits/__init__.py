@@ -18,3 +18,4 @@ from xyad import xyad
 #from sxdelpar import sxdelpar
 from getaxes import getaxes
 from fitsio import fitsdir
+from tileindex import TileIndex
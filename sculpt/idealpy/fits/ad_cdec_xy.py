@@ -1,5 +1,5 @@
 from sculpt.idealpy.fits import sxpar
-import math
+import numpy
 
 def ad_cdec_xy(header, a, d):
     """
@@ -9,9 +9,10 @@ def ad_cdec_xy(header, a, d):
     for large fields-of-view.
 
     @param header:  A pyfits style header object
-    @param a: RA in decimal degrees
-    @param d: DEC in decimal degrees
-    @return : A tuple of (x, y) pixel locations
+    @param a: RA in decimal degrees (scalar or numpy array)
+    @param d: DEC in decimal degrees (scalar or numpy array)
+    @return : A tuple of (x, y) pixel locations, arrays if a and d
+        are arrays
        """
     naxis = sxpar(header, 'NAXIS')
     for i in range(1, naxis+1):
@@ -25,7 +26,7 @@ def ad_cdec_xy(header, a, d):
     cdelt2 = sxpar(header,'CDELT%d' % dec_axis)
     crpix1 = sxpar(header,'CRPIX%d' % ra_axis)
     crpix2 = sxpar(header,'CRPIX%d' % dec_axis)
-    x = crpix1+math.cos(math.radians(d))*(a-crval1)/cdelt1
+    x = crpix1+numpy.cos(numpy.radians(d))*(a-crval1)/cdelt1
     y = crpix2+(d-crval2)/cdelt2
 
     return (x, y)
@@ -0,0 +1,209 @@
+"""
+Spatial index of a directory of FITS map tiles.
+
+A survey split into many overlapping FITS tiles is awkward to work
+with, since finding the files that cover a region means opening every
+one of them. L{TileIndex} reads only the headers of the tiles (like
+L{fitsdir}), keeps the RA and DEC footprint of every tile (from the
+pixel to world transformation of L{xyad}) in a table, and can save
+that table to a FITS binary table so it never has to be rebuilt. It
+then answers which files, and which pixel ranges of them, cover a
+RA/DEC box with a vectorized comparison over the table.
+
+Use it by something like:
+
+    >>> index = TileIndex.build('survey/*.fits')
+    >>> index.save('survey_index.fits')
+    >>> index = TileIndex.load('survey_index.fits')
+    >>> for filename, (x1, x2, y1, y2) in index.query(83.5, 84.0, -5.5, -5.0):
+    ...     print filename, x1, x2, y1, y2
+"""
+
+from astropy.io import fits as pyfits
+import glob
+import numpy
+from sculpt.idealpy.fits import sxpar
+from sculpt.utils import SculptArgumentError
+
+#table columns holding the linear pixel to world transformation
+_WCS_COLUMNS = ('NAXISRA', 'CRVALRA', 'CRPIXRA', 'CDELTRA',
+                'NAXISDEC', 'CRVALDEC', 'CRPIXDEC', 'CDELTDEC')
+
+def _radec_axes(header):
+    """
+    Return the numbers of the RA and DEC axes of header, from the
+    CTYPEn keywords. Axes 2 and 3 (as in L{xyad}) are assumed if they
+    are not found.
+    """
+    ra_axis, dec_axis = 2, 3
+    for i in range(1, sxpar(header, 'NAXIS')+1):
+        ctype = sxpar(header, 'CTYPE%d' % i)
+        if ctype is None:
+            continue
+        if "RA" in ctype:
+            ra_axis = i
+        if "DEC" in ctype:
+            dec_axis = i
+    return ra_axis, dec_axis
+
+class TileIndex(object):
+    """
+    Table of the RA/DEC footprints of a set of FITS tiles. The world
+    coordinates of pixel x along the RA axis of a tile are
+    CRVAL + (x - CRPIX)*CDELT, as in L{xyad}, and similarly for DEC.
+    The footprint of a tile covers its pixels out to their edges.
+
+    Useful attributes are:
+
+      - filenames: list of the tile filenames
+      - ext: extension numbers holding the tiles
+      - ramin, ramax, decmin, decmax: numpy arrays of the footprints
+        of the tiles, in decimal degrees
+    """
+    def __init__(self, filenames, ext, wcs):
+        """
+        Use L{TileIndex.build} or L{TileIndex.load} rather than
+        creating a TileIndex directly.
+
+        @param filenames: list of tile filenames
+        @param ext: list of the extension numbers holding the tiles
+        @param wcs: dictionary of numpy arrays, one per name in
+            _WCS_COLUMNS, with the axis lengths and linear
+            transformations of the RA and DEC axes of the tiles
+        """
+        self.filenames = list(filenames)
+        self.ext = numpy.asarray(ext, dtype=int)
+        self.wcs = dict([(name, numpy.asarray(wcs[name], dtype=float))
+                         for name in _WCS_COLUMNS])
+        corners = []
+        for axis in ('RA', 'DEC'):
+            naxis = self.wcs['NAXIS%s' % axis]
+            ends = [self._world(axis, -0.5), self._world(axis, naxis-0.5)]
+            corners.append((numpy.minimum(*ends), numpy.maximum(*ends)))
+        (self.ramin, self.ramax), (self.decmin, self.decmax) = corners
+
+    def __len__(self):
+        return len(self.filenames)
+
+    def _world(self, axis, x):
+        return (self.wcs['CRVAL%s' % axis] +
+                (x - self.wcs['CRPIX%s' % axis])*self.wcs['CDELT%s' % axis])
+
+    def _pixel(self, axis, w):
+        return (self.wcs['CRPIX%s' % axis] +
+                (w - self.wcs['CRVAL%s' % axis])/self.wcs['CDELT%s' % axis])
+
+    @classmethod
+    def build(cls, directory=None, ext=0):
+        """
+        Build the index by reading the header of every FITS file in
+        directory. Only the headers are read.
+
+        @param directory: Scalar string giving file name, disk or
+            directory to be searched, as in L{fitsdir}. Wildcard file
+            names are allowed. If left blank, the FITS files in the
+            current working directory are indexed.
+        @type directory: string
+        @param ext: extension number holding the tiles. Default 0
+        @type ext: Integer
+        @return: L{TileIndex} instance
+        """
+        if directory is None:
+            directory = '*.fits*'
+        filenames = sorted(glob.glob(directory))
+        return cls.from_headers([(fname, pyfits.getheader(fname, ext=ext))
+                                 for fname in filenames], ext=ext)
+
+    @classmethod
+    def from_headers(cls, headers, ext=0):
+        """
+        Build the index from already read headers.
+
+        @param headers: list of (filename, header) pairs
+        @param ext: extension number holding the tiles. Default 0
+        @type ext: Integer
+        @return: L{TileIndex} instance
+        """
+        wcs = dict([(name, []) for name in _WCS_COLUMNS])
+        filenames = []
+        for fname, header in headers:
+            ra_axis, dec_axis = _radec_axes(header)
+            for axis, i in (('RA', ra_axis), ('DEC', dec_axis)):
+                for key in ('NAXIS', 'CRVAL', 'CRPIX', 'CDELT'):
+                    wcs['%s%s' % (key, axis)].append(sxpar(header, '%s%d' % (key, i)))
+            filenames.append(fname)
+        return cls(filenames, [ext]*len(filenames), wcs)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load an index saved with L{TileIndex.save}.
+
+        @param filename: name of the FITS file holding the index
+        @type filename: string
+        @return: L{TileIndex} instance
+        """
+        table = pyfits.getdata(filename, ext=1)
+        filenames = [str(fname).strip() for fname in table['FILENAME']]
+        wcs = dict([(name, table[name]) for name in _WCS_COLUMNS])
+        return cls(filenames, table['EXT'], wcs)
+
+    def save(self, filename, overwrite=False):
+        """
+        Save the index as a FITS binary table.
+
+        @param filename: name of the FITS file to write
+        @type filename: string
+        @param overwrite: If True, an existing file is overwritten
+        @type overwrite: Boolean
+        """
+        width = max([1] + [len(fname) for fname in self.filenames])
+        columns = [pyfits.Column(name='FILENAME', format='%dA' % width,
+                                 array=numpy.array(self.filenames)),
+                   pyfits.Column(name='EXT', format='J', array=self.ext)]
+        for name in _WCS_COLUMNS:
+            columns.append(pyfits.Column(name=name, format='D',
+                                         array=self.wcs[name]))
+        for name in ('RAMIN', 'RAMAX', 'DECMIN', 'DECMAX'):
+            columns.append(pyfits.Column(name=name, format='D',
+                                         array=getattr(self, name.lower())))
+        hdulist = pyfits.HDUList([pyfits.PrimaryHDU(),
+                                  pyfits.BinTableHDU.from_columns(columns)])
+        hdulist.writeto(filename, overwrite=overwrite)
+
+    def _query(self, ramin, ramax, decmin, decmax):
+        if ramin > ramax or decmin > decmax:
+            raise SculptArgumentError('box', "the lower limits of the box should not be above the upper limits")
+        hit = ((self.ramax >= ramin) & (self.ramin <= ramax) &
+               (self.decmax >= decmin) & (self.decmin <= decmax))
+        ranges = []
+        for axis, w1, w2 in (('RA', ramin, ramax), ('DEC', decmin, decmax)):
+            p1 = self._pixel(axis, w1)
+            p2 = self._pixel(axis, w2)
+            naxis = self.wcs['NAXIS%s' % axis]
+            #pixel centres on the edges of the box are inside it
+            lo = numpy.clip(numpy.ceil(numpy.minimum(p1, p2)-1e-6), 0, naxis)
+            hi = numpy.clip(numpy.floor(numpy.maximum(p1, p2)+1e-6)+1, 0, naxis)
+            hit &= hi > lo
+            ranges.append((lo.astype(int), hi.astype(int)))
+        (x1, x2), (y1, y2) = ranges
+        idx = numpy.flatnonzero(hit)
+        return idx, x1[idx], x2[idx], y1[idx], y2[idx]
+
+    def query(self, ramin, ramax, decmin, decmax):
+        """
+        Find the tiles, and the pixel ranges of them, that cover a
+        RA/DEC box.
+
+        @param ramin: lower RA limit of the box in decimal degrees
+        @param ramax: upper RA limit of the box in decimal degrees
+        @param decmin: lower DEC limit of the box in decimal degrees
+        @param decmax: upper DEC limit of the box in decimal degrees
+        @return: list of (filename, (x1, x2, y1, y2)) for every tile with
+            pixels inside the box, where x1:x2 and y1:y2 are the
+            half-open ranges of pixels of the RA and DEC axes of the tile
+            with their centres inside the box.
+        """
+        idx, x1, x2, y1, y2 = self._query(ramin, ramax, decmin, decmax)
+        return [(self.filenames[i], (x1[k], x2[k], y1[k], y2[k]))
+                for k, i in enumerate(idx)]
@@ -8,11 +8,17 @@ are now converted into idealpy equivalents here.
 """
 
 from momentcube import * #momentcube
-from smooth_image import smooth_image
+from momentindex import MomentIndex, channel_maps, momentcube_windowmap
+from windowspec import WindowSpec, compile_windows
+from baselineindex import BaselineIndex
+from smooth_image import smooth_image, smooth_cube
 from mkrmsimage import mkrmsimage
-from extract_spec import extract_spec
+from extract_spec import extract_spec, extract_spectra
+from smoothcache import SmoothedCubeCache
 from extract_posvel import extract_posvel
-from extract_posvel_angle import extract_posvel_angle
-from cube_extract import cube_extract
+from extract_posvel_angle import extract_posvel_angle, extract_posvel_fan
+from extract_posvel_path import extract_posvel_path
+from cube_extract import cube_extract, cube_extract_region
 from tau import tau_simple as tau
-from transpose_cube import transpose_cube
+from transpose_cube import transpose_cube, transpose_cube_file
+from decimate import decimate_spectra
@@ -1,12 +1,375 @@
 from astropy.io import fits as pyfits
-from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, getaxes, sxaddhist
+from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, sxaddhist
 from sculpt.utils import SculptArgumentError
+from sculpt.idealpy.radio.tiling import row_blocks, map_blocks, fits_cube, fits_output
+from sculpt.idealpy.radio.blanking import get_blank, blank_mask
+from sculpt.idealpy.radio.windowspec import compile_windows
+from sculpt.idealpy.radio.mkrmsimage import MAD_TO_SIGMA
 import numpy
+import types
 
-def baseline(hdu, chan, windows, order = 0, subtract = True, returnrms = True, kms = True):
+def design_matrix(lenv, order, ripples=None):
+    """
+    Polynomial design matrix of a spectrum with lenv channels.
+    The channel number is rescaled to [-1, 1] across the spectrum so
+    that the columns stay well conditioned up to high orders. The
+    fitted baseline is the same as numpy.polyfit's on the raw channel
+    numbers, only the coefficients differ.
+
+    @param lenv: number of channels
+    @type lenv: int
+    @param order: order of the polynomial
+    @type order: int
+    @param ripples: optional list of standing wave frequencies, in
+        cycles per channel. A cosine and a sine column are added for
+        each of them, so that the amplitude and phase of every ripple
+        are fitted along with the polynomial.
+    @return: numpy array of shape (lenv, order+1+2*len(ripples)), column
+        k holding the k-th power of the rescaled channel number for
+        k <= order, followed by the ripple columns
+    """
+    t = numpy.linspace(-1.0, 1.0, lenv) if lenv > 1 else numpy.zeros(lenv)
+    V = t[:, numpy.newaxis]**numpy.arange(order+1)
+    if not ripples:
+        return V
+    phase = 2*numpy.pi*numpy.outer(numpy.arange(lenv), ripples)
+    return numpy.hstack((V, numpy.cos(phase), numpy.sin(phase)))
+
+def lstsq_operator(A):
+    """
+    Return the (ncoef, nchan) matrix that maps a spectrum sampled at
+    the rows of the design matrix A onto its least squares
+    coefficients, from the QR factorisation of A. It is shared by all
+    the spectra of a cube, so fitting a block of spectra is a single
+    matrix product.
+    """
+    Q, R = numpy.linalg.qr(A)
+    return numpy.linalg.solve(R, Q.T)
+
+def masked_lstsq(A, y, w):
+    """
+    Least squares coefficients of many spectra at once, each with its
+    own set of usable channels, from batched normal equations.
+
+    @param A: design matrix of shape (nchan, ncoef)
+    @param y: spectra, of shape (nspec, nchan)
+    @param w: boolean array of shape (nspec, nchan), True for the
+        channels of each spectrum to fit
+    @return: coefficients of shape (nspec, ncoef). Spectra with no
+        more usable channels than coefficients get NaN.
+    """
+    ncoef = A.shape[1]
+    w = w.astype(numpy.float64)
+    y = numpy.where(w > 0, y, 0.0)
+    coef = numpy.empty((y.shape[0], ncoef))
+    coef.fill(numpy.nan)
+    ok = w.sum(axis=1) > ncoef - 1
+    if ok.any():
+        #G[p, k, l] = sum over the channels i of w[p, i]*A[i, k]*A[i, l]
+        AA = (A[:, :, numpy.newaxis]*A[:, numpy.newaxis, :]).reshape(A.shape[0], -1)
+        G = numpy.dot(w[ok], AA).reshape(-1, ncoef, ncoef)
+        b = numpy.dot(y[ok], A)
+        coef[ok] = numpy.linalg.solve(G, b[:, :, numpy.newaxis])[:, :, 0]
+    return coef
+
+#zero padding factor of the FFT in ripple_frequencies
+RIPPLE_PAD = 8
+
+def ripple_frequencies(data, mask, nripple=1, order=0, blank=None,
+                       dontblank=False, maxmem=None, workers=None):
+    """
+    Find the frequencies of the strongest standing wave ripples of a
+    cube. A polynomial of the given order is fitted to the channels of
+    mask of every spectrum and removed, the power spectra of what is
+    left are averaged over the whole map (which brings the ripples,
+    common to all the spectra but not necessarily in phase, well above
+    the noise), and the strongest peaks of the average power spectrum
+    are returned.
+
+    @param data: VLM cube with numpy shape (ny, nx, nv)
+    @param mask: boolean mask of the channels to use, e.g. the
+        line-free windows. Other channels are zeroed before the FFT.
+    @param nripple: number of ripple frequencies to return
+    @type nripple: int
+    @param order: order of the polynomial removed before the FFT
+    @type order: int
+    @param blank: BLANK value of the cube, or None
+    @param dontblank: If False, blanked values are zeroed as well
+    @type dontblank: Boolean
+    @param maxmem: upper limit in bytes for a block of rows of the cube
+    @type maxmem: int
+    @param workers: number of threads to process the blocks with
+    @type workers: int
+    @return: list of up to nripple frequencies in cycles per channel,
+        strongest first. The spectra are zero padded to RIPPLE_PAD times
+        their length before the FFT, and each peak is further refined
+        by fitting a parabola to it.
+    """
+    ny, nx, nv = data.shape
+    V = design_matrix(nv, order)
+    nfft = RIPPLE_PAD*nv
+    power = numpy.zeros((ny, nfft//2+1))
+
+    def _power(y1, y2):
+        rows = data[y1:y2]
+        y = rows.reshape(-1, nv).astype(numpy.float64)
+        w = numpy.repeat(mask[numpy.newaxis, :], y.shape[0], axis=0)
+        if not dontblank:
+            w &= numpy.logical_not(blank_mask(rows, blank)).reshape(-1, nv)
+        coef = masked_lstsq(V, y, w)
+        resid = numpy.where(w, y - numpy.dot(coef, V.T), 0.0)
+        #spectra too blanked to fit have NaN coefficients
+        resid[numpy.isnan(coef[:, 0])] = 0.0
+        spec = numpy.abs(numpy.fft.rfft(resid, n=nfft, axis=1))**2
+        power[y1:y2] = spec.reshape(y2-y1, nx, -1).sum(axis=1)
+
+    blocks = row_blocks(data.shape, 8*(4+2*RIPPLE_PAD), maxmem,
+                        minblocks=workers)
+    map_blocks(_power, blocks, workers=workers)
+    power = power.sum(axis=0)
+    #local maxima of the power spectrum, leaving out the lowest bins
+    #which the polynomial already takes care of
+    k = numpy.arange(2*RIPPLE_PAD, power.size-1)
+    peaks = k[numpy.logical_and(power[k] > power[k-1], power[k] >= power[k+1])]
+    peaks = peaks[numpy.argsort(power[peaks])[::-1]]
+    freqs = []
+    chosen = []
+    for k in peaks:
+        if len(freqs) == nripple:
+            break
+        #skip the sidelobes of stronger ripples
+        if [c for c in chosen if abs(c - k) <= 2*RIPPLE_PAD]:
+            continue
+        chosen.append(k)
+        denom = power[k-1] - 2*power[k] + power[k+1]
+        delta = 0.5*(power[k-1] - power[k+1])/denom if denom != 0 else 0.0
+        freqs.append((k + delta)/float(nfft))
+    return freqs
+
+def _masked_median(values, mask):
+    """
+    Median of every row of the 2d array values over the entries where
+    mask is True, from one sort of all the rows at once. Rows without
+    any such entry get NaN.
+    """
+    n = mask.sum(axis=1)
+    ordered = numpy.sort(numpy.where(mask, values, numpy.inf), axis=1)
+    rows = numpy.arange(values.shape[0])
+    lo = ordered[rows, numpy.maximum((n-1)//2, 0)]
+    hi = ordered[rows, n//2]
+    med = 0.5*(lo + hi)
+    med[n == 0] = numpy.nan
+    return med
+
+def _grow_mask(bad, grow):
+    """
+    Widen every run of True values of the 2d boolean array bad by grow
+    entries on both sides along its second axis.
+    """
+    if grow <= 0 or not bad.any():
+        return bad
+    nv = bad.shape[1]
+    counts = numpy.zeros((bad.shape[0], nv+1), dtype=int)
+    numpy.cumsum(bad, axis=1, out=counts[:, 1:])
+    idx = numpy.arange(nv)
+    lo = numpy.clip(idx-grow, 0, nv)
+    hi = numpy.clip(idx+grow+1, 0, nv)
+    return (counts[:, hi] - counts[:, lo]) > 0
+
+def robust_fit(A, y, w, clip=3.0, niter=10, grow=0):
+    """
+    Iteratively sigma-clipped least squares fit of many spectra at
+    once. Each iteration fits all the spectra that have not converged
+    yet, estimates their noise from the median absolute deviation of
+    the residuals, and drops every channel deviating by more than clip
+    sigma (widened by grow channels on both sides, to also drop the
+    wings of lines) from the channels to fit. A spectrum has converged
+    when its set of channels no longer changes, and iteration stops
+    as soon as all of them have.
+
+    @param A: design matrix of shape (nchan, ncoef)
+    @param y: spectra, of shape (nspec, nchan)
+    @param w: boolean array of shape (nspec, nchan), True for the
+        channels of each spectrum that may be fitted
+    @param clip: clipping threshold in sigma
+    @type clip: float
+    @param niter: maximum number of clipping iterations
+    @type niter: int
+    @param grow: number of channels on both sides of a clipped channel
+        to also drop
+    @type grow: int
+    @return: tuple (coef, mask, sigma) of the coefficients, of shape
+        (nspec, ncoef), the boolean mask of the channels used in the
+        final fit, and the rms of the residuals over those channels.
+        Spectra with no more usable channels than coefficients get NaN
+        coefficients and sigma.
+    """
+    ncoef = A.shape[1]
+    y = numpy.where(w, y, 0.0)
+    mask = w.copy()
+    coef = numpy.empty((y.shape[0], ncoef))
+    coef.fill(numpy.nan)
+    #spectra whose channel mask changed since their last fit
+    active = numpy.ones(y.shape[0], dtype=bool)
+    for i in range(niter):
+        idx = numpy.flatnonzero(active)
+        if idx.size == 0:
+            break
+        coef[idx] = masked_lstsq(A, y[idx], mask[idx])
+        resid = y[idx] - numpy.dot(coef[idx], A.T)
+        m = mask[idx]
+        dev = numpy.abs(resid - _masked_median(resid, m)[:, numpy.newaxis])
+        sig = MAD_TO_SIGMA*_masked_median(dev, m)
+        with numpy.errstate(invalid='ignore'):
+            bad = dev > clip*sig[:, numpy.newaxis]
+        #leave spectra with a zero or undefined noise estimate alone
+        bad[numpy.logical_not(sig > 0)] = False
+        newmask = numpy.logical_and(w[idx], numpy.logical_not(_grow_mask(bad, grow)))
+        keep = newmask.sum(axis=1) > ncoef - 1
+        changed = numpy.logical_and(keep, (newmask != m).any(axis=1))
+        mask[idx[changed]] = newmask[changed]
+        active[idx] = changed
+    if active.any():
+        #refit the spectra clipped in the last iteration
+        idx = numpy.flatnonzero(active)
+        coef[idx] = masked_lstsq(A, y[idx], mask[idx])
+    resid = numpy.where(mask, y - numpy.dot(coef, A.T), 0.0)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        sigma = numpy.sqrt((resid**2).sum(axis=1)/mask.sum(axis=1))
+    sigma[numpy.isnan(coef[:, 0])] = numpy.nan
+    return coef, mask, sigma
+
+def _rms_header(header, spec):
+    """
+    Header of the 2d rms map of a baseline fit of the cube described
+    by header, over the windows of the L{WindowSpec} spec.
+    """
+    #the following grabs relevant information from the original header
+    #and reproduces it in the RMSMap header shifted to account for
+    #the different shape of the data
+    crpix2 = sxpar(header,"CRPIX2")
+    crval2 = sxpar(header,"CRVAL2")
+    cdelt2 = sxpar(header,"CDELT2")
+    ctype2 = sxpar(header,"CTYPE2")
+    crpix3 = sxpar(header,"CRPIX3")
+    crval3 = sxpar(header,"CRVAL3")
+    cdelt3 = sxpar(header,"CDELT3")
+    ctype3 = sxpar(header,"CTYPE3")
+    nx = sxpar(header,"NAXIS2")
+    ny = sxpar(header,"NAXIS3")
+
+    hnew = header.copy()
+
+    sxaddpar(hnew, "CRVAL1", crval2, comment="DEGREES")
+    sxaddpar(hnew, "CRPIX1", crpix2)
+    sxaddpar(hnew, "CDELT1", cdelt2, comment="DEGREES")
+    sxaddpar(hnew, "CTYPE1", ctype2)
+    sxaddpar(hnew, "CRVAL2", crval3, comment="DEGREES")
+    sxaddpar(hnew, "CRPIX2", crpix3)
+    sxaddpar(hnew, "CDELT2", cdelt3, comment="DEGREES")
+    sxaddpar(hnew, "CTYPE2", ctype3)
+    sxaddpar(hnew, "NAXIS", 2)
+    sxaddpar(hnew, "NAXIS1", nx)
+    sxaddpar(hnew, "NAXIS2", ny)
+    sxaddpar(hnew, "NAXIS3", 1)
+    sxaddpar(hnew, "NAXIS4", 1)
+
+    sxaddhist(hnew, "WINDOW : %s; Window %s LIMITS" % (repr(list(spec.windows)),
+                                                     spec.vorc()))
+    #sxaddpar(hnew, "BUNIT", units, "Units")
+    sxdelpar(hnew, "CRVAL3")
+    sxdelpar(hnew, "CRPIX3")
+    sxdelpar(hnew, "CDELT3")
+    sxdelpar(hnew, "CTYPE3")
+    sxdelpar(hnew, "NAXIS3")
+    sxdelpar(hnew, "NAXIS4")
+    return hnew
+
+def _baseline_fitter(lenv, final_ind, order, ripples, blank, dontblank,
+                     subtract):
+    """
+    Return a function which fits (and optionally subtracts in place)
+    the baselines of a block of rows of a VLM cube, and returns the 2d
+    rms of the residuals over the window channels final_ind. Spectra
+    without blanks in the windows share one QR factorisation of the
+    window channels, the others are solved as a batch of normal
+    equations.
+    """
+    V = design_matrix(lenv, order, ripples)
+    ncoef = V.shape[1]
+    A = V[final_ind]
+    if A.shape[0] >= ncoef:
+        solver = lstsq_operator(A)
+    else:
+        solver = None
+
+    def fit_rows(rows):
+        win = rows[:, :, final_ind].astype(numpy.float64)
+        npix = win.shape[0]*win.shape[1]
+        win = win.reshape(npix, -1)
+        if solver is None:
+            coef = numpy.empty((npix, ncoef))
+            coef.fill(numpy.nan)
+        else:
+            coef = numpy.dot(win, solver.T)
+        if dontblank:
+            valid = None
+            n = numpy.empty(npix)
+            n.fill(A.shape[0])
+        else:
+            valid = numpy.logical_not(blank_mask(rows, blank))
+            wvalid = valid[:, :, final_ind].reshape(npix, -1)
+            n = wvalid.sum(axis=1)
+            partial = numpy.logical_not(wvalid.all(axis=1))
+            if partial.any():
+                #spectra with blanks inside the windows
+                coef[partial] = masked_lstsq(A, win[partial], wvalid[partial])
+                win[partial] = numpy.where(wvalid[partial], win[partial], 0.0)
+        resid = win - numpy.dot(coef, A.T)
+        if valid is not None:
+            resid[partial] = numpy.where(wvalid[partial], resid[partial], 0.0)
+        #the residuals of a least squares fit with a constant term
+        #have zero mean, so this is their standard deviation
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            sig = numpy.sqrt((resid**2).sum(axis=1)/n)
+        fitted = n >= ncoef
+        sig[numpy.logical_not(fitted)] = numpy.nan
+        if subtract:
+            model = numpy.dot(coef, V.T).reshape(rows.shape)
+            mask = fitted.reshape(rows.shape[0], rows.shape[1], 1)
+            if valid is not None:
+                mask = numpy.logical_and(mask, valid)
+            if mask.all():
+                numpy.subtract(rows, model, out=rows, casting='unsafe')
+            else:
+                numpy.subtract(rows, model, out=rows, where=mask, casting='unsafe')
+        return sig.reshape(rows.shape[:2])
+
+    return fit_rows
+
+def baseline(hdu, chan, windows, order = 0, subtract = True, returnrms = True, kms = True,
+             header = None, workers = None, dontblank = False, maxmem = None,
+             ripples = None, layout = 'vlm'):
     #this function needs to be passed a FITS HDU
-    #with data in the (V,X,Y) format
-    header = None
+    #with data in the VLM format, i.e. numpy shape (ny, nx, nv)
+    #layout='vxy' takes data in the (V,X,Y) layout baseline used to
+    #expect, i.e. numpy shape (nv, nx, ny), and returns the rms image
+    #as numpy shape (nx, ny) as it used to. the velocity axis is still
+    #described by axis 1 of the header, as before
+    #if workers is larger than 1, blocks of rows of the cube are
+    #fitted in parallel on a pool of that many threads
+    #blanked (BLANK or NaN) channels are left out of the fit and
+    #are not subtracted from, unless dontblank is set
+    #windows are the (v1, v2) pairs the baseline is fitted over, in
+    #channels if chan is True, otherwise in velocity. A WindowSpec
+    #(see compile_windows) can be passed as windows instead
+    #all the spectra of a block of rows are fitted together: spectra
+    #without blanks in the windows share one QR factorisation of the
+    #window channels, the others are solved as a batch of normal
+    #equations
+    #ripples adds standing waves to the baseline model: either a list
+    #of frequencies in cycles per channel, or the number of ripples to
+    #find with ripple_frequencies from the cube averaged spectrum
     if isinstance(hdu, pyfits.hdu.image.PrimaryHDU):
         # get data and header from the hdu
         header = hdu.header
@@ -16,118 +379,221 @@ def baseline(hdu, chan, windows, order = 0, subtract = True, returnrms = True, k
         if header is None or not isinstance(header, pyfits.header.Header):
             raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
         data = hdu
+    else:
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
+    if order < 0:
+        raise SculptArgumentError('order', "order has to be 0 or larger")
+    if layout not in ('vlm', 'vxy'):
+        raise SculptArgumentError('layout', "layout can only be one of 'vlm' or 'vxy'")
+    orig = data
+    if layout == 'vxy':
+        #fit through a VLM view of the cube, so the input is still
+        #subtracted from in place
+        data = data.transpose(2, 1, 0)
 
     shape = data.shape
 
     #windows over which to do the test for sigma values
     #basically excluse major lines you observe
     
-    lenv, lenx, leny = shape
+    leny, lenx, lenv = shape
     #defaultswindow = ((100,200),(650,750))
-    sigma = numpy.zeros((lenx, leny))
-
-    x = numpy.arange(lenv)
-    c_loop = 0
-
-# this commented section is the makermsimage way of selecting them
-# if someone wants to make a change regarding one being better, do it
-
-#    velax = getaxes(header, 1)
-#    indices = numpy.zeros(velax.shape, dtype=bool)
-#    for v1, v2 in window:
-#        if chan:
-#            indices[v1:v2] = True
-#        else:
-#            ind = numpy.logical_and(velax>= v1, velax<= v2)
-#            indices = numpy.logical_or(indices, ind)
-#    indices = numpy.logical_not(indices) # for indices to include in std calc
-
-    for win in windows:  
-        if (len(win) != 2):
-            print "Each element in the window list must be a 2-tuple"
-        c1, c2 = win
-        c1, c2 = sorted((c1, c2))
-        ind = numpy.logical_and(x>=c1, x<=c2)
-        if (c_loop == 0):
-            final_ind = numpy.logical_or(ind,ind)
-        else:
-            final_ind = numpy.logical_or(final_ind,ind)
+    sigma = numpy.zeros((leny, lenx))
+
+    spec = compile_windows(header, windows, chan=chan, kms=kms)
+    chan = spec.chan
+    final_ind = spec.mask
+
+    blank = get_blank(header)
 
-    x_windows = x[final_ind]
-    for ix in range(lenx):
-        for iy in range(leny):
-            spectra = data[:,ix,iy]
-            spec_windows = spectra[final_ind]
+    if isinstance(ripples, (int, long)):
+        #no ripples to find is the same as no ripples
+        if ripples > 0:
+            ripples = ripple_frequencies(data, final_ind, nripple=ripples,
+                                         order=order, blank=blank,
+                                         dontblank=dontblank, maxmem=maxmem,
+                                         workers=workers)
+        else:
+            ripples = None
+    fit_rows = _baseline_fitter(lenv, final_ind, order, ripples, blank,
+                                dontblank, subtract)
 
-            p = numpy.polyfit(x_windows,spec_windows,order)
-            spec_windows -= numpy.polyval(p,len(x_windows))
+    def _fit_block(y1, y2):
+        sigma[y1:y2] = fit_rows(data[y1:y2])
 
-            sigma[ix, iy] = spec_windows.std()
-            if (subtract):
-                data[:,ix,iy] -= numpy.polyval(p,lenv)
+    #the fit works on float64 copies of the window channels and the
+    #model of each block, on top of the block itself
+    blocks = row_blocks(shape, data.dtype.itemsize + 24, maxmem,
+                        minblocks=workers)
+    map_blocks(_fit_block, blocks, workers=workers)
                 
     # this is the original input - with data reduced as needed
-    hdu_orig =  pyfits.hdu.image.PrimaryHDU(header = header, data = data)
+    hdu_orig =  pyfits.hdu.image.PrimaryHDU(header = header, data = orig)
     
     if returnrms:
-        #the following grabs relevant information from the original header
-        #and reproduces it in the RMSMap header shifted to account for
-        #the different shape of the data
-        crpix1 = sxpar(header,"CRPIX1")
-        crval1 = sxpar(header,"CRVAL1")
-        cdelt1 = sxpar(header,"CDELT1")
-        if kms:
-            #convert velocity to km/s
-            crval1 = crval1/1000.
-            cdelt1 = cdelt1/1000.
-        ctype1 = sxpar(header,"CTYPE1")
-        crpix2 = sxpar(header,"CRPIX2")
-        crval2 = sxpar(header,"CRVAL2")
-        cdelt2 = sxpar(header,"CDELT2")
-        ctype2 = sxpar(header,"CTYPE2")
-        crpix3 = sxpar(header,"CRPIX3")
-        crval3 = sxpar(header,"CRVAL3")
-        cdelt3 = sxpar(header,"CDELT3")
-        ctype3 = sxpar(header,"CTYPE3")
-        nv = sxpar(header,"NAXIS1")
-        nx = sxpar(header,"NAXIS2")
-        ny = sxpar(header,"NAXIS3")
-        blank = sxpar(header,"BLANK")
-
-        hnew = header.copy()
-
-        sxaddpar(hnew, "CRVAL1", crval2, comment="DEGREES")
-        sxaddpar(hnew, "CRPIX1", crpix2)
-        sxaddpar(hnew, "CDELT1", cdelt2, comment="DEGREES")
-        sxaddpar(hnew, "CTYPE1", ctype2)
-        sxaddpar(hnew, "CRVAL2", crval3, comment="DEGREES")
-        sxaddpar(hnew, "CRPIX2", crpix3)
-        sxaddpar(hnew, "CDELT2", cdelt3, comment="DEGREES")
-        sxaddpar(hnew, "CTYPE2", ctype3)
-        sxaddpar(hnew, "NAXIS", 2)
-        sxaddpar(hnew, "NAXIS1", nx)
-        sxaddpar(hnew, "NAXIS2", ny)
-        sxaddpar(hnew, "NAXIS3", 1)
-        sxaddpar(hnew, "NAXIS4", 1)
-
-        if chan:
-            vorc = 'CHANNEL'
-        else:
-            vorc = 'VELOCITY'
-
-        sxaddhist(hnew, "WINDOW : %s; Window %s LIMITS" % (repr(windows), vorc))
-        #sxaddpar(hnew, "BUNIT", units, "Units")
-        sxdelpar(hnew, "CRVAL3")
-        sxdelpar(hnew, "CRPIX3")
-        sxdelpar(hnew, "CDELT3")
-        sxdelpar(hnew, "CTYPE3")
-        sxdelpar(hnew, "NAXIS3")
-        sxdelpar(hnew, "NAXIS4")
-        
+        hnew = _rms_header(header, spec)
+        if ripples:
+            sxaddhist(hnew, "RIPPLES : %s cycles/channel" % ", ".join(["%.6g" % f for f in ripples]))
+        if layout == 'vxy':
+            sigma = sigma.T
         hdu_rms =  pyfits.hdu.image.PrimaryHDU(data=sigma, header=hnew)
         return (hdu_orig, hdu_rms)
     else:
         return hdu_orig
 
+def baseline_file(infile, outfile, chan, windows, order = 0, rmsfile = None,
+                  kms = True, workers = None, dontblank = False, maxmem = None,
+                  ripples = None, overwrite = False):
+    #out-of-core version of baseline for cubes that do not fit in memory.
+    #infile (a FITS filename or FITSCube, with the cube in VLM format) is
+    #memory-mapped and read one block of rows at a time. the baselines
+    #of each block are fitted and subtracted, and the block is written
+    #straight into outfile, which is preallocated with fits_output. so
+    #the cube is read once and written once, and only the blocks being
+    #worked on are ever held in memory.
+    #the arguments are the same as for baseline. the rms map is returned
+    #as a HDU, and also written to rmsfile if given. if ripples is a
+    #number of ripples to find, infile is read once more beforehand to
+    #find their frequencies
+    if order < 0:
+        raise SculptArgumentError('order', "order has to be 0 or larger")
+    cube = fits_cube(infile)
+    try:
+        header = cube.header
+        leny, lenx, lenv = cube.shape
+        sigma = numpy.zeros((leny, lenx))
+        spec = compile_windows(header, windows, chan=chan, kms=kms)
+        blank = get_blank(header)
+        if isinstance(ripples, (int, long)):
+            if ripples > 0:
+                ripples = ripple_frequencies(cube, spec.mask, nripple=ripples,
+                                             order=order, blank=blank,
+                                             dontblank=dontblank, maxmem=maxmem,
+                                             workers=workers)
+            else:
+                ripples = None
+        fit_rows = _baseline_fitter(lenv, spec.mask, order, ripples, blank,
+                                    dontblank, True)
+        hout = header.copy()
+        sxaddhist(hout, "BASELINE : order %d; WINDOW : %s; Window %s LIMITS" %
+                  (order, repr(list(spec.windows)), spec.vorc()))
+        hdulist = fits_output(outfile, hout, cube.dtype, overwrite=overwrite)
+        out = hdulist[0].data
+
+        def _fit_block(y1, y2):
+            rows = numpy.array(cube[y1:y2], dtype=cube.dtype)
+            sigma[y1:y2] = fit_rows(rows)
+            out[y1:y2] = rows
+
+        blocks = row_blocks(cube.shape, cube.dtype.itemsize + 24, maxmem,
+                            minblocks=workers)
+        try:
+            map_blocks(_fit_block, blocks, workers=workers)
+        finally:
+            hdulist.close()
+    finally:
+        if isinstance(infile, types.StringTypes):
+            cube.close()
+
+    hnew = _rms_header(header, spec)
+    if ripples:
+        sxaddhist(hnew, "RIPPLES : %s cycles/channel" % ", ".join(["%.6g" % f for f in ripples]))
+    hdu_rms = pyfits.hdu.image.PrimaryHDU(data=sigma, header=hnew)
+    if rmsfile is not None:
+        hdu_rms.writeto(rmsfile, overwrite=overwrite)
+    return hdu_rms
+
+def robust_baseline(hdu, order = 0, windows = None, chan = False, clip = 3.0,
+                    niter = 10, grow = 2, subtract = True, returnrms = True,
+                    returnmask = False, kms = True, header = None,
+                    workers = None, dontblank = False, maxmem = None,
+                    ripples = None):
+    #robust version of baseline: no line-free windows have to be given.
+    #the baseline of every spectrum is fitted to all its channels (or
+    #only to the channels inside windows, if given), then channels with
+    #lines or spikes are found and dropped by iterative sigma clipping
+    #of the residuals, see robust_fit. all the spectra of a block of
+    #rows are clipped and refitted together.
+    #with returnmask, a cube HDU is also returned which is 1 for the
+    #channels each baseline was finally fitted to, and 0 elsewhere
+    #ripples adds standing waves to the baseline model, see baseline
+    if isinstance(hdu, pyfits.hdu.image.PrimaryHDU):
+        # get data and header from the hdu
+        header = hdu.header
+        data = hdu.data
+
+    elif isinstance(hdu, numpy.ndarray):
+        if header is None or not isinstance(header, pyfits.header.Header):
+            raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+        data = hdu
+    else:
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
+    if order < 0:
+        raise SculptArgumentError('order', "order has to be 0 or larger")
+
+    shape = data.shape
+    leny, lenx, lenv = shape
+    sigma = numpy.zeros((leny, lenx))
+    if returnmask:
+        linefree = numpy.zeros(shape, dtype=numpy.uint8)
+
+    if windows is None:
+        windows = [(0, lenv-1)]
+        chan = True
+    spec = compile_windows(header, windows, chan=chan, kms=kms)
+    blank = get_blank(header)
+    if isinstance(ripples, (int, long)):
+        if ripples > 0:
+            ripples = ripple_frequencies(data, spec.mask, nripple=ripples,
+                                         order=order, blank=blank,
+                                         dontblank=dontblank, maxmem=maxmem,
+                                         workers=workers)
+        else:
+            ripples = None
+    V = design_matrix(lenv, order, ripples)
+
+    def _fit_block(y1, y2):
+        rows = data[y1:y2]
+        y = rows.reshape(-1, lenv).astype(numpy.float64)
+        w = numpy.repeat(spec.mask[numpy.newaxis, :], y.shape[0], axis=0)
+        if not dontblank:
+            valid = numpy.logical_not(blank_mask(rows, blank))
+            w &= valid.reshape(-1, lenv)
+        coef, mask, sig = robust_fit(V, y, w, clip=clip, niter=niter,
+                                     grow=grow)
+        sigma[y1:y2] = sig.reshape(y2-y1, lenx)
+        if returnmask:
+            linefree[y1:y2] = mask.reshape(rows.shape)
+        if subtract:
+            model = numpy.dot(coef, V.T).reshape(rows.shape)
+            fitted = numpy.isfinite(coef[:, 0]).reshape(y2-y1, lenx, 1)
+            if dontblank:
+                sub = fitted
+            else:
+                sub = numpy.logical_and(fitted, valid)
+            numpy.subtract(rows, model, out=rows, where=sub, casting='unsafe')
+
+    #robust_fit keeps several float64 working copies of each block
+    blocks = row_blocks(shape, data.dtype.itemsize + 64, maxmem,
+                        minblocks=workers)
+    map_blocks(_fit_block, blocks, workers=workers)
+
+    hdu_orig =  pyfits.hdu.image.PrimaryHDU(header = header, data = data)
+    out = [hdu_orig]
+    if returnrms:
+        hnew = _rms_header(header, spec)
+        sxaddhist(hnew, "Robust baseline: order %d, clip %g sigma, grow %d" % (order, clip, grow))
+        if ripples:
+            sxaddhist(hnew, "RIPPLES : %s cycles/channel" % ", ".join(["%.6g" % f for f in ripples]))
+        out.append(pyfits.hdu.image.PrimaryHDU(data=sigma, header=hnew))
+    if returnmask:
+        hmask = header.copy()
+        sxdelpar(hmask, "BLANK")
+        sxaddhist(hmask, "Line-free channels of robust baseline fit")
+        out.append(pyfits.hdu.image.PrimaryHDU(data=linefree, header=hmask))
+    if len(out) == 1:
+        return hdu_orig
+    return tuple(out)
+
 if __name__ == '__main__':
     print "test - you've activated the 'if __name__ == '__main__':' clause"
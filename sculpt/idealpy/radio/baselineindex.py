@@ -0,0 +1,242 @@
+"""
+Cumulative index of a VLM cube for interactive baseline fitting.
+
+A polynomial baseline fit over a set of channel windows only needs,
+for every spectrum, the sums over the window channels of y*t**k
+(k up to the order), of t**k (k up to twice the order, for the normal
+equations) and of y**2 (for the rms of the residuals), where t is the
+rescaled channel number of L{baseline.design_matrix}. L{BaselineIndex}
+holds the running sums of these along the velocity axis, so the sums
+over any set of windows are differences of a few planes of the index.
+Once the index is built, trying a new set of windows or a new order
+is a small linear solve per pixel, without reading the cube again.
+"""
+
+from sculpt.utils import SculptArgumentError
+from tiling import row_blocks, map_blocks, fits_cube, STREAM_TYPES
+from blanking import get_blank, blank_mask
+from windowspec import compile_windows
+from baseline import design_matrix, _rms_header
+
+import numpy
+from astropy.io import fits as pyfits
+import astropy.io
+import types
+
+class BaselineIndex(object):
+    """
+    Cumulative sums of y*t**k (k = 0..maxorder) and y**2 along the
+    velocity axis of a VLM cube. The index holds maxorder+2 arrays of
+    shape (ny, nx, nv+1) in double precision, where plane c is the sum
+    over channels 0..c-1, so it needs maxorder+2 times the memory of a
+    double precision copy of the cube.
+
+    The sums of t**k are the same for every spectrum without blanks
+    and are kept once. Spectra with some blanked channels keep a
+    boolean mask of their unblanked channels, from which L{fit} sums
+    t**k over the windows asked for. Spectra that are entirely blanked
+    are only flagged, and get NaN from L{fit}.
+
+    Build and use it by something like:
+
+        >>> index = BaselineIndex(hdu, maxorder=3)
+        >>> rms1 = index.rmsmap([(-60, -20), (20, 60)], order=1)
+        >>> rms3 = index.rmsmap([(-60, -15), (15, 60)], order=3)
+        >>> index.subtract(hdu.data, [(-60, -15), (15, 60)], order=3)
+    """
+    def __init__(self, hdu, header=None, maxorder=3, dontblank=False,
+                 kms=True, maxmem=None, workers=None):
+        """
+        @param hdu: input pyfits style HDU (header data unit), numpy
+            data cube (in which case header should also be passed in),
+            or FITS filename / L{FITSCube} to stream the cube from.
+            This cube is expected to be in vlm format.
+        @type hdu: pyfits HDU, numpy array, FITS filename or L{FITSCube}
+        @param header: pyfits style header object if hdu is a numpy array
+        @type header: pyfits header object
+        @param maxorder: highest polynomial order the index should
+            support. Lower values save memory.
+        @type maxorder: int
+        @param dontblank: By default, BLANK and NaN values are left out
+            of the fits. If dontblank is set, they are used as numbers.
+        @type dontblank: Boolean
+        @param kms: If True velocity units is in kms.
+        @type kms: Boolean
+        @param maxmem: upper limit in bytes for a block of rows of the
+            cube read while building the index
+        @type maxmem: int
+        @param workers: number of threads to build the index with
+        @type workers: int
+        """
+        if maxorder < 0:
+            raise SculptArgumentError('maxorder', "maxorder has to be 0 or larger")
+        if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
+            #get data and header from the hdu
+            data = hdu.data
+            header = hdu.header
+        elif isinstance(hdu, numpy.ndarray):
+            if header is None or not isinstance(header, astropy.io.fits.header.Header):
+                raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+            data = hdu
+        elif isinstance(hdu, STREAM_TYPES):
+            #stream the cube from a memory-mapped FITS file
+            data = fits_cube(hdu)
+            header = data.header
+        else:
+            raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type, numpy ndarray or FITS filename")
+        self.header = header
+        self.kms = kms
+        self.maxorder = maxorder
+        self.dontblank = dontblank
+        ny, nx, nv = data.shape
+        self.shape = data.shape
+        #powers 0..2*maxorder of the rescaled channel number
+        tpow = design_matrix(nv, 2*maxorder)
+        self.tsums = numpy.zeros((nv+1, 2*maxorder+1))
+        numpy.cumsum(tpow, axis=0, out=self.tsums[1:])
+        self.sums = []
+        for k in range(maxorder+1):
+            self.sums.append(numpy.zeros((ny, nx, nv+1)))
+        self.sqsums = numpy.zeros((ny, nx, nv+1))
+        self.allblank = numpy.zeros((ny, nx), dtype=bool)
+        blank = get_blank(header)
+        blanked = {}
+
+        def _accumulate(y1, y2):
+            block = data[y1:y2].astype(numpy.float64)
+            if not dontblank:
+                valid = numpy.logical_not(blank_mask(block, blank))
+                nvalid = valid.sum(axis=2)
+                if (nvalid < nv).any():
+                    block = numpy.where(valid, block, 0.0)
+                    self.allblank[y1:y2] = nvalid == 0
+                    iy, ix = numpy.nonzero((nvalid > 0) & (nvalid < nv))
+                    blanked[y1] = (iy+y1, ix, valid[iy, ix])
+            for k in range(maxorder+1):
+                numpy.cumsum(block*tpow[:, k], axis=2,
+                             out=self.sums[k][y1:y2, :, 1:])
+            numpy.cumsum(block**2, axis=2, out=self.sqsums[y1:y2, :, 1:])
+
+        blocks = row_blocks(data.shape, 8*(maxorder+4), maxmem,
+                            minblocks=workers)
+        map_blocks(_accumulate, blocks, workers=workers)
+        if isinstance(hdu, types.StringTypes):
+            data.close()
+        #pixels with some blanked channels, and their unblanked channels
+        if blanked:
+            parts = [blanked[y1] for y1 in sorted(blanked)]
+            self.blanked_y = numpy.concatenate([p[0] for p in parts])
+            self.blanked_x = numpy.concatenate([p[1] for p in parts])
+            self.blanked_valid = numpy.concatenate([p[2] for p in parts])
+        else:
+            self.blanked_y = numpy.zeros(0, dtype=int)
+            self.blanked_x = numpy.zeros(0, dtype=int)
+            self.blanked_valid = numpy.zeros((0, nv), dtype=bool)
+
+    def _window_spec(self, windows, chan):
+        return compile_windows(self.header, windows, chan=chan, kms=self.kms)
+
+    def fit(self, windows, order=0, chan=False):
+        """
+        Fit a polynomial baseline over windows to every spectrum.
+
+        @param windows: list of tuples (pairs) of channels/velocity
+            to fit the baseline over, or a L{WindowSpec}
+        @param order: order of the polynomial, up to the maxorder
+            of the index
+        @type order: int
+        @param chan: If True, windows are treated as channels
+        @type chan: Boolean
+        @return: tuple (coef, sigma) of the coefficients, of shape
+            (ny, nx, order+1), in the basis of L{baseline.design_matrix},
+            and the 2d image of the rms of the residuals in the windows.
+            Pixels with no more usable channels than coefficients get
+            NaN for both.
+        """
+        if order not in range(self.maxorder+1):
+            raise SculptArgumentError('order', "the index was built for orders up to %d" % self.maxorder)
+        spec = self._window_spec(windows, chan)
+        ncoef = order+1
+        ny, nx = self.shape[:2]
+        #sums over the windows, from differences of the index planes
+        b = numpy.zeros((ny, nx, ncoef))
+        yy = numpy.zeros((ny, nx))
+        g = numpy.zeros(2*order+1)
+        gb = numpy.zeros((self.blanked_y.size, 2*order+1))
+        if gb.shape[0]:
+            tpow = design_matrix(self.shape[2], 2*self.maxorder)[:, :2*order+1]
+        for c1, c2 in spec.ranges:
+            for k in range(ncoef):
+                b[:, :, k] += self.sums[k][:, :, c2] - self.sums[k][:, :, c1]
+            yy += self.sqsums[:, :, c2] - self.sqsums[:, :, c1]
+            g += self.tsums[c2, :2*order+1] - self.tsums[c1, :2*order+1]
+            if gb.shape[0]:
+                #sums of t**k over the unblanked window channels
+                gb += numpy.dot(self.blanked_valid[:, c1:c2], tpow[c1:c2])
+        #normal equations G[k, l] = sum of t**(k+l)
+        hankel = numpy.add.outer(numpy.arange(ncoef), numpy.arange(ncoef))
+        n = numpy.empty((ny, nx))
+        n.fill(g[0])
+        coef = numpy.empty((ny, nx, ncoef))
+        coef.fill(numpy.nan)
+        if g[0] > order:
+            coef[:] = numpy.linalg.solve(g[hankel], b.reshape(-1, ncoef).T).T.reshape(ny, nx, ncoef)
+        if gb.shape[0]:
+            by, bx = self.blanked_y, self.blanked_x
+            n[by, bx] = gb[:, 0]
+            coef[by, bx] = numpy.nan
+            ok = gb[:, 0] > order
+            if ok.any():
+                G = gb[ok][:, hankel]
+                coef[by[ok], bx[ok]] = numpy.linalg.solve(G, b[by[ok], bx[ok]][:, :, numpy.newaxis])[:, :, 0]
+        coef[self.allblank] = numpy.nan
+        #at the least squares solution the residual sum of squares
+        #is sum(y**2) - coef.b
+        rss = yy - (coef*b).sum(axis=2)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            sigma = numpy.sqrt(numpy.maximum(rss, 0.0)/n)
+        sigma[numpy.isnan(coef[:, :, 0])] = numpy.nan
+        return coef, sigma
+
+    def rmsmap(self, windows, order=0, chan=False):
+        """
+        Rms of the baseline subtracted spectra over windows. This gives
+        the same map as the rms HDU returned by L{baseline.baseline}
+        with the same windows, order and chan arguments.
+
+        @return: A HDU instance with the 2d rms map
+        """
+        spec = self._window_spec(windows, chan)
+        coef, sigma = self.fit(spec, order=order)
+        return pyfits.PrimaryHDU(sigma, header=_rms_header(self.header, spec))
+
+    def subtract(self, data, windows, order=0, chan=False, maxmem=None,
+                 workers=None):
+        """
+        Subtract the baseline fitted over windows from data in place.
+        data has to be the indexed cube (or an in-memory copy of it).
+        Blanked channels are not subtracted from.
+
+        @param data: numpy data cube in vlm format
+        @type data: numpy array
+        @return: the 2d rms image of the residuals in the windows
+        """
+        coef, sigma = self.fit(windows, order=order, chan=chan)
+        if data.shape != self.shape:
+            raise SculptArgumentError('data', "data has to have the shape of the indexed cube")
+        V = design_matrix(self.shape[2], order)
+        blank = get_blank(self.header)
+        fitted = numpy.isfinite(coef[:, :, 0])
+
+        def _subtract(y1, y2):
+            rows = data[y1:y2]
+            model = numpy.dot(coef[y1:y2].reshape(-1, order+1), V.T).reshape(rows.shape)
+            mask = fitted[y1:y2, :, numpy.newaxis]
+            if not self.dontblank:
+                mask = numpy.logical_and(mask, numpy.logical_not(blank_mask(rows, blank)))
+            numpy.subtract(rows, model, out=rows, where=mask, casting='unsafe')
+
+        blocks = row_blocks(data.shape, data.dtype.itemsize + 8, maxmem,
+                            minblocks=workers)
+        map_blocks(_subtract, blocks, workers=workers)
+        return sigma
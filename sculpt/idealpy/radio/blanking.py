@@ -0,0 +1,58 @@
+"""
+Blank handling shared by the radio reductions.
+
+A value of a cube is treated as blanked if it is not finite (NaN) or
+equals the BLANK keyword of the FITS header. Blanks are handled one
+block (row block, channel chunk or spatial window) at a time, on the
+piece of the cube that is being reduced, and the input cube is never
+modified:
+
+  - sums (moments, spectra) treat blanked values as zero
+  - statistics (rms, baseline fits) leave blanked values out
+
+Every reduction takes a dontblank keyword which switches this off,
+in which case blanks are used as plain numbers.
+"""
+
+import numpy
+
+def get_blank(header):
+    """
+    Return the BLANK value of a pyfits header, or None if the
+    header does not have one.
+    """
+    if 'BLANK' in header:
+        return header['BLANK']
+    return None
+
+def blank_mask(block, blank=None):
+    """
+    Return a boolean mask, of the same shape as block, which is True
+    for the blanked values of block.
+
+    @param block: numpy array
+    @param blank: BLANK value of the cube, or None
+    """
+    if block.dtype.kind == 'f':
+        mask = numpy.isnan(block)
+    else:
+        mask = numpy.zeros(block.shape, dtype=bool)
+    if blank is not None:
+        mask |= (block == blank)
+    return mask
+
+def fill_blanks(block, blank=None, value=0.0):
+    """
+    Return block with its blanked values replaced by value. If block
+    has no blanked values, block itself is returned, otherwise a new
+    array of the same shape. block is never modified.
+
+    @param block: numpy array
+    @param blank: BLANK value of the cube, or None
+    @param value: replacement value, e.g. 0.0 for sums or numpy.nan
+        for statistics that leave blanks out
+    """
+    mask = blank_mask(block, blank)
+    if not mask.any():
+        return block
+    return numpy.where(mask, value, block)
@@ -1,19 +1,28 @@
 from sculpt.utils import SculptArgumentError
-from sculpt.idealpy.fits import sxpar, sxaddpar, sxaddhist
+from sculpt.idealpy.fits import sxpar, sxaddpar, sxaddhist, sxdelpar
+from sculpt.idealpy.radio.blanking import get_blank, fill_blanks
+from sculpt.idealpy.radio.tiling import FITSCube, fits_cube, STREAM_TYPES
 import numpy
 from scipy import signal
 from astropy.io import fits as pyfits
-import copy
+import types
 import astropy.io
 
-def cube_extract(hdu, vxy, header=None):
+def cube_extract(hdu, vxy, header=None, dontblank=False, copy=False):
     """
     Given a 3-dimensionsal FITS format cube, returns a portion (sub-cube)
     of it.
+
+    Only the sub-cube is ever touched. For an in-memory cube the
+    returned data is a view into it (unless copy is set), and if a
+    FITS filename (or L{FITSCube}) is passed, only the bytes of the
+    sub-cube are read from disk.
     @param hdu: input pyfits style HDU (header data unit) or just the numpy
         numpy format data image from pyfits HDU data attribute.
         If numpy format data cube is passed, then the header parameter
-        should also be passed in.
+        should also be passed in. A FITS filename (or L{FITSCube}) can
+        also be passed.
+    @type hdu: pyfits HDU, numpy array, FITS filename or L{FITSCube}
     @param vxy: list or numpy array with 6 parameters, first 2 are limits of
         1st axis, 2nd pair is limits of 2nd axis, and 3rd pair are limits of
         3rd axis. Using -1 as a limit implies that you can use the limiting pixel.
@@ -21,23 +30,34 @@ def cube_extract(hdu, vxy, header=None):
         in 1st axis, but 40:60 each in 2nd and 3rd axis.
     @type vxy: list or numpy array
     @param header: pyfits header object if needed
+    @param dontblank: By default, BLANK values of the sub-cube are
+        replaced by NaN. If dontblank is set, they are left as they are.
+    @type dontblank: Boolean
+    @param copy: By default, the sub-cube of an in-memory cube is a view
+        that shares its data with the input cube (unless BLANK values
+        had to be replaced), so changing one changes the other. If copy
+        is set, the sub-cube is always an independent copy.
+    @type copy: Boolean
     @return: A HDU instance with 3d output subcube in the data attribute of the HDU, 
         and the corresponding header in header attribute of the HDU.
         """
     if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
         #get data and header from the hdu
-        data = hdu.data
         header = hdu.header
+        data = hdu.data
     elif isinstance(hdu, numpy.ndarray):
         if header is None or not isinstance(header, astropy.io.fits.header.Header):
             raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
         data = hdu
+    elif isinstance(hdu, STREAM_TYPES):
+        #read just the sub-cube from the FITS file
+        data = fits_cube(hdu)
+        header = data.header
     else:
-        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type, numpy ndarray or FITS filename")
     if len(vxy) != 6:
         raise SculptArgumentError('vxy', "has to be of length 6")
     hdr = header.copy()
-    dt = data.copy()
     naxis1 = sxpar(hdr, 'naxis1')
     naxis2 = sxpar(hdr, 'naxis2')
     naxis3 = sxpar(hdr, 'naxis3')
@@ -56,7 +76,16 @@ def cube_extract(hdu, vxy, header=None):
         y1 = 0
     if y2 > naxis3 or y2<0:
         y2 = naxis3
-    dt = dt[y1:y2, x1:x2, v1:v2]
+    dt = data[y1:y2, x1:x2, v1:v2]
+    if isinstance(hdu, types.StringTypes):
+        data.close()
+    if copy and isinstance(data, numpy.ndarray):
+        dt = numpy.array(dt)
+    blank = get_blank(hdr)
+    if not dontblank and blank is not None:
+        dt = fill_blanks(dt, blank, numpy.nan)
+        #blanks are now NaN, as for any floating point FITS image
+        sxdelpar(hdr, 'BLANK')
     ny, nx, nv = dt.shape
     cards = hdr.cards
     card = cards['NAXIS1']
@@ -82,3 +111,95 @@ def cube_extract(hdu, vxy, header=None):
     card = cards['CRPIX3']
     card.value = card.value-y1
     return pyfits.PrimaryHDU(dt, header=hdr)
+
+def _same(a, b):
+    return abs(a - b) <= 1e-6*max(abs(a), abs(b), 1e-30)
+
+def cube_extract_region(index, ramin, ramax, decmin, decmax, chans=None,
+                        dontblank=False):
+    """
+    Assemble the sub-cube covering a RA/DEC box from a survey split
+    into many FITS tiles, reading only the tiles (and only the sections
+    of them) that cover the box. The tiles are found with a
+    L{TileIndex}, and have to be vlm format cubes on the same pixel
+    grid and velocity axis.
+
+    @param index: L{TileIndex} of the tiles
+    @type index: L{TileIndex}
+    @param ramin: lower RA limit of the box in decimal degrees
+    @param ramax: upper RA limit of the box in decimal degrees
+    @param decmin: lower DEC limit of the box in decimal degrees
+    @param decmax: upper DEC limit of the box in decimal degrees
+    @param chans: (v1, v2) half-open range of channels to extract.
+        By default, all the channels are extracted.
+    @type chans: tuple
+    @param dontblank: By default, BLANK values of the tiles are
+        replaced by NaN. If dontblank is set, they are left as they are.
+    @type dontblank: Boolean
+    @return: A HDU instance with the 3d sub-cube in the data attribute
+        of the HDU, and the corresponding header in header attribute of
+        the HDU. Its grid is the grid of the first tile in the index
+        that covers the box. Where tiles overlap, the first tile with
+        an unblanked value is used, and pixels of the box that no tile
+        covers are NaN.
+    """
+    idx, tx1, tx2, ty1, ty2 = index._query(ramin, ramax, decmin, decmax)
+    if idx.size == 0:
+        raise SculptArgumentError('box', "no tile covers the box")
+    cubes = [FITSCube(index.filenames[i], ext=index.ext[i]) for i in idx]
+    try:
+        hdr = cubes[0].header.copy()
+        naxis1 = sxpar(hdr, 'naxis1')
+        if chans is None:
+            v1, v2 = 0, naxis1
+        else:
+            v1, v2 = max(chans[0], 0), min(chans[1], naxis1)
+        #pixel range of the box on the grid of the first tile
+        box = []
+        for axis, w1, w2 in ((2, ramin, ramax), (3, decmin, decmax)):
+            p = [sxpar(hdr, 'crpix%d' % axis) +
+                 (w - sxpar(hdr, 'crval%d' % axis))/sxpar(hdr, 'cdelt%d' % axis)
+                 for w in (w1, w2)]
+            box.append((int(numpy.ceil(min(p)-1e-6)), int(numpy.floor(max(p)+1e-6))+1))
+        (X1, X2), (Y1, Y2) = box
+        dtype = numpy.result_type(*[cube.dtype for cube in cubes])
+        dt = numpy.empty((Y2-Y1, X2-X1, v2-v1), dtype=dtype)
+        dt.fill(numpy.nan)
+        for k, cube in enumerate(cubes):
+            h = cube.header
+            if cube.ndim != 3:
+                raise SculptArgumentError('index', "%s is not a cube" % cube.filename)
+            for key in ('naxis1', 'crval1', 'cdelt1', 'crpix1', 'cdelt2', 'cdelt3'):
+                if not _same(sxpar(h, key), sxpar(hdr, key)):
+                    raise SculptArgumentError('index', "%s %s does not match the other tiles" % (cube.filename, key.upper()))
+            #offset of the tile in pixels of the first tile
+            offset = []
+            for axis in (2, 3):
+                o = (sxpar(hdr, 'crpix%d' % axis) - sxpar(h, 'crpix%d' % axis) +
+                     (sxpar(h, 'crval%d' % axis) - sxpar(hdr, 'crval%d' % axis))/sxpar(hdr, 'cdelt%d' % axis))
+                if abs(o - round(o)) > 1e-3:
+                    raise SculptArgumentError('index', "%s is not on the pixel grid of the other tiles" % cube.filename)
+                offset.append(int(round(o)))
+            ox, oy = offset
+            xs = slice(max(tx1[k]+ox-X1, 0), min(tx2[k]+ox-X1, X2-X1))
+            ys = slice(max(ty1[k]+oy-Y1, 0), min(ty2[k]+oy-Y1, Y2-Y1))
+            sub = cube[ys.start+Y1-oy:ys.stop+Y1-oy, xs.start+X1-ox:xs.stop+X1-ox, v1:v2]
+            blank = get_blank(h)
+            if not dontblank:
+                sub = fill_blanks(sub, blank, numpy.nan)
+            target = dt[ys, xs]
+            dt[ys, xs] = numpy.where(numpy.isnan(target), sub, target)
+    finally:
+        for cube in cubes:
+            cube.close()
+    if not dontblank:
+        sxdelpar(hdr, 'BLANK')
+    ny, nx, nv = dt.shape
+    sxaddpar(hdr, 'NAXIS1', nv)
+    sxaddpar(hdr, 'NAXIS2', nx)
+    sxaddpar(hdr, 'NAXIS3', ny)
+    sxaddpar(hdr, 'CRPIX1', sxpar(hdr, 'crpix1')-v1)
+    sxaddpar(hdr, 'CRPIX2', sxpar(hdr, 'crpix2')-X1)
+    sxaddpar(hdr, 'CRPIX3', sxpar(hdr, 'crpix3')-Y1)
+    sxaddhist(hdr, "Assembled from %d tiles for RA %.5f to %.5f, DEC %.5f to %.5f" % (idx.size, ramin, ramax, decmin, decmax))
+    return pyfits.PrimaryHDU(dt, header=hdr)
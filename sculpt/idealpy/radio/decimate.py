@@ -0,0 +1,235 @@
+"""
+Spectral decimation of cubes.
+
+Reducing the number of channels of a cube by a factor f is a weighted
+average of the input channels for every output channel, so it can be
+done on any axis layout by walking the cube in blocks along a spatial
+axis, without transposing it or interpolating it. Three weightings are
+offered by L{decimate_axis}:
+
+  - 'average': plain average of every f channels (f an integer)
+  - 'hanning': average with a Hanning window of FWHM f channels,
+    centred on every block of f channels, which suppresses the
+    aliasing of the plain average
+  - 'rebin': flux-conserving rebinning, which also allows a
+    non-integer f. Each input channel contributes in proportion to
+    its overlap with the output channel, so the integrated intensity
+    is conserved. For an integer f this is the same as 'average'.
+
+Output channel i covers input channels i*f to (i+1)*f, so the new
+header (see L{decimate_header}) has CDELT multiplied by f and
+CRPIX = (CRPIX - 0.5)/f + 0.5. Trailing channels that do not fill a
+whole output channel are dropped.
+"""
+
+from sculpt.utils import SculptArgumentError
+from sculpt.idealpy.fits import sxpar, sxaddpar, sxaddhist
+from tiling import row_blocks, map_blocks
+from blanking import get_blank, blank_mask
+
+import numpy
+import math
+import astropy.io
+from astropy.io import fits as pyfits
+
+def _hanning_taps(factor):
+    """
+    Offsets m (from the first channel of a block) and weights of the
+    Hanning window of FWHM factor centred on a block of factor channels.
+    """
+    centre = (factor-1)/2.
+    m = numpy.arange(int(math.floor(centre-factor))+1,
+                     int(math.ceil(centre+factor)))
+    w = numpy.cos(numpy.pi*(m-centre)/(2.*factor))**2
+    keep = w > 0
+    return m[keep], w[keep]
+
+def _decimate_block(block, factor, axis, nnew, method, blank, dontblank):
+    """
+    Decimate an in-memory block along axis to nnew channels.
+    """
+    block = numpy.asarray(block, dtype=numpy.float64)
+    if dontblank:
+        valid = None
+    else:
+        valid = numpy.logical_not(blank_mask(block, blank))
+        block = numpy.where(valid, block, 0.0)
+    index = [slice(None)]*block.ndim
+    if method == 'average':
+        f = int(factor)
+        index[axis] = slice(0, nnew*f)
+        shape = list(block.shape)
+        shape[axis:axis+1] = [nnew, f]
+        total = block[tuple(index)].reshape(shape).sum(axis=axis+1)
+        if valid is None:
+            return total/f
+        count = valid[tuple(index)].reshape(shape).sum(axis=axis+1)
+    elif method == 'hanning':
+        n = block.shape[axis]
+        shape = list(block.shape)
+        shape[axis] = nnew
+        total = numpy.zeros(shape)
+        count = numpy.zeros(shape)
+        f = int(factor)
+        for m, w in zip(*_hanning_taps(f)):
+            #output channels i with input channel i*f + m on the cube
+            i1 = max(0, -(m // f))
+            i2 = min(nnew, (n - 1 - m)//f + 1)
+            if i2 <= i1:
+                continue
+            index[axis] = slice(i1*f+m, (i2-1)*f+m+1, f)
+            out = [slice(None)]*block.ndim
+            out[axis] = slice(i1, i2)
+            total[tuple(out)] += w*block[tuple(index)]
+            if valid is None:
+                count[tuple(out)] += w
+            else:
+                count[tuple(out)] += w*valid[tuple(index)]
+    else:
+        #integrals of the block (and of the unblanked channels) from the
+        #start of the axis, at the edges of the output channels
+        edges = numpy.arange(nnew+1)*float(factor)
+        lo = numpy.minimum(numpy.floor(edges).astype(int), block.shape[axis]-1)
+        frac = edges - lo
+        shape = [1]*block.ndim
+        shape[axis] = nnew+1
+        frac = frac.reshape(shape)
+
+        def _integral(values):
+            cum = numpy.cumsum(values, axis=axis)
+            cum = numpy.concatenate([numpy.zeros_like(numpy.take(cum, [0], axis=axis)),
+                                     cum], axis=axis)
+            return numpy.take(cum, lo, axis=axis) + frac*numpy.take(values, lo, axis=axis)
+
+        total = numpy.diff(_integral(block), axis=axis)
+        if valid is None:
+            return total/float(factor)
+        count = numpy.diff(_integral(valid.astype(numpy.float64)), axis=axis)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.where(count > 0, total/count, numpy.nan)
+
+def decimate_axis(data, factor, axis, method='average', blank=None,
+                  dontblank=False, maxmem=None, workers=None):
+    """
+    Decimate a cube by factor along one of its (numpy) axes, in its
+    native layout, one block along another axis at a time.
+
+    @param data: numpy data cube (or L{FITSCube})
+    @param factor: decimation factor. It has to be an integer for
+        methods 'average' and 'hanning'
+    @type factor: int or float
+    @param axis: numpy axis to decimate
+    @type axis: int
+    @param method: 'average', 'hanning' or 'rebin'
+    @type method: string
+    @param blank: BLANK value of the cube, or None
+    @param dontblank: By default, blanked values are left out of the
+        averages (output channels with no unblanked input are NaN). If
+        dontblank is set, they are used as numbers.
+    @type dontblank: Boolean
+    @param maxmem: upper limit in bytes for a block of the cube
+    @type maxmem: int
+    @param workers: number of threads to decimate the blocks with
+    @type workers: int
+    @return: the decimated numpy data cube
+    """
+    if method not in ('average', 'hanning', 'rebin'):
+        raise SculptArgumentError('method', "method can only be one of 'average', 'hanning' or 'rebin'")
+    if method != 'rebin' and factor != int(factor):
+        raise SculptArgumentError('factor', "factor has to be an integer for method %s" % method)
+    if factor < 1:
+        raise SculptArgumentError('factor', "factor has to be 1 or larger")
+    shape = data.shape
+    nnew = int(math.floor(shape[axis]/float(factor) + 1e-9))
+    if nnew < 1:
+        raise SculptArgumentError('factor', "factor is larger than the number of channels")
+    newshape = list(shape)
+    newshape[axis] = nnew
+    out = numpy.empty(newshape, dtype=numpy.result_type(data.dtype, numpy.float32))
+    #walk the cube along the slowest axis other than axis
+    caxis = 0 if axis != 0 else 1
+    cshape = (shape[caxis],) + tuple([n for i, n in enumerate(shape) if i != caxis])
+
+    def _decimate(a1, a2):
+        index = [slice(None)]*len(shape)
+        index[caxis] = slice(a1, a2)
+        out[tuple(index)] = _decimate_block(data[tuple(index)], factor, axis,
+                                            nnew, method, blank, dontblank)
+
+    blocks = row_blocks(cshape, 32, maxmem, minblocks=workers)
+    map_blocks(_decimate, blocks, workers=workers)
+    return out
+
+def decimate_header(header, factor, vaxis, method='average'):
+    """
+    Update header for a cube decimated by factor along FITS axis vaxis:
+    NAXISn is the new number of channels, CDELTn is multiplied by
+    factor and CRPIXn becomes (CRPIXn - 0.5)/factor + 0.5, so CRVALn
+    stays at the same pixel position.
+
+    @return: the updated header (header is changed in place)
+    """
+    n = sxpar(header, 'NAXIS%d' % vaxis)
+    sxaddpar(header, 'NAXIS%d' % vaxis, int(math.floor(n/float(factor) + 1e-9)))
+    sxaddpar(header, 'CDELT%d' % vaxis, sxpar(header, 'CDELT%d' % vaxis)*factor)
+    sxaddpar(header, 'CRPIX%d' % vaxis, (sxpar(header, 'CRPIX%d' % vaxis)-0.5)/factor + 0.5)
+    sxaddhist(header, 'Decimating axis %d by %g with method %s' % (vaxis, factor, method))
+    return header
+
+def _velocity_axis(header):
+    for i in range(1, sxpar(header, 'NAXIS')+1):
+        ctype = sxpar(header, 'CTYPE%d' % i)
+        if ctype is not None and ctype[:4] in ('VELO', 'VRAD', 'FREQ'):
+            return i
+    #vlm cubes
+    return 1
+
+def decimate_spectra(hdu, factor, header=None, method='average', vaxis=None,
+                     dontblank=False, maxmem=None, workers=None):
+    """
+    Reduce the number of channels of a cube by factor, with header
+    CDELT and CRPIX kept consistent. See the module documentation for
+    the methods.
+
+    @param hdu: input pyfits style HDU (header data unit) or just the numpy
+        numpy format data cube from pyfits HDU data attribute.
+        If numpy format data cube is passed, then the header parameter
+        should also be passed in. Any axis layout can be used.
+    @type hdu: pyfits HDU or numpy array
+    @param factor: decimation factor. It has to be an integer for
+        methods 'average' and 'hanning'
+    @type factor: int or float
+    @param header: pyfits header object if needed
+    @param method: 'average', 'hanning' or 'rebin'
+    @type method: string
+    @param vaxis: FITS axis number of the spectral axis. By default it is
+        the first axis with a velocity or frequency CTYPE, or axis 1.
+    @type vaxis: int
+    @param dontblank: See L{decimate_axis}
+    @type dontblank: Boolean
+    @param maxmem: upper limit in bytes for a block of the cube
+    @type maxmem: int
+    @param workers: number of threads to decimate the blocks with
+    @type workers: int
+    @return: A HDU instance with the decimated cube in the data attribute
+        of the HDU, and the corresponding header in header attribute of
+        the HDU.
+    """
+    if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
+        #get data and header from the hdu
+        data = hdu.data
+        header = hdu.header
+    elif isinstance(hdu, numpy.ndarray):
+        if header is None or not isinstance(header, astropy.io.fits.header.Header):
+            raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+        data = hdu
+    else:
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
+    if vaxis is None:
+        vaxis = _velocity_axis(header)
+    axis = data.ndim - vaxis
+    dt = decimate_axis(data, factor, axis, method=method,
+                       blank=get_blank(header), dontblank=dontblank,
+                       maxmem=maxmem, workers=workers)
+    hdr = decimate_header(header.copy(), factor, vaxis, method=method)
+    return pyfits.PrimaryHDU(dt, header=hdr)
@@ -7,13 +7,74 @@ import astropy.io
 
 from sculpt.utils import SculptArgumentError
 from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, getaxes, sxaddhist, xyad
-from sculpt.idealpy.radio.extract_spec import extract_spec
+from sculpt.idealpy.radio.extract_spec import sample_spectra
 
-def extract_posvel(hdu, p1, p2, header=None, gauss_width=2):
+def _line_samples(x1, y1, x2, y2, step=1.0):
+    """
+    Sample positions every step pixels along the line from (x1, y1)
+    towards (x2, y2), starting at (x1, y1).
+
+    @return: tuple (x, y, ux, uy) of the arrays of sample positions and
+        the unit vector along the line
+    """
+    d = math.sqrt((x1-x2)**2 + (y1-y2)**2.)
+    if d == 0:
+        raise SculptArgumentError('positions', "the two ends of the cut have to be different positions")
+    ux = (x2-x1)/d
+    uy = (y2-y1)/d
+    s = numpy.arange(int(d/step))*step
+    return x1 + s*ux, y1 + s*uy, ux, uy
+
+def _pv_spectra(data, header, x, y, ux, uy, gauss_width=2, width=0,
+                bilinear=False, cache=None):
+    """
+    Spectra at the sample positions (x, y) of a cut with unit vector
+    (ux, uy) (scalars, or arrays with one vector per sample), averaged
+    over a strip width pixels wide perpendicular to the cut. The strip
+    is sampled at whole pixel offsets from the cut, symmetric about it,
+    each weighted by how much of its pixel lies inside the strip (so a
+    width 2 strip takes offsets -1, 0 and 1 with weights 1/2, 1 and
+    1/2). All the positions (and their perpendicular offsets) are
+    sampled from the cube in one pass of L{sample_spectra}.
+
+    @return: numpy array (npos, nv). Samples off the map are NaN, and
+        are left out of the perpendicular average.
+    """
+    if width <= 0:
+        return sample_spectra(data, header, x, y, gauss_width=gauss_width,
+                              bilinear=bilinear, cache=cache)
+    half = width/2.
+    kmax = int(math.ceil(half + 0.5)) - 1
+    offsets = numpy.arange(-kmax, kmax+1)
+    weights = (numpy.minimum(offsets + 0.5, half) -
+               numpy.maximum(offsets - 0.5, -half))
+    xs = x[:, numpy.newaxis] - numpy.multiply.outer(uy, offsets)
+    ys = y[:, numpy.newaxis] + numpy.multiply.outer(ux, offsets)
+    spectra = sample_spectra(data, header, xs.ravel(), ys.ravel(),
+                             gauss_width=gauss_width, bilinear=bilinear,
+                             cache=cache)
+    spectra = spectra.reshape(x.size, offsets.size, data.shape[2])
+    valid = numpy.isfinite(spectra)
+    w = weights[:, numpy.newaxis]*valid
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return (numpy.where(valid, spectra, 0.0)*w).sum(axis=1)/w.sum(axis=1)
+
+def _pv_history(hdr, step, width, bilinear):
+    if step != 1.0:
+        sxaddpar(hdr, "CDELT2", sxpar(hdr, "CDELT2")*step)
+    if step != 1.0 or width > 0 or bilinear:
+        sxaddhist(hdr, "posvel sampled every %g pixels, width %g pixels, bilinear=%s" % (step, width, bilinear))
+
+def extract_posvel(hdu, p1, p2, header=None, gauss_width=2, cache=None,
+                   step=1.0, width=0, bilinear=False):
     """
     Given a hdu in vlm format, and two positions (in pixel
     coordinates), obtains a position velocity cut along that line
     Returns p-v image as a pyfits hdu unit.
+
+    All the sample positions along the cut are computed at once, and
+    the cube is sampled at all of them in one vectorized pass (see
+    L{sample_spectra}).
     @param hdu: input pyfits style HDU (header data unit) or just the numpy
         numpy format data cube from pyfits HDU data attribute.
         If numpy format data cube is passed, then the header parameter
@@ -27,8 +88,21 @@ def extract_posvel(hdu, p1, p2, header=None, gauss_width=2):
     @type p2: tuple, list or array of floats or ints
     @param header: pyfits header object if needed
     @gauss_width: the width of the gaussian kernel to use in weighting
-        neighboring pixels with when extracting spectra
+        neighboring pixels with when extracting spectra. If 0, the
+        cube is not smoothed.
     @type gauss_width: int
+    @param cache: optional L{SmoothedCubeCache} to look the spectra
+        up from, see L{extract_spec}
+    @type cache: L{SmoothedCubeCache}
+    @param step: distance in pixels between the samples along the cut
+    @type step: float
+    @param width: if larger than 0, the spectra are averaged over
+        a strip this many pixels wide perpendicular to the cut, sampled
+        every pixel (see L{_pv_spectra})
+    @type width: float
+    @param bilinear: If True, the samples are bilinearly interpolated
+        between pixels rather than taken at the nearest pixel
+    @type bilinear: Boolean
     @return A HDU instance with 2d position-velocity image in the data
         attribute of the HDU, and the corresponding header in header
         attribute of the HDU.
@@ -44,10 +118,10 @@ def extract_posvel(hdu, p1, p2, header=None, gauss_width=2):
     else:
         raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
     hdr = header.copy()
-    dt = data.copy()
-    hdu = pyfits.PrimaryHDU(dt, header=hdr)
-    if gauss_width <= 0 or type(gauss_width) != types.IntType:
-        raise SculptArgumentError('gauss_width', "should be positive and non-zero integer")
+    if gauss_width < 0 or type(gauss_width) != types.IntType:
+        raise SculptArgumentError('gauss_width', "should be a positive integer or 0")
+    if step <= 0:
+        raise SculptArgumentError('step', "should be positive")
     try:
         if len(p1) != 2 and len(p2) != 2:
             raise SculptArgumentError('positions', "Positions p1 and p2 should be 2-element tuples, lists or arrays")
@@ -55,18 +129,9 @@ def extract_posvel(hdu, p1, p2, header=None, gauss_width=2):
         raise SculptArgumentError('positions', "Positions p1 and p2 should be 2-element tuples, lists or arrays")
     x1, y1 = p1
     x2, y2 = p2
-    m = (y1-y2)/(x1-x2)  #slope of line
-    d = math.sqrt((x1-x2)**2 + (y1-y2)**2.)
-    posvel = numpy.zeros((int(d), dt.shape[2]), dtype='float')
-    dist = numpy.arange(int(d))
-    if x1 <= x2:
-        x = x1 + numpy.sqrt(dist**2./(1+m**2.)) #2nd term is deltax
-    else:
-        x = x1 - numpy.sqrt(dist**2./(1+m**2.)) #2nd term is deltax
-    y = y1 + m*(x-x1)
-    for i in range(int(d)):
-        posvel[i,:] = extract_spec(hdu, x[i], y[i],
-                                   gauss_width=gauss_width).data
+    x, y, ux, uy = _line_samples(x1, y1, x2, y2, step=step)
+    posvel = _pv_spectra(data, header, x, y, ux, uy, gauss_width=gauss_width,
+                         width=width, bilinear=bilinear, cache=cache)
 
     xmid = (x1+x2)/2.
     ymid = (y1+y2)/2.
@@ -80,7 +145,5 @@ def extract_posvel(hdu, p1, p2, header=None, gauss_width=2):
     for name in ('CTYPE', 'CRVAL', 'CDELT', 'CRPIX'):
             sxdelpar(hdr, "%s3" % name)
     sxaddhist(hdr, "Extracted posvel image from (%.1f, %.1f) to (%.1f, %.1f) with gauss_width=%s" % (x1, y1, x2, y2, gauss_width))
+    _pv_history(hdr, step, width, bilinear)
     return pyfits.PrimaryHDU(posvel, header=hdr)
-
-
-    
@@ -7,15 +7,20 @@ import astropy.io
 
 from sculpt.utils import SculptArgumentError
 from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, getaxes, sxaddhist, xyad
-from sculpt.idealpy.radio.extract_spec import extract_spec
-from sculpt.idealpy.utils import line_rectangle_intersection
+from sculpt.idealpy.radio.extract_posvel import _line_samples, _pv_spectra, _pv_history
+from sculpt.idealpy.utils import line_rectangle_intersections
+from sculpt.idealpy.radio.smoothcache import SmoothedCubeCache
 
-def extract_posvel_angle(hdu, p1, angle, header=None, gauss_width=2):
+def extract_posvel_angle(hdu, p1, angle, header=None, gauss_width=2,
+                         cache=None, step=1.0, width=0, bilinear=False):
     """
     Given a hdu in vlm format, and one position (in pixel
     coordinates), and an angle, obtains a position velocity cut about
     that position with that angle, along that line
     Returns p-v image as a pyfits hdu unit.
+
+    As in L{extract_posvel}, the cube is sampled at all the positions
+    along the cut in one vectorized pass.
     @param hdu: input pyfits style HDU (header data unit) or just the numpy
         numpy format data cube from pyfits HDU data attribute.
         If numpy format data cube is passed, then the header parameter
@@ -30,6 +35,17 @@ def extract_posvel_angle(hdu, p1, angle, header=None, gauss_width=2):
     @gauss_width: the width of the gaussian kernel to use in weighting
         neighboring pixels with when extracting spectra
     @type gauss_width: int
+    @param cache: optional L{SmoothedCubeCache} to look the spectra
+        up from, see L{extract_spec}
+    @type cache: L{SmoothedCubeCache}
+    @param step: distance in pixels between the samples along the cut
+    @type step: float
+    @param width: if larger than 0, the spectra are averaged over
+        this many pixels perpendicular to the cut
+    @type width: float
+    @param bilinear: If True, the samples are bilinearly interpolated
+        between pixels, see L{extract_posvel}
+    @type bilinear: Boolean
     @return A HDU instance with 2d position-velocity image in the data
         attribute of the HDU, and the corresponding header in header
         attribute of the HDU.
@@ -45,10 +61,10 @@ def extract_posvel_angle(hdu, p1, angle, header=None, gauss_width=2):
     else:
         raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
     hdr = header.copy()
-    dt = data.copy()
-    hdu = pyfits.PrimaryHDU(dt, header=hdr)
-    if gauss_width <= 0 or type(gauss_width) != types.IntType:
-        raise SculptArgumentError('gauss_width', "should be positive and non-zero integer")
+    if gauss_width < 0 or type(gauss_width) != types.IntType:
+        raise SculptArgumentError('gauss_width', "should be a positive integer or 0")
+    if step <= 0:
+        raise SculptArgumentError('step', "should be positive")
     try:
         if len(p1) != 2:
             raise SculptArgumentError('positions', "Positions p1 and p2 should be 2-element tuples, lists or arrays")
@@ -56,9 +72,8 @@ def extract_posvel_angle(hdu, p1, angle, header=None, gauss_width=2):
         raise SculptArgumentError('positions', "Positions p1 and p2 should be 2-element tuples, lists or arrays")
     a, b = p1
     #x2, y2 = p2
-    m = math.tan(math.radians(angle)) #slope of line
     xmin, ymin = 0, 0
-    y1, x1, v1 = hdu.data.shape
+    y1, x1, v1 = data.shape
     ymax = y1-1
     xmax = x1-1
     print "xylims: ", xmin, ymin, xmax, ymax
@@ -102,25 +117,22 @@ def extract_posvel_angle(hdu, p1, angle, header=None, gauss_width=2):
     #         xh = ((ymin-b)/m) + a
     #     if xmin <= xh and xh <= xmax:
     #         yh = ymax
-    i1, i2 = line_rectangle_intersection(xmin, xmax, ymin, ymax, a, b, angle)
-    xl,yl = i1
-    xh,yh = i2
+    i1, i2 = line_rectangle_intersections(xmin, xmax, ymin, ymax, a, b, angle)
+    xl, yl = i1[0][0], i1[1][0]
+    xh, yh = i2[0][0], i2[1][0]
+    if numpy.isnan(xl):
+        raise SculptArgumentError('positions', "the cut does not cross the map")
+    if (xh, yh) < (xl, yl):
+        #start from the end with the lowest x, as line_rectangle_intersection
+        xl, yl, xh, yh = xh, yh, xl, yl
     print xl, xh, yl, yh
-    d = math.sqrt((xl-xh)**2 + (yl-yh)**2.)
-    posvel = numpy.zeros((int(d), dt.shape[2]), dtype='float')
-    dist = numpy.arange(int(d))
-    if xl <= xh:
-        x = xl + numpy.sqrt(dist**2./(1+m**2.)) #2nd term is deltax
-    else:
-        x = xl - numpy.sqrt(dist**2./(1+m**2.)) #2nd term is deltax
-    y = yl + m*(x-xl)
-    for i in range(int(d)):
-        posvel[i,:] = extract_spec(hdu, x[i], y[i],
-                                   gauss_width=gauss_width).data
+    x, y, ux, uy = _line_samples(xl, yl, xh, yh, step=step)
+    posvel = _pv_spectra(data, header, x, y, ux, uy, gauss_width=gauss_width,
+                         width=width, bilinear=bilinear, cache=cache)
     r, d = xyad(header, a, b)
     sxaddpar(hdr, "CRVAL2", r)
     dmid = math.sqrt((xl-a)**2 + (yl-b)**2)
-    sxaddpar(hdr, "CRPIX2", int(dmid))
+    sxaddpar(hdr, "CRPIX2", int(dmid/step))
 
     sxaddpar(hdr, "NAXIS", 2)
     sxdelpar(hdr, "NAXIS3")
@@ -128,7 +140,141 @@ def extract_posvel_angle(hdu, p1, angle, header=None, gauss_width=2):
     for name in ('CTYPE', 'CRVAL', 'CDELT', 'CRPIX'):
             sxdelpar(hdr, "%s3" % name)
     sxaddhist(hdr, "Extracted posvel image from (%.1f, %.1f) with angle %.2f with gauss_width=%s" % (a, b, angle, gauss_width))
+    _pv_history(hdr, step, width, bilinear)
     return pyfits.PrimaryHDU(posvel, header=hdr)
 
+def extract_posvel_fan(hdu, p1, angles, header=None, gauss_width=2,
+                       cache=None, step=1.0, width=0, bilinear=False):
+    """
+    Given a hdu in vlm format, one position (in pixel coordinates)
+    and a list of angles, obtains the position velocity cuts through
+    that position at all the angles in one call, e.g. for a position
+    angle search over angles=numpy.arange(0, 180).
+    Returns a stack of p-v images as a pyfits hdu unit.
 
-    
+    All the lines are clipped to the map at once with
+    L{line_rectangle_intersections}, and the cube is smoothed only
+    once (in a L{SmoothedCubeCache}) for all the cuts, so a full sweep
+    costs about as much as a single cut. The smoothed copy is as large
+    as the cube (in at least single precision) while the sweep runs; pass
+    a cache (possibly with a sidecar_dir) to control it. Unlike L{extract_posvel_angle},
+    every cut is sampled on the same grid of offsets from p1, with p1
+    itself at offset 0, so the cuts line up in the stack. Offsets
+    outside the map for a given angle are NaN.
+    @param hdu: input pyfits style HDU (header data unit) or just the numpy
+        numpy format data cube from pyfits HDU data attribute.
+        If numpy format data cube is passed, then the header parameter
+        should also be passed in. The cube is expected to be in vlm format.
+    @type hdu: pyfits hdu type or numpy nd-array
+    @param p1: (x, y) pixel location of the centre of the cuts. The x,y
+        position can be a two-tuple, a list of two elements, or numpy
+        array of two elements
+    @type p1: tuple, list or array of floats or ints
+    @param angles: angles of the PV cuts with respect to X-axis in degrees
+    @type angles: numpy array or list of floats
+    @param header: pyfits header object if needed
+    @param gauss_width: the width of the gaussian kernel to use in weighting
+        neighboring pixels with when extracting spectra. If 0, the
+        cube is not smoothed.
+    @type gauss_width: int
+    @param cache: optional L{SmoothedCubeCache} to look the spectra
+        up from. If not given, a temporary one is used for the call.
+    @type cache: L{SmoothedCubeCache}
+    @param step: distance in pixels between the samples along the cuts
+    @type step: float
+    @param width: if larger than 0, the spectra are averaged over
+        this many pixels perpendicular to the cuts
+    @type width: float
+    @param bilinear: If True, the samples are bilinearly interpolated
+        between pixels, see L{extract_posvel}
+    @type bilinear: Boolean
+    @return A HDU instance with a 3d image of numpy shape (nangle, noffset,
+        nchan) in the data attribute of the HDU. Axis 1 of its header is
+        the velocity axis of the cube, axis 2 the offset from p1 in
+        degrees and axis 3 the angle.
+    """
+    if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
+        #get data and header from the hdu
+        data = hdu.data
+        header = hdu.header
+    elif isinstance(hdu, numpy.ndarray):
+        if header is None or not isinstance(header, astropy.io.fits.header.Header):
+            raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+        data = hdu
+    else:
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
+    hdr = header.copy()
+    if gauss_width < 0 or type(gauss_width) != types.IntType:
+        raise SculptArgumentError('gauss_width', "should be a positive integer or 0")
+    if step <= 0:
+        raise SculptArgumentError('step', "should be positive")
+    try:
+        if len(p1) != 2:
+            raise SculptArgumentError('positions', "Position p1 should be 2-element tuples, lists or arrays")
+    except:
+        raise SculptArgumentError('positions', "Position p1 should be 2-element tuples, lists or arrays")
+    a, b = p1
+    angles = numpy.atleast_1d(numpy.asarray(angles, dtype=float))
+    if angles.ndim != 1 or angles.size == 0:
+        raise SculptArgumentError('angles', "angles should be a 1d list or array")
+    ny, nx, nv = data.shape
+    (xl, yl), (xh, yh) = line_rectangle_intersections(0, nx-1, 0, ny-1,
+                                                      a, b, angles)
+    ux = numpy.cos(numpy.radians(angles))
+    uy = numpy.sin(numpy.radians(angles))
+    #extent of each cut as offsets from p1 along (ux, uy)
+    tmin = (xl-a)*ux + (yl-b)*uy
+    tmax = (xh-a)*ux + (yh-b)*uy
+    if numpy.isnan(tmin).all():
+        raise SculptArgumentError('positions', "none of the cuts cross the map")
+    kmin = int(math.ceil(numpy.nanmin(tmin)/step))
+    kmax = int(math.floor(numpy.nanmax(tmax)/step))
+    offsets = numpy.arange(kmin, kmax+1)*step
+    x = a + numpy.multiply.outer(ux, offsets)
+    y = b + numpy.multiply.outer(uy, offsets)
+    dx = numpy.repeat(ux, offsets.size)
+    dy = numpy.repeat(uy, offsets.size)
+    if cache is None and gauss_width > 0:
+        #smooth the cube once for all the cuts, at the precision of
+        #the cube (but at least single)
+        fancache = SmoothedCubeCache(maxsize=1,
+                                     dtype=numpy.result_type(data.dtype, numpy.float32))
+    else:
+        fancache = cache
+    try:
+        posvel = _pv_spectra(data, header, x.ravel(), y.ravel(), dx, dy,
+                             gauss_width=gauss_width, width=width,
+                             bilinear=bilinear, cache=fancache)
+    finally:
+        if fancache is not cache:
+            fancache.clear()
+    posvel = posvel.reshape(angles.size, offsets.size, nv)
+    with numpy.errstate(invalid='ignore'):
+        outside = numpy.logical_not(numpy.logical_and(
+            offsets >= tmin[:, numpy.newaxis] - 1e-9,
+            offsets <= tmax[:, numpy.newaxis] + 1e-9))
+    posvel[outside] = numpy.nan
+
+    r, d = xyad(header, a, b)
+    cdelt = abs(sxpar(hdr, "CDELT2"))
+    sxaddpar(hdr, "NAXIS", 3)
+    sxaddpar(hdr, "NAXIS2", offsets.size)
+    sxaddpar(hdr, "NAXIS3", angles.size)
+    sxaddpar(hdr, "CTYPE2", "OFFSET", "Offset from centre of cuts")
+    sxaddpar(hdr, "CRVAL2", 0.0, comment="DEGREES")
+    sxaddpar(hdr, "CRPIX2", 1-kmin)
+    sxaddpar(hdr, "CDELT2", cdelt*step, comment="DEGREES")
+    sxaddpar(hdr, "CTYPE3", "ANGLE", "Angle of cut from X-axis")
+    sxaddpar(hdr, "CRVAL3", angles[0], comment="DEGREES")
+    sxaddpar(hdr, "CRPIX3", 1)
+    if angles.size > 1:
+        dang = numpy.diff(angles)
+        sxaddpar(hdr, "CDELT3", dang[0], comment="DEGREES")
+        if not numpy.allclose(dang, dang[0]):
+            sxaddhist(hdr, "ANGLES : %s" % repr(list(angles)))
+    else:
+        sxaddpar(hdr, "CDELT3", 1.0, comment="DEGREES")
+    sxdelpar(hdr, "NAXIS4")
+    sxaddhist(hdr, "Extracted %d posvel images about (%.1f, %.1f) (RA %.5f, DEC %.5f) with gauss_width=%s" % (angles.size, a, b, r, d, gauss_width))
+    sxaddhist(hdr, "posvel sampled every %g pixels, width %g pixels, bilinear=%s" % (step, width, bilinear))
+    return pyfits.PrimaryHDU(posvel, header=hdr)
@@ -0,0 +1,148 @@
+import numpy
+from astropy.io import fits as pyfits
+import scipy.interpolate
+import types
+import astropy.io
+
+from sculpt.utils import SculptArgumentError
+from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, sxaddhist
+from sculpt.idealpy.radio.extract_posvel import _pv_spectra
+
+#number of points per pixel of path length the spline is evaluated at
+#before it is resampled by arc length
+SPLINE_OVERSAMPLE = 10
+
+def _path_vertices(path):
+    """
+    Check path and return its vertices as an array of shape (n, 2),
+    without repeated consecutive vertices.
+    """
+    try:
+        vert = numpy.asarray(path, dtype=float)
+    except (TypeError, ValueError):
+        vert = None
+    if vert is None or vert.ndim != 2 or vert.shape[1] != 2:
+        raise SculptArgumentError('path', "path should be a sequence of (x, y) positions")
+    #repeated vertices make zero length segments
+    keep = numpy.ones(vert.shape[0], dtype=bool)
+    keep[1:] = (numpy.diff(vert, axis=0) != 0).any(axis=1)
+    vert = vert[keep]
+    if vert.shape[0] < 2:
+        raise SculptArgumentError('path', "path should have at least two different positions")
+    return vert
+
+def path_samples(path, step=1.0, spline=False):
+    """
+    Sample positions every step pixels of arc length along a path.
+
+    @param path: the (x, y) pixel locations of the vertices of the path,
+        as a sequence of 2-element tuples or an array of shape (n, 2)
+    @param step: distance in pixels between the samples along the path
+    @type step: float
+    @param spline: If False, the path is the polyline through the
+        vertices. If True, it is the interpolating cubic spline through
+        them.
+    @type spline: Boolean
+    @return: tuple (x, y, ux, uy, s) of arrays, with the sample
+        positions, the unit tangent vector of the path at each sample
+        and the arc length of each sample from the first vertex. The
+        first vertex is always sampled, even if the path is shorter
+        than step.
+    """
+    vert = _path_vertices(path)
+    if spline and vert.shape[0] > 2:
+        chord = numpy.hypot(*numpy.diff(vert, axis=0).T).sum()
+        tck, u = scipy.interpolate.splprep([vert[:, 0], vert[:, 1]], s=0,
+                                           k=min(3, vert.shape[0]-1))
+        u = numpy.linspace(0, 1, int(SPLINE_OVERSAMPLE*chord)+2)
+        vert = numpy.array(scipy.interpolate.splev(u, tck)).T
+    seg = numpy.diff(vert, axis=0)
+    seglen = numpy.hypot(seg[:, 0], seg[:, 1])
+    cumlen = numpy.concatenate(([0.0], numpy.cumsum(seglen)))
+    s = numpy.arange(max(1, int(cumlen[-1]/step)))*step
+    #segment each sample falls in, and where along it
+    i = numpy.clip(numpy.searchsorted(cumlen, s, side='right')-1, 0, seg.shape[0]-1)
+    frac = (s - cumlen[i])/numpy.where(seglen[i] > 0, seglen[i], 1.0)
+    x = vert[i, 0] + frac*seg[i, 0]
+    y = vert[i, 1] + frac*seg[i, 1]
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        ux = seg[i, 0]/seglen[i]
+        uy = seg[i, 1]/seglen[i]
+    return x, y, ux, uy, s
+
+def extract_posvel_path(hdu, path, header=None, gauss_width=2, cache=None,
+                        step=1.0, width=0, bilinear=False, spline=False):
+    """
+    Given a hdu in vlm format, and a path through a list of positions
+    (in pixel coordinates), obtains a position velocity cut along
+    that path, sampled by arc length. This follows curved structures
+    like filaments or outflows, which a straight L{extract_posvel}
+    cut does not. As in L{extract_posvel}, the cube is sampled at all
+    the positions along the path in one vectorized pass.
+    Returns p-v image as a pyfits hdu unit.
+    @param hdu: input pyfits style HDU (header data unit) or just the numpy
+        numpy format data cube from pyfits HDU data attribute.
+        If numpy format data cube is passed, then the header parameter
+        should also be passed in. The cube is expected to be in vlm format.
+    @type hdu: pyfits hdu type or numpy nd-array
+    @param path: (x, y) pixel locations of the vertices of the path, as a
+        list of 2-element tuples, lists or arrays, or an array of
+        shape (n, 2)
+    @param header: pyfits header object if needed
+    @param gauss_width: the width of the gaussian kernel to use in weighting
+        neighboring pixels with when extracting spectra. If 0, the
+        cube is not smoothed.
+    @type gauss_width: int
+    @param cache: optional L{SmoothedCubeCache} to look the spectra
+        up from, see L{extract_spec}
+    @type cache: L{SmoothedCubeCache}
+    @param step: distance in pixels between the samples along the path
+    @type step: float
+    @param width: if larger than 0, the spectra are averaged over a
+        strip this many pixels wide, perpendicular to the path
+    @type width: float
+    @param bilinear: If True, the samples are bilinearly interpolated
+        between pixels rather than taken at the nearest pixel
+    @type bilinear: Boolean
+    @param spline: If True, the path is a cubic spline through the
+        vertices rather than straight segments between them
+    @type spline: Boolean
+    @return A HDU instance with 2d position-velocity image in the data
+        attribute of the HDU, and the corresponding header in header
+        attribute of the HDU. Axis 2 is the offset along the path in
+        degrees, from 0 at the first vertex.
+    """
+    if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
+        #get data and header from the hdu
+        data = hdu.data
+        header = hdu.header
+    elif isinstance(hdu, numpy.ndarray):
+        if header is None or not isinstance(header, astropy.io.fits.header.Header):
+            raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+        data = hdu
+    else:
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
+    hdr = header.copy()
+    if gauss_width < 0 or type(gauss_width) != types.IntType:
+        raise SculptArgumentError('gauss_width', "should be a positive integer or 0")
+    if step <= 0:
+        raise SculptArgumentError('step', "should be positive")
+    vert = _path_vertices(path)
+    x, y, ux, uy, s = path_samples(vert, step=step, spline=spline)
+    posvel = _pv_spectra(data, header, x, y, ux, uy, gauss_width=gauss_width,
+                         width=width, bilinear=bilinear, cache=cache)
+
+    #offset along the path, in the pixel scale of the map
+    cdelt = abs(sxpar(hdr, "CDELT2"))
+    sxaddpar(hdr, "CTYPE2", "OFFSET", "Offset along path")
+    sxaddpar(hdr, "CRVAL2", 0.0, comment="DEGREES")
+    sxaddpar(hdr, "CRPIX2", 1)
+    sxaddpar(hdr, "CDELT2", cdelt*step, comment="DEGREES")
+    sxaddpar(hdr, "NAXIS", 2)
+    sxdelpar(hdr, "NAXIS3")
+
+    for name in ('CTYPE', 'CRVAL', 'CDELT', 'CRPIX'):
+            sxdelpar(hdr, "%s3" % name)
+    sxaddhist(hdr, "Extracted posvel image along a %s path through %d positions with gauss_width=%s" % (('polyline', 'spline')[bool(spline)], vert.shape[0], gauss_width))
+    sxaddhist(hdr, "posvel sampled every %g pixels, width %g pixels, bilinear=%s" % (step, width, bilinear))
+    return pyfits.PrimaryHDU(posvel, header=hdr)
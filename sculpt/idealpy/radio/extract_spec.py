@@ -5,10 +5,14 @@ import types
 import astropy.io
 
 from sculpt.utils import SculptArgumentError
-from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, getaxes, sxaddhist
+from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, getaxes, sxaddhist, ad_cdec_xy
 from sculpt.idealpy.radio.smooth_image import gauss_kern
+from sculpt.idealpy.radio.blanking import get_blank, blank_mask, fill_blanks
+from sculpt.idealpy.radio.tiling import BLOCK_BYTES
+from sculpt.idealpy.radio.smoothcache import bilinear_corners
 
-def extract_spec(hdu, x0, y0, header=None, gauss_width=2):
+def extract_spec(hdu, x0, y0, header=None, gauss_width=2, dontblank=False,
+                 cache=None):
     """
     Given a hdu in vlm format, and a x0,y0 location (in pixel
     coordinates), obtains a gaussian-convolved spectra
@@ -27,6 +31,16 @@ def extract_spec(hdu, x0, y0, header=None, gauss_width=2):
     @gauss_width: the width of the gaussian kernel to use in weighting
         neighboring pixels with.
     @type gauss_width: int
+    @param dontblank: By default, blanked (BLANK or NaN) pixels are
+        left out of the kernel-weighted average, and the weights of
+        the remaining pixels renormalized. If dontblank is set, such
+        blanking is not performed.
+    @type dontblank: Boolean
+    @param cache: optional L{SmoothedCubeCache}. If given, the cube is
+        smoothed once for gauss_width (on the first call) and the
+        spectrum is looked up from the smoothed cube. The cache's own
+        dontblank setting then applies.
+    @type cache: L{SmoothedCubeCache}
     @return A HDU instance with 1d spectrum map in the data attribute of the HDU, 
         and the corresponding header in header attribute of the HDU.
     
@@ -42,12 +56,11 @@ def extract_spec(hdu, x0, y0, header=None, gauss_width=2):
     else:
         raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
     hdr = header.copy()
-    dt = data.copy()
     if gauss_width <= 0 or type(gauss_width) != types.IntType:
         raise SculptArgumentError('gauss_width', "should be positive and non-zero integer")
     gk = gauss_kern(gauss_width)
     kernx, kerny = gk.shape
-    ysize, xsize, vsize = dt.shape
+    ysize, xsize, vsize = data.shape
     if x0 < 0 or x0 >= xsize:
         raise SculptArgumentError('x0', "x0=%s is out of bounds of x-limits: (0, %d)" % (x0, xsize))
     if y0 < 0 or y0 >= ysize:
@@ -65,15 +78,27 @@ def extract_spec(hdu, x0, y0, header=None, gauss_width=2):
         ymin = 0
     if ymax >= ysize:
         ymax = ysize-1
-    specdata = numpy.zeros(vsize, dtype='float')
     #print "Gk = " , gk
     #print xmin, xmax, ymin, ymax
     #print gk.sum().shape
-    if xmax-xmin != kernx or ymax-ymin != kerny:
-        specdata = dt[y0, x0, :]
+    blank = get_blank(header)
+    if cache is not None:
+        specdata = cache.spectrum(data, header, x0, y0, gauss_width)
+    elif xmax-xmin != kernx or ymax-ymin != kerny:
+        specdata = data[int(round(y0)), int(round(x0)), :].copy()
+        if not dontblank:
+            specdata = fill_blanks(specdata, blank, numpy.nan)
     else:
-        for i in range(vsize):
-            specdata[i] = (gk*dt[ymin:ymax, xmin:xmax, i]).sum()/gk.sum()
+        #view of the spatial window around (x0, y0); the kernel
+        #weighted sum over all channels is a single tensordot
+        window = data[ymin:ymax, xmin:xmax, :]
+        if dontblank:
+            wsum = gk.sum()
+        else:
+            valid = numpy.logical_not(blank_mask(window, blank))
+            window = fill_blanks(window, blank)
+            wsum = numpy.tensordot(gk, valid, axes=([0, 1], [0, 1]))
+        specdata = numpy.tensordot(gk, window, axes=([0, 1], [0, 1]))/wsum
 
     sxaddpar(hdr, "NAXIS", 1)
     sxdelpar(hdr, "NAXIS2")
@@ -86,3 +111,191 @@ def extract_spec(hdu, x0, y0, header=None, gauss_width=2):
 
 
     
+
+def _gather_spectra(data, cx, cy, gk, blank=None, dontblank=False,
+                    maxmem=None):
+    """
+    Kernel-weighted spectra of a VLM cube at many integer pixel
+    positions at once, with the same rules as L{extract_spec}: where
+    the kernel does not fit inside the map, the spectrum of the pixel
+    itself is used. The kernel windows of a chunk of positions are
+    gathered with one fancy index and weighted with one tensordot.
+
+    @param data: VLM cube, numpy shape (ny, nx, nv)
+    @param cx: integer x pixel positions
+    @param cy: integer y pixel positions
+    @param gk: 2d kernel of weights
+    @param blank: BLANK value of the cube, or None
+    @param dontblank: If False, blanked pixels are left out and the
+        weights renormalized (or are NaN on the single-pixel path)
+    @param maxmem: upper limit in bytes for the gathered windows of a
+        chunk of positions. Defaults to L{tiling.BLOCK_BYTES}.
+    @return: numpy array (npos, nv) of spectra
+    """
+    if maxmem is None:
+        maxmem = BLOCK_BYTES
+    ysize, xsize, vsize = data.shape
+    kern = gk.shape[0]
+    xmin = cx - kern/2
+    ymin = cy - kern/2
+    full = (xmin >= 0) & (xmin+kern < xsize) & (ymin >= 0) & (ymin+kern < ysize)
+    out = numpy.empty((cx.size, vsize))
+    edge = numpy.flatnonzero(numpy.logical_not(full))
+    if edge.size:
+        out[edge] = data[cy[edge], cx[edge], :]
+        if not dontblank:
+            out[edge] = fill_blanks(out[edge], blank, numpy.nan)
+    dy, dx = numpy.indices(gk.shape).reshape(2, -1)
+    w = gk.ravel()
+    inner = numpy.flatnonzero(full)
+    chunk = max(1, int(maxmem // (2*8*w.size*vsize)))
+    for i in range(0, inner.size, chunk):
+        idx = inner[i:i+chunk]
+        window = data[ymin[idx, numpy.newaxis]+dy, xmin[idx, numpy.newaxis]+dx]
+        if dontblank:
+            out[idx] = numpy.tensordot(window, w, axes=([1], [0]))/w.sum()
+        else:
+            valid = numpy.logical_not(blank_mask(window, blank))
+            window = fill_blanks(window, blank)
+            out[idx] = (numpy.tensordot(window, w, axes=([1], [0])) /
+                        numpy.tensordot(valid, w, axes=([1], [0])))
+    return out
+
+def sample_spectra(data, header, x, y, gauss_width=2, dontblank=False,
+                   bilinear=False, cache=None, maxmem=None):
+    """
+    Gaussian-convolved spectra of a VLM cube at arrays of pixel
+    positions, all computed in one vectorized pass. This is the engine
+    behind L{extract_spectra} and the position-velocity extractions.
+
+    @param data: VLM cube, numpy shape (ny, nx, nv)
+    @param header: pyfits header of the cube
+    @param x: x pixel locations
+    @type x: numpy array
+    @param y: y pixel locations
+    @type y: numpy array
+    @param gauss_width: the width of the gaussian kernel, as in
+        L{extract_spec}. If 0, the cube is not smoothed and only
+        sampled (or bilinearly interpolated).
+    @type gauss_width: int
+    @param dontblank: See L{extract_spec}
+    @type dontblank: Boolean
+    @param bilinear: If False, the kernel is centred on the pixel
+        nearest to each position. If True, the spectra of the four
+        pixels around each position are bilinearly interpolated.
+    @type bilinear: Boolean
+    @param cache: optional L{SmoothedCubeCache} to look the spectra up
+        from. It is not needed for gauss_width=0.
+    @param maxmem: upper limit in bytes for the pixels gathered at a time
+    @type maxmem: int
+    @return: numpy array (npos, nv) of spectra. Positions outside the
+        map give NaN.
+    """
+    x = numpy.asarray(x, dtype=float)
+    y = numpy.asarray(y, dtype=float)
+    if gauss_width == 0:
+        gk = numpy.ones((1, 1))
+    else:
+        gk = gauss_kern(gauss_width)
+    ysize, xsize, vsize = data.shape
+    blank = get_blank(header)
+    inside = (x >= 0) & (x < xsize) & (y >= 0) & (y < ysize)
+    specdata = numpy.empty((x.size, vsize))
+    specdata.fill(numpy.nan)
+    xi, yi = x[inside], y[inside]
+    if cache is not None and gauss_width > 0:
+        specdata[inside] = cache.spectra(data, header, xi, yi, gauss_width,
+                                         bilinear=bilinear)
+    elif bilinear:
+        acc = numpy.zeros((xi.size, vsize))
+        for cx, cy, wgt in bilinear_corners(xi, yi, xsize, ysize):
+            wgt = wgt[:, numpy.newaxis]
+            spec = _gather_spectra(data, cx, cy, gk, blank, dontblank, maxmem)
+            acc += numpy.where(wgt > 0, spec*wgt, 0.0)
+        specdata[inside] = acc
+    else:
+        #same rounding (half away from zero) as extract_spec
+        cx = numpy.floor(xi+0.5).astype(int)
+        cy = numpy.floor(yi+0.5).astype(int)
+        #positions within half a pixel of the far edges round off the map
+        cx = numpy.minimum(cx, xsize-1)
+        cy = numpy.minimum(cy, ysize-1)
+        specdata[inside] = _gather_spectra(data, cx, cy, gk, blank, dontblank, maxmem)
+    return specdata
+
+def extract_spectra(hdu, x, y, header=None, gauss_width=2, dontblank=False,
+                    world=False, bilinear=False, maxmem=None):
+    """
+    Batch version of L{extract_spec}: given a hdu in vlm format and
+    arrays of positions, obtains the gaussian-convolved spectra at all
+    of them at once. The spectra are returned as the rows of a single
+    2d image with one shared header, rather than as one HDU each.
+
+    Positions outside the map give a row of NaN rather than an error,
+    so that a whole catalogue can be passed in.
+
+    @param hdu: input pyfits style HDU (header data unit) or just the numpy
+        numpy format data cube from pyfits HDU data attribute.
+        If numpy format data cube is passed, then the header parameter
+        should also be passed in. The cube is expected to be in vlm format.
+    @type hdu: pyfits hdu type or numpy nd-array
+    @param x: x pixel locations (or RA in decimal degrees if world is True)
+    @type x: numpy array, list or scalar
+    @param y: y pixel locations (or DEC in decimal degrees if world is True)
+    @type y: numpy array, list or scalar
+    @param header: pyfits header object if needed
+    @param gauss_width: the width of the gaussian kernel to use in weighting
+        neighboring pixels with.
+    @type gauss_width: int
+    @param dontblank: See L{extract_spec}
+    @type dontblank: Boolean
+    @param world: If True, x and y are RA and DEC, converted to pixels
+        with L{ad_cdec_xy}
+    @type world: Boolean
+    @param bilinear: By default, as in L{extract_spec}, the kernel is
+        centred on the pixel nearest to each position. If bilinear is
+        True, the spectra of the four pixels around each position are
+        bilinearly interpolated instead, for sub-pixel placement.
+    @type bilinear: Boolean
+    @param maxmem: upper limit in bytes for the pixels gathered at a time
+    @type maxmem: int
+    @return: A HDU instance with the spectra in a 2d image of numpy
+        shape (npos, nchan), in the order of the positions. Axis 1 of
+        its header is the velocity axis of the cube, axis 2 the
+        position number.
+    """
+    if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
+        #get data and header from the hdu
+        data = hdu.data
+        header = hdu.header
+    elif isinstance(hdu, numpy.ndarray):
+        if header is None or not isinstance(header, astropy.io.fits.header.Header):
+            raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+        data = hdu
+    else:
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
+    if gauss_width <= 0 or type(gauss_width) != types.IntType:
+        raise SculptArgumentError('gauss_width', "should be positive and non-zero integer")
+    x = numpy.atleast_1d(numpy.asarray(x, dtype=float))
+    y = numpy.atleast_1d(numpy.asarray(y, dtype=float))
+    if x.shape != y.shape or x.ndim != 1:
+        raise SculptArgumentError('x', "x and y should be 1d and of the same length")
+    if world:
+        x, y = ad_cdec_xy(header, x, y)
+    specdata = sample_spectra(data, header, x, y, gauss_width=gauss_width,
+                              dontblank=dontblank, bilinear=bilinear,
+                              maxmem=maxmem)
+
+    hdr = header.copy()
+    sxaddpar(hdr, "NAXIS", 2)
+    sxaddpar(hdr, "NAXIS2", x.size)
+    sxdelpar(hdr, "NAXIS3")
+    for i in range(2,4):
+        for name in ('CTYPE', 'CRVAL', 'CDELT', 'CRPIX'):
+            sxdelpar(hdr, "%s%i" % (name, i))
+    sxaddpar(hdr, "CTYPE2", "POSITION", "Position number")
+    sxaddpar(hdr, "CRVAL2", 0)
+    sxaddpar(hdr, "CRPIX2", 1)
+    sxaddpar(hdr, "CDELT2", 1)
+    sxaddhist(hdr, "Extracted %d spectra with gauss_width=%s" % (x.size, gauss_width))
+    return pyfits.PrimaryHDU(specdata, header=hdr)
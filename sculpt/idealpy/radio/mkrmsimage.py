@@ -1,5 +1,8 @@
-from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, getaxes, sxaddhist
+from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, sxaddhist
 from sculpt.utils import SculptArgumentError
+from tiling import row_blocks, map_blocks, fits_cube, STREAM_TYPES
+from blanking import get_blank, blank_mask, fill_blanks
+from windowspec import compile_windows
 
 import numpy
 from astropy.io import fits as pyfits
@@ -7,10 +10,118 @@ import types
 import astropy.io
 #import copy
 
+#working set (in bytes) of a single channel chunk of the rms accumulation
+CHUNK_BYTES = 8*1024*1024
+
+def streaming_rms(data, y1, y2, ranges, blank=None, dontblank=False):
+    """
+    Standard deviation along the velocity axis of rows y1 to y2 of a
+    VLM cube, over the given channel ranges. The channels are walked
+    in chunks of at most L{CHUNK_BYTES}, and each chunk is merged into
+    running count, mean and sum of squared deviations images with the
+    pairwise update of Chan, Golub & LeVeque. No copy of the selected
+    channels is ever made, and the result matches numpy's std (ddof=0).
+
+    @param data: VLM cube (numpy array or L{FITSCube})
+    @param y1: first row
+    @type y1: int
+    @param y2: last row + 1
+    @type y2: int
+    @param ranges: list of (c1, c2) half-open channel ranges to use
+    @param blank: BLANK value of the cube, or None
+    @param dontblank: If False, blanked values are left out
+    @type dontblank: Boolean
+    @return: 2d rms image of the rows y1 to y2. Pixels without any
+        unblanked channel are NaN.
+    """
+    shape = (y2-y1, data.shape[1])
+    count = numpy.zeros(shape)
+    mean = numpy.zeros(shape)
+    m2 = numpy.zeros(shape)
+    step = max(1, CHUNK_BYTES // (8*shape[0]*shape[1]))
+    for c1, c2 in ranges:
+        for k1 in range(c1, c2, step):
+            k2 = min(k1+step, c2)
+            chunk = data[y1:y2, :, k1:k2]
+            if dontblank:
+                n = float(k2-k1)
+                cmean = chunk.mean(axis=2, dtype=numpy.float64)
+                dev = chunk - cmean[:, :, numpy.newaxis]
+            else:
+                valid = numpy.logical_not(blank_mask(chunk, blank))
+                n = valid.sum(axis=2)
+                chunk = numpy.where(valid, chunk, 0.0)
+                cmean = chunk.sum(axis=2, dtype=numpy.float64)/numpy.maximum(n, 1)
+                dev = numpy.where(valid, chunk - cmean[:, :, numpy.newaxis], 0.0)
+            cm2 = (dev**2).sum(axis=2)
+            total = count + n
+            frac = n/numpy.maximum(total, 1)
+            delta = cmean - mean
+            mean += delta*frac
+            m2 += cm2 + delta**2*count*frac
+            count = total
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return numpy.sqrt(m2/count)
+
+#scale factor from median absolute deviation to gaussian sigma
+MAD_TO_SIGMA = 1.482602218505602
+
+def _median(block):
+    """
+    Median along the velocity axis, ignoring NaN. Both numpy.median
+    and numpy.nanmedian select with numpy.partition rather than sort.
+    """
+    if numpy.isnan(block).any():
+        return numpy.nanmedian(block, axis=2)
+    return numpy.median(block, axis=2)
+
+def robust_rms(block, method='mad', clip=3.0, niter=10):
+    """
+    Robust estimate of the noise along the velocity axis of every
+    spectrum of a block of a VLM cube at once.
+
+    @param block: block of a VLM cube with numpy shape (ny, nx, nchan),
+        holding only the channels to use. Blanked values should be NaN.
+    @param method: 'mad' for the scaled median absolute deviation, or
+        'sigmaclip' for the standard deviation after iteratively
+        clipping channels more than clip sigma away from the mean.
+    @type method: string
+    @param clip: clipping threshold in sigma for method='sigmaclip'
+    @type clip: float
+    @param niter: maximum number of clipping iterations. Iteration
+        stops as soon as no spectrum clips any further channel.
+    @type niter: int
+    @return: 2d rms image
+    """
+    if method == 'mad':
+        med = _median(block)
+        return MAD_TO_SIGMA*_median(numpy.abs(block - med[:, :, numpy.newaxis]))
+    elif method == 'sigmaclip':
+        mask = numpy.isfinite(block)
+        values = numpy.where(mask, block, 0.0)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            for i in range(niter):
+                n = mask.sum(axis=2)
+                mean = values.sum(axis=2)/n
+                dev = numpy.where(mask, values - mean[:, :, numpy.newaxis], 0.0)
+                std = numpy.sqrt((dev**2).sum(axis=2)/n)
+                newmask = numpy.logical_and(mask, numpy.abs(dev) <= clip*std[:, :, numpy.newaxis])
+                if (newmask == mask).all():
+                    #every spectrum has converged
+                    break
+                mask = newmask
+                values = numpy.where(mask, values, 0.0)
+        return std
+    else:
+        raise SculptArgumentError('method', "method can only be one of 'std', 'mad' or 'sigmaclip'")
+
 def mkrmsimage (hdu, window, header=None, 
                 chan=False, dontblank=False,
                 kms=True,
-                moment=0):
+                moment=0,
+                maxmem=None,
+                workers=None,
+                method='std', clip=3.0, niter=10):
     """
     Create rms image from spectral cube. The input cube is expected
     to be in the VLM format
@@ -19,8 +130,10 @@ def mkrmsimage (hdu, window, header=None,
         numpy format data cube from pyfits HDU data attribute.
         This cube is expected to be in vlm format. If numpy format
         data cube is passed, then the header parameter should also be
-        passed in.
-    @type hdu: pyfits HDU or numpy array
+        passed in. If a FITS filename (or L{FITSCube}) is passed, the
+        cube is memory-mapped and streamed from disk one block of rows
+        at a time, so it never has to fit in memory.
+    @type hdu: pyfits HDU, numpy array, FITS filename or L{FITSCube}
     @param header: pyfits style header object that corresponds to the
         hdu data variable. This header parameter is only considered if
         the hdu parameter is a numpy array type rather than a pyfits HDU
@@ -31,17 +144,38 @@ def mkrmsimage (hdu, window, header=None,
         True, these should be integers. If chan is False, this is expected to be
         velocity expressed in kms (if the input parameter kms is True). If
         chan is False, and kms is False, v1 is treated with the same
-        units as the FITS header describes.
+        units as the FITS header describes. Both limits of every window
+        are excluded. A L{WindowSpec} from L{compile_windows} can be
+        passed instead, in which case chan and kms are taken from it.
     @param chan: If True, window variables are treated as channels. If False,
         they are treated as velocity
     @type chan: Boolean
     @param dontblank: By default, mkrmsimage will use the BLANK fits
-        header value and automatically zero blanked values in order
-        to compute rms. If dontblank keyword is set, then
-        such blanking is not performed.
+        header value (and NaN values) and automatically leave blanked
+        values out of the rms, without modifying the input cube.
+        If dontblank keyword is set, then such blanking is not performed.
     @type dontblank: Boolean
     @param kms: If True velocity units is in kms.
     @type kms: Boolean
+    @param maxmem: upper limit in bytes for the block of rows of the
+        cube that is worked on at a time. Defaults to
+        L{tiling.BLOCK_BYTES}. The result does not depend on it.
+    @type maxmem: int
+    @param workers: if larger than 1, the blocks of rows are reduced
+        in parallel on a pool of that many threads.
+    @type workers: int
+    @param method: noise estimator to use. 'std' (default) is the
+        standard deviation of the line-free channels. The robust
+        estimators, which are not inflated by residual lines and spikes,
+        are 'mad' (median absolute deviation scaled to a gaussian sigma)
+        and 'sigmaclip' (iteratively sigma-clipped standard deviation).
+        See L{robust_rms}.
+    @type method: string
+    @param clip: clipping threshold in sigma for method='sigmaclip'
+    @type clip: float
+    @param niter: maximum number of clipping iterations for
+        method='sigmaclip'
+    @type niter: int
     @return: A HDU instance with 2d output map in the data attribute of the HDU, 
         and the corresponding header in header attribute of the HDU.
 
@@ -54,11 +188,14 @@ def mkrmsimage (hdu, window, header=None,
         if header is None or not isinstance(header, astropy.io.fits.header.Header):
             raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
         data = hdu
+    elif isinstance(hdu, STREAM_TYPES):
+        #stream the cube from a memory-mapped FITS file
+        data = fits_cube(hdu)
+        header = data.header
     else:
-        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
-    #check for list or tuple type of window
-    if type(window) not in (types.ListType, types.TupleType):
-        raise SculptArgumentError('window', 'has to be a List Type or Tuple Type')
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type, numpy ndarray or FITS filename")
+    if method not in ('std', 'mad', 'sigmaclip'):
+        raise SculptArgumentError('method', "method can only be one of 'std', 'mad' or 'sigmaclip'")
     # calculate the x-axis (velocity) 
     crpix1 = sxpar(header,"CRPIX1")
     crval1 = sxpar(header,"CRVAL1")
@@ -79,25 +216,33 @@ def mkrmsimage (hdu, window, header=None,
     nv = sxpar(header,"NAXIS1")
     nx = sxpar(header,"NAXIS2")
     ny = sxpar(header,"NAXIS3")
-    blank = sxpar(header,"BLANK")
+    blank = get_blank(header)
 
-    cube = data.copy()
-    if not dontblank and blank is not None:
-        ind = numpy.where(cube == blank)
-        cube[ind] = 0.0
+    #channels outside the windows
+    spec = compile_windows(header, window, chan=chan, kms=kms)
+    ranges = spec.complement().ranges
+    rms = numpy.zeros(data.shape[:2])
 
-    #get velocity axis
-    velax = getaxes(header, 1)
-    indices = numpy.zeros(velax.shape, dtype=bool)
-    for v1, v2 in window:
-        if chan:
-            indices[v1:v2] = True
-        else:
-            ind = numpy.logical_and(velax>= v1, velax<= v2)
-            indices = numpy.logical_or(indices, ind)
-    indices = numpy.logical_not(indices) # for indices to include in std calc
+    def _rms(y1, y2):
+        if method == 'std':
+            rms[y1:y2] = streaming_rms(data, y1, y2, ranges, blank=blank,
+                                       dontblank=dontblank)
+            return
+        if not ranges:
+            #the windows cover every channel, as streaming_rms gives
+            rms[y1:y2] = numpy.nan
+            return
+        block = numpy.concatenate([data[y1:y2, :, c1:c2] for c1, c2 in ranges],
+                                  axis=2)
+        if not dontblank:
+            block = fill_blanks(block, blank, numpy.nan)
+        rms[y1:y2] = robust_rms(block, method=method, clip=clip, niter=niter)
 
-    rms = cube[:,:,indices].std(axis=2)
+    blocks = row_blocks(data.shape, data.dtype.itemsize, maxmem,
+                        minblocks=workers)
+    map_blocks(_rms, blocks, workers=workers)
+    if isinstance(hdu, types.StringTypes):
+        data.close()
     hnew = header.copy()
     
     sxaddpar(hnew, "CRVAL1", crval2, comment="DEGREES")
@@ -113,11 +258,10 @@ def mkrmsimage (hdu, window, header=None,
     sxaddpar(hnew, "NAXIS2", ny)
     sxaddpar(hnew, "NAXIS3", 1)
     sxaddpar(hnew, "NAXIS4", 1)
-    if chan:
-        vorc = 'CHANNEL'
-    else:
-        vorc = 'VELOCITY'
-    sxaddhist(hnew, "WINDOW : %s; Window %s LIMITS" % (repr(window), vorc))
+    sxaddhist(hnew, "WINDOW : %s; Window %s LIMITS" % (repr(list(spec.windows)),
+                                                     spec.vorc()))
+    if method != 'std':
+        sxaddhist(hnew, "RMS estimated with method %s" % method)
     #sxaddpar(hnew, "BUNIT", units, "Units")
     sxdelpar(hnew, "CRVAL3")
     sxdelpar(hnew, "CRPIX3")
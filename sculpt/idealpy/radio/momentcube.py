@@ -1,19 +1,140 @@
-from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, getaxes, sxaddhist
+from sculpt.idealpy.fits import sxpar, sxdelpar, sxaddpar, sxaddhist
 from sculpt.utils import SculptArgumentError
-from mkrmsimage import mkrmsimage
+from mkrmsimage import mkrmsimage, streaming_rms
+from tiling import row_blocks, map_blocks, fits_cube, STREAM_TYPES
+from windowspec import WindowSpec, compile_windows
+from blanking import get_blank, fill_blanks
 
 import numpy
 from astropy.io import fits as pyfits
 import math
+import types
 #import copy
 import astropy.io
 
-def momentcube (hdu, v1, v2, header=None, 
+def _moment_header(header, v1, v2, chan, moment):
+    """
+    Build the 2d header of a moment map from the header of
+    the VLM cube it was derived from.
+    """
+    crpix2 = sxpar(header,"CRPIX2")
+    crval2 = sxpar(header,"CRVAL2")
+    cdelt2 = sxpar(header,"CDELT2")
+    ctype2 = sxpar(header,"CTYPE2")
+    crpix3 = sxpar(header,"CRPIX3")
+    crval3 = sxpar(header,"CRVAL3")
+    cdelt3 = sxpar(header,"CDELT3")
+    ctype3 = sxpar(header,"CTYPE3")
+    nx = sxpar(header,"NAXIS2")
+    ny = sxpar(header,"NAXIS3")
+    hnew = header.copy()
+    
+    sxaddpar(hnew, "CRVAL1", crval2, comment="DEGREES")
+    sxaddpar(hnew, "CRPIX1", crpix2)
+    sxaddpar(hnew, "CDELT1", cdelt2, comment="DEGREES")
+    sxaddpar(hnew, "CTYPE1", ctype2)
+    sxaddpar(hnew, "CRVAL2", crval3, comment="DEGREES")
+    sxaddpar(hnew, "CRPIX2", crpix3)
+    sxaddpar(hnew, "CDELT2", cdelt3, comment="DEGREES")
+    sxaddpar(hnew, "CTYPE2", ctype3)
+    sxaddpar(hnew, "NAXIS", 2)
+    sxaddpar(hnew, "NAXIS1", nx)
+    sxaddpar(hnew, "NAXIS2", ny)
+    sxaddpar(hnew, "NAXIS3", 1)
+    sxaddpar(hnew, "NAXIS4", 1)
+    if chan:
+        vorc = 'CHANNEL'
+    else:
+        vorc = 'VELOCITY'
+    sxaddpar(hnew, "VMIN", v1, "LOWER %s LIMIT" % vorc)
+    sxaddpar(hnew,"VMAX", v2, "UPPER %s LIMIT" % vorc)
+    sxaddpar(hnew, "MOMENT", moment, comment="Order of Moment")
+    if moment == 0:
+        units = "K.km/s"
+    else:
+        units = "km/s"
+    sxaddpar(hnew, "BUNIT", units, "Units")
+    for axis in xrange(3, 5):
+        for attr in ('CRVAL', 'CRPIX', 'CDELT',
+                     'CROTA', 'CTYPE', 'NAXIS'):
+            sxdelpar(hnew, '%s%1d' % (attr, axis))
+    return hnew
+
+def _velocity_window(header, v1, v2, chan, kms):
+    """
+    Return the L{WindowSpec} of the v1 to v2 integration window. v1
+    may already be a WindowSpec, in which case v2 is ignored.
+    """
+    if isinstance(v1, WindowSpec):
+        return v1
+    if v2 is None:
+        raise SculptArgumentError('v2', "v2 is needed unless v1 is a WindowSpec")
+    return compile_windows(header, [(v1, v2)], chan=chan, kms=kms)
+
+def _moment_sums(data, spec, moment=2, rmsspec=None,
+                 blank=None, dontblank=False, maxmem=None, workers=None):
+    """
+    Accumulate the moment sums of a VLM cube in a single sweep.
+    The cube is walked one block of rows at a time, and every
+    moment sum (and optionally the rms of the line-free channels)
+    is computed from the same block before moving on to the next.
+
+    @param data: VLM cube with numpy shape (ny, nx, nv)
+    @param spec: L{WindowSpec} of the channels to integrate over
+    @param moment: highest moment sum needed (0, 1 or 2)
+    @param rmsspec: L{WindowSpec} of the channels to use for the rms.
+        If None, no rms is computed.
+    @param blank: BLANK value of the cube, or None
+    @param dontblank: If False, blanked values (see L{blanking}) are
+        zeroed in each block before it is reduced, and left out of
+        the rms. The input data is never modified.
+    @param maxmem: upper limit in bytes for a block of rows
+    @param workers: number of threads to process the blocks with
+    @return: tuple of (T, C, W, rms) images, where T is the sum of
+        intensity, C the sum of intensity*velocity and W the sum of
+        intensity*velocity**2. Sums beyond the requested moment,
+        and the rms if rmsspec is None, are returned as None.
+    """
+    ny, nx, nv = data.shape
+    sel = spec.slice
+    v = spec.velax[spec.mask]
+    T = numpy.zeros((ny, nx))
+    C, W, rms = None, None, None
+    if moment >= 1:
+        C = numpy.zeros((ny, nx))
+    if moment == 2:
+        W = numpy.zeros((ny, nx))
+        v2 = v**2.
+    if rmsspec is not None:
+        rms = numpy.zeros((ny, nx))
+
+    def _reduce(y1, y2):
+        rows = data[y1:y2]
+        block = rows[:, :, sel]
+        if not dontblank:
+            block = fill_blanks(block, blank)
+        T[y1:y2] = block.sum(axis=2)
+        if moment >= 1:
+            C[y1:y2] = numpy.dot(block, v)
+        if moment == 2:
+            W[y1:y2] = numpy.dot(block, v2)
+        if rmsspec is not None:
+            rms[y1:y2] = streaming_rms(rows, 0, y2-y1, rmsspec.ranges, blank=blank,
+                                       dontblank=dontblank)
+
+    blocks = row_blocks(data.shape, data.dtype.itemsize, maxmem,
+                        minblocks=workers)
+    map_blocks(_reduce, blocks, workers=workers)
+    return T, C, W, rms
+
+def momentcube (hdu, v1, v2=None, header=None, 
                 chan=False, dontblank=False,
                 kms=True,
                 moment=0,
                 returnrms=False,
-                window=None):
+                window=None,
+                maxmem=None,
+                workers=None):
     """
     Create 2d moment image from cube. The input cube is expected
     to be in the VLM format
@@ -22,8 +143,10 @@ def momentcube (hdu, v1, v2, header=None,
         numpy format data cube from pyfits HDU data attribute.
         This cube is expected to be in vlm format. If numpy format
         data cube is passed, then the header parameter should also be
-        passed in.
-    @type hdu: pyfits HDU or numpy array
+        passed in. If a FITS filename (or L{FITSCube}) is passed, the
+        cube is memory-mapped and streamed from disk one block of rows
+        at a time, so it never has to fit in memory.
+    @type hdu: pyfits HDU, numpy array, FITS filename or L{FITSCube}
     @param header: pyfits style header object that corresponds to the
         hdu data variable. This header parameter is only considered if
         the hdu parameter is a numpy array type rather than a pyfits HDU
@@ -33,15 +156,18 @@ def momentcube (hdu, v1, v2, header=None,
         should be an integer). If chan is False, this is expected to be
         velocity expressed in kms (if the input parameter kms is True). If
         chan is False, and kms is False, v1 is treated with the same
-        units as the FITS header describes.
+        units as the FITS header describes. v1 can also be a
+        L{WindowSpec} (see L{compile_windows}), in which case v2 is
+        not needed and chan and kms are taken from it.
     @param v2: upper velocity to be used. Same explanation as v1
     @param chan: If True, v1 and v2 are treated as channels. If False,
         they are treated as velocity
     @type chan: Boolean
     @param dontblank: By default, momentcube will use the BLANK fits
-        header value and automatically zero blanked values in order
-        to compute moments. If dontblank keyword is set, then
-        such blanking is not performed.
+        header value (and NaN values) and automatically zero blanked
+        values in order to compute moments, without modifying the
+        input cube. If dontblank keyword is set, then such blanking
+        is not performed.
     @type dontblank: Boolean
     @param kms: If True velocity units is in kms.
     @type kms: Boolean
@@ -57,7 +183,15 @@ def momentcube (hdu, v1, v2, header=None,
         True, these should be integers. If chan is False, this is expected to be
         velocity expressed in kms (if the input parameter kms is True). If
         chan is False, and kms is False, window is treated with the same
-        units as the FITS header describes.
+        units as the FITS header describes. A L{WindowSpec} can be
+        passed instead.
+    @param maxmem: upper limit in bytes for the block of rows of the
+        cube that is worked on at a time. Defaults to
+        L{tiling.BLOCK_BYTES}. The result does not depend on it.
+    @type maxmem: int
+    @param workers: if larger than 1, the blocks of rows are reduced
+        in parallel on a pool of that many threads.
+    @type workers: int
     @return: A HDU instance with 2d output map in the data attribute of the HDU, 
         and the corresponding header in header attribute of the HDU. If
         returnrms is True, returns the momentmap and rms image as a tuple.
@@ -73,92 +207,44 @@ def momentcube (hdu, v1, v2, header=None,
         if header is None or not isinstance(header, astropy.io.fits.header.Header):
             raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
         data = hdu
+    elif isinstance(hdu, STREAM_TYPES):
+        #stream the cube from a memory-mapped FITS file
+        data = fits_cube(hdu)
+        header = data.header
     else:
-        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type or numpy ndarray")
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type, numpy ndarray or FITS filename")
     if returnrms and window is None:
         raise SculptArgumentError('rms', 'if returnrms is True, you need to specify a window to do the rms calculation in')
     if returnrms and moment != 0:
         raise SculptArgumentError('rms', 'For now, only moment=0 return rms image')
-    # calculate the x-axis (velocity) 
-    crpix1 = sxpar(header,"CRPIX1")
-    crval1 = sxpar(header,"CRVAL1")
+    blank = get_blank(header)
+
+    spec = _velocity_window(header, v1, v2, chan, kms)
+    chan = spec.chan
     cdelt1 = sxpar(header,"CDELT1")
-    if kms:
+    if spec.kms:
         #convert velocity to km/s
-        crval1 = crval1/1000.
         cdelt1 = cdelt1/1000.
-    ctype1 = sxpar(header,"CTYPE1")
-    crpix2 = sxpar(header,"CRPIX2")
-    crval2 = sxpar(header,"CRVAL2")
-    cdelt2 = sxpar(header,"CDELT2")
-    ctype2 = sxpar(header,"CTYPE2")
-    crpix3 = sxpar(header,"CRPIX3")
-    crval3 = sxpar(header,"CRVAL3")
-    cdelt3 = sxpar(header,"CDELT3")
-    ctype3 = sxpar(header,"CTYPE3")
-    nv = sxpar(header,"NAXIS1")
-    nx = sxpar(header,"NAXIS2")
-    ny = sxpar(header,"NAXIS3")
-    blank = sxpar(header,"BLANK")
-
-    #cube = data.copy()
-    if not dontblank and blank is not None:
-        ind = numpy.where(data == blank)
-        data[ind] = 0.0
-
-    vind = numpy.zeros(nv, dtype=bool)
-    if not chan:
-        #get velocity axis
-        velax = getaxes(header, 1)
-        if v2 < v1:
-            v1, v2 = v2, v1
-
-    if chan:
-        vind[v1:v2+1] = True
-    else:
-        vind = numpy.logical_and(velax>= v1, velax<=v2)
-
-    N = len(numpy.where(vind)[0])
+    v1, v2 = spec.vmin, spec.vmax
+    N = spec.nchan
     print "The number of spectral channels used, N: %d" % N
-    T = data[:,:,vind].sum(axis=2) #T is integ intensity image now
+    if returnrms:
+        rmsspec = compile_windows(header, window, chan=chan,
+                                  kms=spec.kms).complement()
+    else:
+        rmsspec = None
+    T, C, W, specrms = _moment_sums(data, spec, moment=moment,
+                                    rmsspec=rmsspec, blank=blank,
+                                    dontblank=dontblank,
+                                    maxmem=maxmem, workers=workers)
+    if isinstance(hdu, types.StringTypes):
+        data.close()
     if moment >= 1:
-        C = (data[:,:,vind]*velax[vind]).sum(axis=2) 
         C = C/T  #centroid velocity definition
         if moment == 2:
-            W = (data[:,:,vind]*velax[vind]**2.).sum(axis=2)
             W = W/T - C**2.
 
-    hnew = header.copy()
-    
-    sxaddpar(hnew, "CRVAL1", crval2, comment="DEGREES")
-    sxaddpar(hnew, "CRPIX1", crpix2)
-    sxaddpar(hnew, "CDELT1", cdelt2, comment="DEGREES")
-    sxaddpar(hnew, "CTYPE1", ctype2)
-    sxaddpar(hnew, "CRVAL2", crval3, comment="DEGREES")
-    sxaddpar(hnew, "CRPIX2", crpix3)
-    sxaddpar(hnew, "CDELT2", cdelt3, comment="DEGREES")
-    sxaddpar(hnew, "CTYPE2", ctype3)
-    sxaddpar(hnew, "NAXIS", 2)
-    sxaddpar(hnew, "NAXIS1", nx)
-    sxaddpar(hnew, "NAXIS2", ny)
-    sxaddpar(hnew, "NAXIS3", 1)
-    sxaddpar(hnew, "NAXIS4", 1)
-    if chan:
-        vorc = 'CHANNEL'
-    else:
-        vorc = 'VELOCITY'
-    sxaddpar(hnew, "VMIN", v1, "LOWER %s LIMIT" % vorc)
-    sxaddpar(hnew,"VMAX", v2, "UPPER %s LIMIT" % vorc)
-    sxaddpar(hnew, "MOMENT", moment, comment="Order of Moment")
-    if moment == 0:
-        units = "K.km/s"
-    else:
-        units = "km/s"
-    sxaddpar(hnew, "BUNIT", units, "Units")
-    for axis in xrange(3, 5):
-        for attr in ('CRVAL', 'CRPIX', 'CDELT',
-                     'CROTA', 'CTYPE', 'NAXIS'):
-            sxdelpar(hnew, '%s%1d' % (attr, axis))
+    hnew = _moment_header(header, v1, v2, chan, moment)
     if moment == 0:
         dt = T*abs(cdelt1)
     elif moment == 1:
@@ -167,10 +253,107 @@ def momentcube (hdu, v1, v2, header=None,
         dt = W
     hdu = pyfits.PrimaryHDU(dt, header=hnew)
     if moment == 0 and returnrms:
-        specrms = mkrmsimage(data, window=window, header=header)
-        rms_data = specrms.data*abs(cdelt1)*math.sqrt(N)
+        rms_data = specrms*abs(cdelt1)*math.sqrt(N)
         hrms = hnew.copy()
-        sxaddhist(hrms, "WINDOW : %s; Window %s LIMITS" % (repr(window), vorc))
+        sxaddhist(hrms, "WINDOW : %s; Window %s LIMITS" % (repr(list(rmsspec.windows)),
+                                                         rmsspec.vorc()))
         rms = pyfits.PrimaryHDU(rms_data, header=hrms)
         return hdu, rms
     return hdu
+
+def momentmaps(hdu, v1, v2=None, header=None,
+               chan=False, dontblank=False,
+               kms=True,
+               window=None,
+               maxmem=None,
+               workers=None):
+    """
+    Create the moment 0, 1 and 2 images (and optionally the rms image
+    of the moment 0 map) of a cube in a single pass. The channel
+    selection and the accumulated sums are shared between all the
+    moments, so the cube is only read once. The input cube is expected
+    to be in the VLM format. Each returned image is identical to the
+    one returned by L{momentcube} with the same arguments.
+
+    @param hdu: input pyfits style HDU (header data unit) or just the numpy
+        numpy format data cube from pyfits HDU data attribute.
+        This cube is expected to be in vlm format. If numpy format
+        data cube is passed, then the header parameter should also be
+        passed in. If a FITS filename (or L{FITSCube}) is passed, the
+        cube is memory-mapped and streamed from disk one block of rows
+        at a time, so it never has to fit in memory.
+    @type hdu: pyfits HDU, numpy array, FITS filename or L{FITSCube}
+    @param v1: lower velocity to be used, or a L{WindowSpec}.
+        See L{momentcube}
+    @param v2: upper velocity to be used. See L{momentcube}
+    @param header: pyfits style header object that corresponds to the
+        hdu data variable, if hdu is a numpy array
+    @type header: pyfits header object
+    @param chan: If True, v1 and v2 are treated as channels. If False,
+        they are treated as velocity
+    @type chan: Boolean
+    @param dontblank: If True, BLANK and NaN values are not zeroed
+    @type dontblank: Boolean
+    @param kms: If True velocity units is in kms.
+    @type kms: Boolean
+    @param window: list of tuples (pairs) of channels/velocity to exclude
+        from the rms calculation. If given, the rms image of the moment 0
+        map is also returned.
+    @param maxmem: upper limit in bytes for the block of rows of the
+        cube that is worked on at a time. See L{momentcube}
+    @type maxmem: int
+    @param workers: number of threads to reduce the blocks of rows with.
+        See L{momentcube}
+    @type workers: int
+    @return: A tuple of HDU instances (moment0, moment1, moment2), or
+        (moment0, moment1, moment2, rms) if window is given.
+    """
+    if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
+        #get data and header from the hdu
+        data = hdu.data
+        header = hdu.header
+    elif isinstance(hdu, numpy.ndarray):
+        if header is None or not isinstance(header, astropy.io.fits.header.Header):
+            raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+        data = hdu
+    elif isinstance(hdu, STREAM_TYPES):
+        #stream the cube from a memory-mapped FITS file
+        data = fits_cube(hdu)
+        header = data.header
+    else:
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type, numpy ndarray or FITS filename")
+    blank = get_blank(header)
+
+    spec = _velocity_window(header, v1, v2, chan, kms)
+    chan = spec.chan
+    cdelt1 = sxpar(header,"CDELT1")
+    if spec.kms:
+        #convert velocity to km/s
+        cdelt1 = cdelt1/1000.
+    v1, v2 = spec.vmin, spec.vmax
+    N = spec.nchan
+    print "The number of spectral channels used, N: %d" % N
+    if window is not None:
+        rmsspec = compile_windows(header, window, chan=chan,
+                                  kms=spec.kms).complement()
+    else:
+        rmsspec = None
+    T, C, W, specrms = _moment_sums(data, spec, moment=2,
+                                    rmsspec=rmsspec, blank=blank,
+                                    dontblank=dontblank,
+                                    maxmem=maxmem, workers=workers)
+    if isinstance(hdu, types.StringTypes):
+        data.close()
+    C = C/T
+    W = W/T - C**2.
+    hdus = []
+    for moment, dt in enumerate((T*abs(cdelt1), C, W)):
+        hnew = _moment_header(header, v1, v2, chan, moment)
+        hdus.append(pyfits.PrimaryHDU(dt, header=hnew))
+    if window is not None:
+        hrms = hdus[0].header.copy()
+        sxaddhist(hrms, "WINDOW : %s; Window %s LIMITS" % (repr(list(rmsspec.windows)),
+                                                         rmsspec.vorc()))
+        rms_data = specrms*abs(cdelt1)*math.sqrt(N)
+        hdus.append(pyfits.PrimaryHDU(rms_data, header=hrms))
+    return tuple(hdus)
@@ -0,0 +1,343 @@
+"""
+Cumulative velocity index of a VLM cube for fast moment maps.
+
+L{MomentIndex} holds the running sums of I, I*v and I*v**2 along the
+velocity axis of every spectrum. The moment sums over any channel
+window (c1, c2) are then just the difference of two planes of the
+index, so once the index is built, moment maps (and whole sets of
+channel maps) for any number of windows cost no more than a
+subtraction each, instead of a full reduction of the cube.
+"""
+
+from sculpt.idealpy.fits import sxpar, getaxes, sxaddhist, sxdelpar
+from sculpt.utils import SculptArgumentError
+from momentcube import _moment_header
+from tiling import row_blocks, map_blocks, fits_cube, STREAM_TYPES
+from blanking import get_blank, fill_blanks
+
+import numpy
+from astropy.io import fits as pyfits
+import astropy.io
+import types
+
+class MomentIndex(object):
+    """
+    Cumulative sums of I, I*v and I*v**2 along the velocity axis
+    of a VLM cube. The index holds (moment+1) arrays of shape
+    (ny, nx, nv+1) in double precision, where plane k is the sum over
+    channels 0..k-1, so be aware that it needs (moment+1) times the
+    memory of a double precision copy of the cube.
+
+    Build and use it by something like:
+
+        >>> index = MomentIndex(hdu)
+        >>> mom0 = index.momentmap(-5, 5)
+        >>> maps = index.channel_maps([(-5, -3), (-3, -1), (-1, 1)])
+    """
+    def __init__(self, hdu, header=None, dontblank=False, kms=True,
+                 moment=2, maxmem=None, workers=None):
+        """
+        @param hdu: input pyfits style HDU (header data unit), numpy
+            data cube (in which case header should also be passed in),
+            or FITS filename / L{FITSCube} to stream the cube from.
+            This cube is expected to be in vlm format.
+        @type hdu: pyfits HDU, numpy array, FITS filename or L{FITSCube}
+        @param header: pyfits style header object if hdu is a numpy array
+        @type header: pyfits header object
+        @param dontblank: By default, BLANK and NaN values are zeroed
+            while building the index. If dontblank is set, they are not.
+        @type dontblank: Boolean
+        @param kms: If True velocity units is in kms.
+        @type kms: Boolean
+        @param moment: highest moment the index should support. Lower
+            values save memory; moment=0 only keeps the sums of I.
+        @type moment: int
+        @param maxmem: upper limit in bytes for a block of rows of the
+            cube read while building the index
+        @type maxmem: int
+        @param workers: number of threads to build the index with
+        @type workers: int
+        """
+        if moment not in range(3):
+            raise SculptArgumentError('moment', "moment can only be one of 0,1,2")
+        if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
+            #get data and header from the hdu
+            data = hdu.data
+            header = hdu.header
+        elif isinstance(hdu, numpy.ndarray):
+            if header is None or not isinstance(header, astropy.io.fits.header.Header):
+                raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+            data = hdu
+        elif isinstance(hdu, STREAM_TYPES):
+            #stream the cube from a memory-mapped FITS file
+            data = fits_cube(hdu)
+            header = data.header
+        else:
+            raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type, numpy ndarray or FITS filename")
+        self.header = header
+        self.kms = kms
+        self.moment = moment
+        self.cdelt1 = sxpar(header, "CDELT1")
+        if kms:
+            #convert velocity to km/s
+            self.cdelt1 = self.cdelt1/1000.
+        blank = get_blank(header)
+        self.velax = getaxes(header, 1, kms=kms)
+        ny, nx, nv = data.shape
+        self.shape = data.shape
+        self.sums = []
+        for k in range(moment+1):
+            self.sums.append(numpy.zeros((ny, nx, nv+1)))
+        vpow = [self.velax**k for k in range(moment+1)]
+
+        def _accumulate(y1, y2):
+            block = data[y1:y2]
+            if not dontblank:
+                block = fill_blanks(block, blank)
+            for k in range(moment+1):
+                if k == 0:
+                    weighted = block
+                else:
+                    weighted = block*vpow[k]
+                numpy.cumsum(weighted, axis=2, dtype=numpy.float64,
+                             out=self.sums[k][y1:y2, :, 1:])
+
+        blocks = row_blocks(data.shape, 8*(moment+1), maxmem,
+                            minblocks=workers)
+        map_blocks(_accumulate, blocks, workers=workers)
+        if isinstance(hdu, types.StringTypes):
+            data.close()
+
+    def channels(self, v1, v2, chan=False):
+        """
+        Convert a window to the half-open channel range (c1, c2) of
+        the index, with the same conventions as L{momentcube}: if chan
+        is True, channels v1 to v2 (inclusive) are used, otherwise all
+        channels with velocities between v1 and v2.
+        """
+        nv = self.velax.size
+        if v2 < v1:
+            v1, v2 = v2, v1
+        if chan:
+            c1 = min(max(v1, 0), nv)
+            c2 = min(max(v2+1, c1), nv)
+            return c1, c2
+        idx = numpy.flatnonzero(numpy.logical_and(self.velax >= v1,
+                                                  self.velax <= v2))
+        if idx.size == 0:
+            return 0, 0
+        return idx[0], idx[-1]+1
+
+    def channel_maps_of(self, v1map, v2map, chan=False):
+        """
+        Vectorized version of L{channels} for spatially variable
+        windows. v1map and v2map are 2d images (or scalars, which are
+        broadcast) of the window limits of each pixel. Pixels with a
+        non-finite limit get an empty window.
+
+        @return: tuple of 2d integer images (c1, c2) of the half-open
+            channel range of each pixel.
+        """
+        nv = self.velax.size
+        shape = self.shape[:2]
+        v1map = numpy.broadcast_to(numpy.asarray(v1map), shape)
+        v2map = numpy.broadcast_to(numpy.asarray(v2map), shape)
+        bad = numpy.logical_not(numpy.isfinite(v1map) & numpy.isfinite(v2map))
+        if chan:
+            c1 = numpy.clip(numpy.where(bad, 0, v1map), 0, nv).astype(int)
+            c2 = numpy.clip(numpy.where(bad, 0, v2map+1), 0, nv).astype(int)
+            c2 = numpy.maximum(c1, c2)
+            c1[bad] = 0
+            c2[bad] = 0
+            return c1, c2
+        lo = numpy.where(bad, 0.0, numpy.minimum(v1map, v2map))
+        hi = numpy.where(bad, 0.0, numpy.maximum(v1map, v2map))
+        if self.velax[-1] >= self.velax[0]:
+            c1 = numpy.searchsorted(self.velax, lo, side='left')
+            c2 = numpy.searchsorted(self.velax, hi, side='right')
+        else:
+            #velocity decreasing with channel number
+            rvel = self.velax[::-1]
+            c1 = nv - numpy.searchsorted(rvel, hi, side='right')
+            c2 = nv - numpy.searchsorted(rvel, lo, side='left')
+        c2 = numpy.maximum(c1, c2)
+        c1[bad] = 0
+        c2[bad] = 0
+        return c1, c2
+
+    def window_sums(self, v1, v2, chan=False):
+        """
+        Return the list of moment sums (sum of I, I*v, I*v**2 up to
+        the moment of the index) over the window v1 to v2 as 2d images.
+        """
+        c1, c2 = self.channels(v1, v2, chan=chan)
+        return [s[:, :, c2] - s[:, :, c1] for s in self.sums]
+
+    def momentmap(self, v1, v2, chan=False, moment=0):
+        """
+        Moment map over the window v1 to v2. This gives the same HDU
+        as L{momentcube} called on the indexed cube with the same
+        v1, v2, chan and moment arguments.
+
+        @param v1: lower velocity (or channel if chan is True)
+        @param v2: upper velocity (or channel if chan is True)
+        @param chan: If True, v1 and v2 are treated as channels
+        @type chan: Boolean
+        @param moment: which moment to extract (0, 1 or 2)
+        @type moment: int
+        @return: A HDU instance with the 2d moment map
+        """
+        if moment not in range(self.moment+1):
+            raise SculptArgumentError('moment', "the index was built for moments up to %d" % self.moment)
+        if v2 < v1:
+            v1, v2 = v2, v1
+        sums = self.window_sums(v1, v2, chan=chan)
+        T = sums[0]
+        if moment == 0:
+            dt = T*abs(self.cdelt1)
+        else:
+            C = sums[1]/T  #centroid velocity definition
+            if moment == 1:
+                dt = C
+            else:
+                dt = sums[2]/T - C**2.
+        hnew = _moment_header(self.header, v1, v2, chan, moment)
+        return pyfits.PrimaryHDU(dt, header=hnew)
+
+    def windowmap(self, v1map, v2map, chan=False, moment=0):
+        """
+        Moment map over spatially variable windows, for example a
+        window centred on the moment 1 value of each pixel:
+
+            >>> mom1 = index.momentmap(-5, 5, moment=1).data
+            >>> mom0 = index.windowmap(mom1-width, mom1+width)
+
+        The sums for every pixel are gathered from the index in one
+        vectorized operation, so this costs the same as a map over a
+        single global window.
+
+        @param v1map: 2d image of the lower velocity (or channel if chan
+            is True) of the window of each pixel
+        @type v1map: numpy array
+        @param v2map: 2d image of the upper velocity (or channel)
+        @type v2map: numpy array
+        @param chan: If True, v1map and v2map are treated as channels
+        @type chan: Boolean
+        @param moment: which moment to extract (0, 1 or 2)
+        @type moment: int
+        @return: A HDU instance with the 2d moment map. VMIN and VMAX
+            in its header hold the extreme limits of all the windows,
+            and are left out if no pixel has finite limits.
+        """
+        if moment not in range(self.moment+1):
+            raise SculptArgumentError('moment', "the index was built for moments up to %d" % self.moment)
+        c1, c2 = self.channel_maps_of(v1map, v2map, chan=chan)
+        yy, xx = numpy.indices(c1.shape)
+        sums = [s[yy, xx, c2] - s[yy, xx, c1] for s in self.sums]
+        T = sums[0]
+        if moment == 0:
+            dt = T*abs(self.cdelt1)
+        else:
+            C = sums[1]/T  #centroid velocity definition
+            if moment == 1:
+                dt = C
+            else:
+                dt = sums[2]/T - C**2.
+        lo = numpy.atleast_1d(numpy.minimum(v1map, v2map))
+        hi = numpy.atleast_1d(numpy.maximum(v1map, v2map))
+        good = numpy.isfinite(lo) & numpy.isfinite(hi)
+        if good.any():
+            hnew = _moment_header(self.header, float(lo[good].min()),
+                                  float(hi[good].max()), chan, moment)
+        else:
+            #no window at all: leave the limits out of the header
+            hnew = _moment_header(self.header, 0.0, 0.0, chan, moment)
+            sxdelpar(hnew, 'VMIN')
+            sxdelpar(hnew, 'VMAX')
+        sxaddhist(hnew, "Moment map over spatially variable windows")
+        return pyfits.PrimaryHDU(dt, header=hnew)
+
+    def channel_maps(self, windows, chan=False, moment=0):
+        """
+        Moment maps for a list of windows.
+
+        @param windows: list of tuples (pairs) of velocity (or channels
+            if chan is True) windows
+        @param chan: If True, windows are treated as channels
+        @type chan: Boolean
+        @param moment: which moment to extract (0, 1 or 2)
+        @type moment: int
+        @return: list of HDU instances, one per window, in the order
+            of windows.
+        """
+        if type(windows) not in (types.ListType, types.TupleType):
+            raise SculptArgumentError('windows', 'has to be a List Type or Tuple Type')
+        return [self.momentmap(v1, v2, chan=chan, moment=moment)
+                for v1, v2 in windows]
+
+def channel_maps(hdu, windows, header=None, chan=False,
+                 dontblank=False, kms=True, moment=0,
+                 maxmem=None, workers=None):
+    """
+    Create moment maps of a cube for a whole list of velocity windows,
+    e.g. a set of channel maps. The cube is read once to build a
+    L{MomentIndex}, after which each map is a difference of two of
+    its planes. The input cube is expected to be in the VLM format.
+
+    @param hdu: input pyfits style HDU, numpy data cube (with header),
+        or FITS filename. See L{MomentIndex}
+    @param windows: list of tuples (pairs) of velocity (or channels
+        if chan is True) windows
+    @param header: pyfits style header object if hdu is a numpy array
+    @param chan: If True, windows are treated as channels
+    @type chan: Boolean
+    @param dontblank: If True, BLANK and NaN values are not zeroed
+    @type dontblank: Boolean
+    @param kms: If True velocity units is in kms.
+    @type kms: Boolean
+    @param moment: which moment to extract (0, 1 or 2)
+    @type moment: int
+    @param maxmem: upper limit in bytes for a block of rows of the cube
+    @type maxmem: int
+    @param workers: number of threads to build the index with
+    @type workers: int
+    @return: list of HDU instances, one per window
+    """
+    index = MomentIndex(hdu, header=header, dontblank=dontblank, kms=kms,
+                        moment=moment, maxmem=maxmem, workers=workers)
+    return index.channel_maps(windows, chan=chan, moment=moment)
+
+def momentcube_windowmap(hdu, v1map, v2map, header=None, chan=False,
+                         dontblank=False, kms=True, moment=0,
+                         maxmem=None, workers=None):
+    """
+    Create a 2d moment image from a cube with a different velocity
+    window for every pixel. The cube is read once to build a
+    L{MomentIndex} and the window sums of all pixels are gathered
+    from it at once. The input cube is expected to be in the VLM format.
+
+    @param hdu: input pyfits style HDU, numpy data cube (with header),
+        or FITS filename. See L{MomentIndex}
+    @param v1map: 2d image of the lower velocity (or channel if chan is
+        True) of the window of each pixel
+    @type v1map: numpy array
+    @param v2map: 2d image of the upper velocity (or channel)
+    @type v2map: numpy array
+    @param header: pyfits style header object if hdu is a numpy array
+    @param chan: If True, v1map and v2map are treated as channels
+    @type chan: Boolean
+    @param dontblank: If True, BLANK and NaN values are not zeroed
+    @type dontblank: Boolean
+    @param kms: If True velocity units is in kms.
+    @type kms: Boolean
+    @param moment: which moment to extract (0, 1 or 2)
+    @type moment: int
+    @param maxmem: upper limit in bytes for a block of rows of the cube
+    @type maxmem: int
+    @param workers: number of threads to build the index with
+    @type workers: int
+    @return: A HDU instance with the 2d moment map
+    """
+    index = MomentIndex(hdu, header=header, dontblank=dontblank, kms=kms,
+                        moment=moment, maxmem=maxmem, workers=workers)
+    return index.windowmap(v1map, v2map, chan=chan, moment=moment)
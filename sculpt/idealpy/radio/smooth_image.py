@@ -1,10 +1,31 @@
 from sculpt.utils import SculptArgumentError
+from sculpt.idealpy.fits import sxaddhist
+from sculpt.idealpy.radio.tiling import row_blocks, map_blocks, fits_cube, fits_output, STREAM_TYPES, BLOCK_BYTES
+from sculpt.idealpy.radio.blanking import get_blank, fill_blanks
+from sculpt.idealpy.radio.smoothcache import gauss_kern_1d, _correlate
 import numpy
 from scipy import signal
+import scipy.fftpack
 from astropy.io import fits as pyfits
+from collections import OrderedDict
+import threading
 import copy
+import types
 import astropy.io
 
+#kernels wider than this many pixels along an axis are convolved by
+#FFT when smooth_cube is called with method='auto'
+FFT_KERNEL_SIZE = 29
+
+#working set (in bytes) of the channels transformed at a time by FFT
+FFT_CHUNK_BYTES = 4*1024*1024
+
+#number of kernel spectra kept by smooth_cube
+KERNEL_CACHE_SIZE = 8
+
+_kernel_spectra = OrderedDict()
+_kernel_lock = threading.Lock()
+
 def gauss_kern(size, sizey=None):
     """ Returns a normalized 2D gauss kernel array for convolutions """
     size = int(size)
@@ -66,3 +87,155 @@ def smooth_image(hdu, smooth=2, header=None, mode='same'):
     card.value = card.value*float(ny)/float(nyy)
     
     return pyfits.PrimaryHDU(dt, header=hdr)
+
+def _kernel_spectrum(shape, gy, gx):
+    """
+    rfft2 of the separable kernel outer(gy, gx) zero-padded to shape,
+    cached on shape and the kernel.
+    """
+    key = (shape, gy.tostring(), gx.tostring())
+    with _kernel_lock:
+        if key in _kernel_spectra:
+            spec = _kernel_spectra.pop(key)
+            _kernel_spectra[key] = spec
+            return spec
+    spec = numpy.fft.rfft2(numpy.outer(gy, gx), s=shape)
+    with _kernel_lock:
+        _kernel_spectra[key] = spec
+        while len(_kernel_spectra) > KERNEL_CACHE_SIZE:
+            _kernel_spectra.popitem(last=False)
+    return spec
+
+def smooth_cube(hdu, smooth=2, header=None, sizey=None, method='auto',
+                dontblank=False, outfile=None, overwrite=False,
+                maxmem=None, workers=None):
+    """Takes a 3-dimensional FITS format cube in vlm format, and returns a
+    version of it with every channel smoothed as by L{smooth_image}
+    (with mode='same').
+
+    The gaussian kernel of L{gauss_kern} is separable, so it is applied
+    either as two 1d convolutions along the spatial axes (method
+    'separable'), or by FFT over the spatial axes (method 'fft'), with
+    the spectrum of the kernel cached for the next block or call. The
+    cube is worked on in blocks of rows (plus the rows of the kernel
+    halo), which can be spread over a pool of threads, and which can be
+    streamed from a FITS file to an output FITS file so that the cube
+    never has to fit in memory.
+
+    @param hdu: input pyfits style HDU (header data unit) or just the numpy
+        numpy format data cube from pyfits HDU data attribute.
+        If numpy format data cube is passed, then the header parameter
+        should also be passed in. If a FITS filename (or L{FITSCube}) is
+        passed, the cube is streamed from disk one block of rows at
+        a time.
+    @type hdu: pyfits HDU, numpy array, FITS filename or L{FITSCube}
+    @param smooth: integer smoothing factor, as in L{smooth_image}
+    @type smooth: int
+    @param header: pyfits header object if needed
+    @param sizey: optional different smoothing factor along the x axis
+        of the channel images, as the sizey argument of L{gauss_kern}
+    @type sizey: int
+    @param method: 'separable', 'fft' or 'auto', which uses FFT when the
+        kernel is wider than L{FFT_KERNEL_SIZE} pixels
+    @type method: string
+    @param dontblank: By default, BLANK and NaN values are taken as 0,
+        as in the sums of L{momentcube}. If dontblank is set, they are
+        used as they are.
+    @type dontblank: Boolean
+    @param outfile: if given, the smoothed cube is written straight into
+        this FITS file, one block of rows at a time, rather than returned
+    @type outfile: string
+    @param overwrite: If True, an existing outfile is overwritten
+    @type overwrite: Boolean
+    @param maxmem: upper limit in bytes for a block of rows. Blocks
+        are kept at least 4*smooth rows long, so that the rows of the
+        kernel halo do not dominate.
+    @type maxmem: int
+    @param workers: number of threads to smooth the blocks with
+    @type workers: int
+    @return A HDU instance with the smoothed cube in the data attribute of
+        the HDU, and the corresponding header in header attribute of the
+        HDU. If outfile is given, nothing is returned.
+    """
+    if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
+        #get data and header from the hdu
+        data = hdu.data
+        header = hdu.header
+    elif isinstance(hdu, numpy.ndarray):
+        if header is None or not isinstance(header, astropy.io.fits.header.Header):
+            raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+        data = hdu
+    elif isinstance(hdu, STREAM_TYPES):
+        #stream the cube from a memory-mapped FITS file
+        data = fits_cube(hdu)
+        header = data.header
+    else:
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type, numpy ndarray or FITS filename")
+    if method not in ('auto', 'separable', 'fft'):
+        raise SculptArgumentError('method', "method can only be one of 'auto', 'separable' or 'fft'")
+    if smooth <= 0 or (sizey is not None and sizey <= 0):
+        raise SculptArgumentError('smooth', "should be positive and non-zero integer")
+    ky = int(smooth)
+    kx = ky if not sizey else int(sizey)
+    #normalized 1d factors of gauss_kern(smooth, sizey)
+    gy = gauss_kern_1d(ky)
+    gy = gy/gy.sum()
+    gx = gauss_kern_1d(kx)
+    gx = gx/gx.sum()
+    if method == 'auto':
+        if max(gy.size, gx.size) > FFT_KERNEL_SIZE:
+            method = 'fft'
+        else:
+            method = 'separable'
+    ny, nx, nv = data.shape
+    dtype = numpy.result_type(data.dtype, numpy.float32)
+    blank = get_blank(header)
+    hdr = header.copy()
+    sxaddhist(hdr, "Smoothed channels with gaussian kernel of size %d x %d" % (ky, kx))
+    if outfile is None:
+        out = numpy.empty(data.shape, dtype=dtype)
+    else:
+        hdulist = fits_output(outfile, hdr, dtype, overwrite=overwrite)
+        out = hdulist[0].data
+
+    def _smooth(y1, y2):
+        #zero padded rows y1-ky to y2+ky, columns -kx to nx+kx
+        r1 = max(y1-ky, 0)
+        r2 = min(y2+ky, ny)
+        rows = numpy.asarray(data[r1:r2], dtype=numpy.float64)
+        if not dontblank:
+            rows = fill_blanks(rows, blank, 0.0)
+        padded = numpy.zeros((y2-y1+2*ky, nx+2*kx, nv))
+        padded[r1-y1+ky:r2-y1+ky, kx:kx+nx] = rows
+        del rows
+        if method == 'separable':
+            out[y1:y2] = _correlate(_correlate(padded, gy, 0), gx, 1)
+        else:
+            #circular convolution of the padded block is free of
+            #wrap-around from row 2*ky and column 2*kx on. The channels
+            #are transformed a few at a time, as contiguous images
+            shape = tuple([scipy.fftpack.next_fast_len(n) for n in padded.shape[:2]])
+            kspec = _kernel_spectrum(shape, gy, gx)
+            step = max(1, FFT_CHUNK_BYTES // (8*shape[0]*shape[1]))
+            for c1 in range(0, nv, step):
+                chans = padded[:, :, c1:c1+step].transpose(2, 0, 1)
+                fchans = numpy.fft.rfft2(chans, s=shape)
+                fchans *= kspec
+                conv = numpy.fft.irfft2(fchans, s=shape)
+                out[y1:y2, :, c1:c1+step] = conv[:, 2*ky:2*ky+y2-y1, 2*kx:2*kx+nx].transpose(1, 2, 0)
+
+    #keep the kernel halo small next to the rows of a block
+    itemsize = 40
+    if maxmem is None:
+        maxmem = BLOCK_BYTES
+    maxmem = max(maxmem, 4*ky*itemsize*nx*nv)
+    blocks = row_blocks(data.shape, itemsize, maxmem, minblocks=workers)
+    try:
+        map_blocks(_smooth, blocks, workers=workers)
+    finally:
+        if outfile is not None:
+            hdulist.close()
+        if isinstance(hdu, types.StringTypes):
+            data.close()
+    if outfile is None:
+        return pyfits.PrimaryHDU(out, header=hdr)
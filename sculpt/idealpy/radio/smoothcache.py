@@ -0,0 +1,306 @@
+"""
+Cache of spatially smoothed cubes for repeated spectrum extraction.
+
+L{extract_spec}, L{extract_posvel} and L{extract_posvel_angle} weight
+the pixels around every requested position with L{gauss_kern}. When
+many spectra are extracted from the same cube, it is cheaper to
+smooth the whole cube once per gauss_width and look the spectra up.
+L{SmoothedCubeCache} does that. The gaussian kernel of L{gauss_kern}
+is separable, so the cube is smoothed with two 1d passes over the
+spatial axes, one block of rows (plus the rows of the kernel halo) at
+a time. The smoothed cubes are kept in memory, or in memory-mapped
+sidecar files, and the least recently used one is dropped when the
+cache is full.
+
+Use it by something like:
+
+    >>> cache = SmoothedCubeCache()
+    >>> spec = extract_spec(hdu, 20, 30, cache=cache)
+    >>> pv = extract_posvel(hdu, (10, 10), (40, 50), cache=cache)
+"""
+
+from sculpt.utils import SculptArgumentError
+from tiling import row_blocks, map_blocks
+from blanking import get_blank, blank_mask, fill_blanks
+
+import numpy
+from collections import OrderedDict
+import threading
+import tempfile
+import os
+
+def gauss_kern_1d(size):
+    """
+    Unnormalized 1d factor of L{gauss_kern}: gauss_kern(size) is the
+    outer product of gauss_kern_1d(size) with itself, normalized.
+    """
+    size = int(size)
+    x = numpy.arange(-size, size+1)
+    return numpy.exp(-x**2/float(size))
+
+def _correlate(block, g, axis):
+    """
+    Correlate block with the 1d kernel g along axis, keeping only the
+    positions where g fits entirely ('valid' mode). Symmetric kernels
+    (like the gaussian ones) take half the multiplications.
+    """
+    n = block.shape[axis] - g.size + 1
+    index = [slice(None)]*block.ndim
+
+    def _shifted(k):
+        index[axis] = slice(k, k+n)
+        return block[tuple(index)]
+
+    if g.size > 1 and numpy.array_equal(g, g[::-1]):
+        w = g.size//2
+        out = g[w]*_shifted(w)
+        term = numpy.empty_like(out)
+        for k in range(w):
+            numpy.add(_shifted(k), _shifted(g.size-1-k), out=term)
+            term *= g[k]
+            out += term
+        return out
+    out = None
+    for k in range(g.size):
+        term = g[k]*_shifted(k)
+        if out is None:
+            out = term
+        else:
+            out += term
+    return out
+
+def bilinear_corners(x, y, nx, ny):
+    """
+    Corners and weights of the bilinear interpolation at positions
+    (x, y) inside a nx by ny map (0 <= x < nx, 0 <= y < ny). Positions
+    beyond the centres of the last column (or row) take its value: the
+    corner that would be off the map gets zero weight.
+
+    @return: list of four (cx, cy, weight) tuples of numpy arrays
+    """
+    x0 = numpy.floor(x).astype(int)
+    y0 = numpy.floor(y).astype(int)
+    tx = numpy.where(x0 < nx-1, x - x0, 0.0)
+    ty = numpy.where(y0 < ny-1, y - y0, 0.0)
+    x1 = numpy.minimum(x0+1, nx-1)
+    y1 = numpy.minimum(y0+1, ny-1)
+    return [(x0, y0, (1-tx)*(1-ty)), (x1, y0, tx*(1-ty)),
+            (x0, y1, (1-tx)*ty), (x1, y1, tx*ty)]
+
+def smooth_cube_spatial(data, header, gauss_width, out=None,
+                        dontblank=False, maxmem=None, workers=None):
+    """
+    Smooth every channel of a VLM cube with the kernel of
+    L{extract_spec}, so that out[y, x] is the spectrum extract_spec
+    returns at (x, y): pixels too close to the edges for the kernel to
+    fit (with the same rule as extract_spec) keep their own spectrum,
+    and blanked pixels are left out with the weights renormalized,
+    unless dontblank is set.
+
+    @param data: VLM cube, numpy shape (ny, nx, nv)
+    @param header: pyfits header of the cube (for BLANK)
+    @param gauss_width: the width of the gaussian kernel
+    @type gauss_width: int
+    @param out: optional preallocated output array (or memmap) of the
+        shape of data
+    @param dontblank: If True, blanks are used as plain numbers
+    @type dontblank: Boolean
+    @param maxmem: upper limit in bytes for a block of rows
+    @type maxmem: int
+    @param workers: number of threads to smooth the blocks with
+    @type workers: int
+    @return: the smoothed cube (out, if given)
+    """
+    ny, nx, nv = data.shape
+    w = int(gauss_width)
+    g = gauss_kern_1d(w)
+    if out is None:
+        out = numpy.empty(data.shape)
+    blank = get_blank(header)
+    #extract_spec uses the kernel for x in w..nx-w-2 and y in w..ny-w-2
+    x2 = nx - w - 1
+
+    def _smooth(y1, y2):
+        rows = data[y1:y2]
+        if not dontblank:
+            rows = fill_blanks(rows, blank, numpy.nan)
+        out[y1:y2] = rows
+        c1 = max(y1, w)
+        c2 = min(y2, ny - w - 1)
+        if c2 <= c1 or x2 <= w:
+            return
+        block = numpy.asarray(data[c1-w:c2+w], dtype=numpy.float64)
+        if dontblank:
+            norm = g.sum()**2
+        else:
+            valid = numpy.logical_not(blank_mask(block, blank))
+            block = numpy.where(valid, block, 0.0)
+            norm = _correlate(_correlate(valid.astype(numpy.float64), g, 0),
+                              g, 1)[:, :x2-w]
+        smooth = _correlate(_correlate(block, g, 0), g, 1)[:, :x2-w]
+        out[c1:c2, w:x2] = smooth/norm
+
+    blocks = row_blocks(data.shape, 8*6, maxmem, minblocks=workers)
+    map_blocks(_smooth, blocks, workers=workers)
+    return out
+
+#number of spectra along each spatial axis of the grid of spectra
+#that make up the fingerprint of a cached cube
+FINGERPRINT_SPECTRA = 8
+
+def _fingerprint(data):
+    """
+    Bytes of a sparse grid of the spectra of data, to tell whether the
+    cube changed since it was smoothed.
+    """
+    ny, nx = data.shape[:2]
+    iy = numpy.unique(numpy.linspace(0, ny-1, FINGERPRINT_SPECTRA).astype(int))
+    ix = numpy.unique(numpy.linspace(0, nx-1, FINGERPRINT_SPECTRA).astype(int))
+    return numpy.ascontiguousarray(data[numpy.ix_(iy, ix)]).tostring()
+
+class SmoothedCubeCache(object):
+    """
+    LRU cache of spatially smoothed cubes, one per (cube, gauss_width).
+    A cube is identified by the numpy array object holding it, which
+    the cache keeps a reference to for as long as its smoothed versions
+    are cached. The spectra looked up from the cache are the ones
+    L{extract_spec} would return (to the precision of dtype).
+
+    The cache never changes the cube. With every smoothed version it
+    keeps a fingerprint of the cube (a sparse grid of its spectra, see
+    FINGERPRINT_SPECTRA), and smooths the cube again if the fingerprint
+    changed, so edits of the whole cube in place (like a baseline
+    subtraction) are picked up. Edits of only a few pixels can be
+    missed; call L{invalidate} (or L{clear}) after making them.
+    """
+    def __init__(self, maxsize=4, sidecar_dir=None, dtype=numpy.float32,
+                 dontblank=False, maxmem=None, workers=None):
+        """
+        @param maxsize: maximum number of smoothed cubes to keep
+        @type maxsize: int
+        @param sidecar_dir: if given, the smoothed cubes are kept in
+            memory-mapped files in this directory instead of in memory.
+            The files are removed when their cube is dropped.
+        @type sidecar_dir: string
+        @param dtype: numpy data type of the smoothed cubes
+        @param dontblank: If True, blanks are used as plain numbers
+        @type dontblank: Boolean
+        @param maxmem: upper limit in bytes for a block of rows while
+            smoothing
+        @type maxmem: int
+        @param workers: number of threads to smooth with
+        @type workers: int
+        """
+        if maxsize < 1:
+            raise SculptArgumentError('maxsize', "maxsize has to be 1 or larger")
+        self.maxsize = maxsize
+        self.sidecar_dir = sidecar_dir
+        self.dtype = numpy.dtype(dtype)
+        self.dontblank = dontblank
+        self.maxmem = maxmem
+        self.workers = workers
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _allocate(self, shape):
+        if self.sidecar_dir is None:
+            return numpy.empty(shape, dtype=self.dtype), None
+        fd, filename = tempfile.mkstemp(suffix='.smooth', dir=self.sidecar_dir)
+        os.close(fd)
+        return numpy.memmap(filename, dtype=self.dtype, mode='w+',
+                            shape=shape), filename
+
+    def _drop(self, entry):
+        """
+        Release a cache entry. Has to be called with the lock held and
+        the entry already removed from _entries. A sidecar memmap is
+        closed before its file is removed, so arrays returned by L{get}
+        for the entry must not be used afterwards.
+        """
+        data, smooth, filename, fingerprint = entry
+        if filename is not None:
+            smooth.flush()
+            if smooth._mmap is not None:
+                smooth._mmap.close()
+            os.remove(filename)
+
+    def invalidate(self, data):
+        """
+        Drop the smoothed versions of data for all gauss_widths. Call
+        this after changing data in place.
+
+        @param data: VLM cube (numpy array)
+        """
+        with self._lock:
+            for key in [k for k, e in self._entries.items() if e[0] is data]:
+                self._drop(self._entries.pop(key))
+
+    def get(self, data, header, gauss_width):
+        """
+        Return the smoothed version of data for gauss_width, smoothing
+        the cube if it is not cached yet.
+
+        @param data: VLM cube (numpy array)
+        @param header: pyfits header of the cube
+        @param gauss_width: the width of the gaussian kernel
+        @type gauss_width: int
+        """
+        key = (id(data), int(gauss_width))
+        fingerprint = _fingerprint(data)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                if entry[0] is data and entry[3] == fingerprint:
+                    self._entries[key] = entry
+                    return entry[1]
+                #a stale smoothed cube
+                self._drop(entry)
+        smooth, filename = self._allocate(data.shape)
+        smooth_cube_spatial(data, header, gauss_width, out=smooth,
+                            dontblank=self.dontblank, maxmem=self.maxmem,
+                            workers=self.workers)
+        with self._lock:
+            self._entries[key] = (data, smooth, filename, fingerprint)
+            while len(self._entries) > self.maxsize:
+                self._drop(self._entries.popitem(last=False)[1])
+        return smooth
+
+    def spectrum(self, data, header, x0, y0, gauss_width):
+        """
+        Smoothed spectrum at pixel (x0, y0), rounded to the nearest
+        pixel as in L{extract_spec}.
+        """
+        smooth = self.get(data, header, gauss_width)
+        return numpy.array(smooth[int(round(y0)), int(round(x0)), :],
+                           dtype=numpy.float64)
+
+    def spectra(self, data, header, x, y, gauss_width, bilinear=False):
+        """
+        Smoothed spectra at arrays of pixel positions, which have to
+        lie inside the map.
+
+        @param bilinear: If False, positions are rounded to the nearest
+            pixel, otherwise the spectra of the four pixels around each
+            position are bilinearly interpolated.
+        @type bilinear: Boolean
+        @return: numpy array of shape (npos, nv)
+        """
+        smooth = self.get(data, header, gauss_width)
+        ny, nx = smooth.shape[:2]
+        x = numpy.asarray(x, dtype=float)
+        y = numpy.asarray(y, dtype=float)
+        if not bilinear:
+            cx = numpy.minimum(numpy.floor(x+0.5).astype(int), nx-1)
+            cy = numpy.minimum(numpy.floor(y+0.5).astype(int), ny-1)
+            return numpy.asarray(smooth[cy, cx], dtype=numpy.float64)
+        out = numpy.zeros((x.size, smooth.shape[2]))
+        for cx, cy, wgt in bilinear_corners(x, y, nx, ny):
+            wgt = wgt[:, numpy.newaxis]
+            out += numpy.where(wgt > 0, smooth[cy, cx]*wgt, 0.0)
+        return out
+
+    def clear(self):
+        """Drop all the cached cubes"""
+        with self._lock:
+            while self._entries:
+                self._drop(self._entries.popitem(last=False)[1])
@@ -0,0 +1,7 @@
+"""
+Regression tests of the radio reductions. Each fast or streamed
+path is checked against the plain in-memory implementation it
+replaces, on small synthetic cubes. Run them with
+
+    python -m pytest sculpt/idealpy/radio/tests
+"""
@@ -0,0 +1,60 @@
+"""
+Small synthetic VLM cubes for the tests.
+"""
+
+from astropy.io import fits as pyfits
+import numpy
+
+def make_cube(ny=12, nx=14, nv=64, seed=1):
+    """
+    Return (data, header) of a float32 VLM cube, numpy shape
+    (ny, nx, nv), holding a gaussian line of varying strength and
+    centre over noise and a sloping baseline. Velocities are in m/s,
+    with velocity 0 at channel 32.
+    """
+    rs = numpy.random.RandomState(seed)
+    v = numpy.arange(nv)
+    amp = rs.uniform(0.5, 2.0, (ny, nx, 1))
+    centre = 32 + rs.uniform(-4, 4, (ny, nx, 1))
+    data = (amp*numpy.exp(-(v - centre)**2/18.) + rs.normal(0, 0.1, (ny, nx, nv)) +
+            0.2 + 0.005*v)
+    header = pyfits.Header()
+    header['NAXIS'] = 3
+    header['NAXIS1'] = nv
+    header['NAXIS2'] = nx
+    header['NAXIS3'] = ny
+    header['CTYPE1'] = 'VELO-LSR'
+    header['CRVAL1'] = 0.0
+    header['CRPIX1'] = 33.0
+    header['CDELT1'] = 500.0
+    header['CTYPE2'] = 'RA---GLS'
+    header['CRVAL2'] = 83.8
+    header['CRPIX2'] = 7.0
+    header['CDELT2'] = -0.005
+    header['CTYPE3'] = 'DEC--GLS'
+    header['CRVAL3'] = -5.4
+    header['CRPIX3'] = 6.0
+    header['CDELT3'] = 0.005
+    return data.astype(numpy.float32), header
+
+def write_scaled_int16(filename, data, header):
+    """
+    Write data to filename as a scaled int16 image, with BSCALE, BZERO
+    and a BLANK value for NaN pixels, and return the float32 cube the
+    file holds after scaling (NaN where blanked).
+    """
+    bscale = (numpy.nanmax(data) - numpy.nanmin(data))/60000.
+    bzero = (numpy.nanmax(data) + numpy.nanmin(data))/2.
+    raw = numpy.round((data - bzero)/bscale)
+    raw = numpy.where(numpy.isnan(raw), -32768, raw).astype(numpy.int16)
+    pyfits.PrimaryHDU(raw, header=header.copy()).writeto(filename)
+    #add the scaling to the raw integers already in the file
+    hdulist = pyfits.open(filename, mode='update', do_not_scale_image_data=True)
+    hdr = hdulist[0].header
+    hdr['BSCALE'] = bscale
+    hdr['BZERO'] = bzero
+    hdr['BLANK'] = -32768
+    hdulist.close()
+    scaled = (raw*numpy.float64(bscale) + bzero).astype(numpy.float32)
+    scaled[raw == -32768] = numpy.nan
+    return scaled
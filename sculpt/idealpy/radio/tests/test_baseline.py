@@ -0,0 +1,32 @@
+"""
+Baseline fitting.
+"""
+
+from sculpt.idealpy.radio.baseline import baseline
+from sculpt.idealpy.radio.tests.cubes import make_cube
+
+from numpy.testing import assert_allclose
+import numpy
+import unittest
+import warnings
+
+WINDOWS = [(0, 20), (45, 63)]
+
+class BaselineTest(unittest.TestCase):
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.data, self.header = make_cube()
+
+    def test_vxy_layout(self):
+        vlm = self.data.copy()
+        vxy = numpy.ascontiguousarray(self.data.transpose(2, 1, 0))
+        base, rms = baseline(vlm, True, WINDOWS, order=1, header=self.header)
+        base_vxy, rms_vxy = baseline(vxy, True, WINDOWS, order=1,
+                                     header=self.header, layout='vxy')
+        self.assertTrue(base_vxy.data is vxy)
+        assert_allclose(vxy, vlm.transpose(2, 1, 0), atol=1e-5)
+        self.assertEqual(rms_vxy.data.shape, (self.data.shape[1], self.data.shape[0]))
+        assert_allclose(rms_vxy.data, rms.data.T, rtol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
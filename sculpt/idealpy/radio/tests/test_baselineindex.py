@@ -0,0 +1,52 @@
+"""
+L{BaselineIndex} checked against L{baseline}.
+"""
+
+from sculpt.idealpy.radio import BaselineIndex
+from sculpt.idealpy.radio.baseline import baseline
+from sculpt.idealpy.radio.tests.cubes import make_cube
+
+from numpy.testing import assert_allclose
+import numpy
+import unittest
+import warnings
+
+WINDOWS = [(0, 20), (45, 63)]
+
+class BaselineIndexTest(unittest.TestCase):
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.data, self.header = make_cube()
+        #partly and fully blanked spectra
+        self.data[2, 3, 5:9] = numpy.nan
+        self.data[7, 8, :] = numpy.nan
+
+    def test_rmsmap(self):
+        index = BaselineIndex(self.data, header=self.header, maxorder=3,
+                              workers=2, maxmem=20000)
+        for order in range(4):
+            fast = index.rmsmap(WINDOWS, order=order, chan=True)
+            rms = baseline(self.data.copy(), True, WINDOWS, order=order,
+                           header=self.header)[1]
+            assert_allclose(fast.data, rms.data, rtol=1e-4, atol=1e-6)
+            self.assertTrue(numpy.isnan(fast.data[7, 8]))
+
+    def test_velocity_windows(self):
+        index = BaselineIndex(self.data, header=self.header, maxorder=1)
+        windows = [(-15, -6), (6, 15)]
+        fast = index.rmsmap(windows, order=1)
+        rms = baseline(self.data.copy(), False, windows, order=1,
+                       header=self.header)[1]
+        assert_allclose(fast.data, rms.data, rtol=1e-4, atol=1e-6)
+
+    def test_subtract(self):
+        index = BaselineIndex(self.data, header=self.header, maxorder=2)
+        fast = self.data.copy()
+        sigma = index.subtract(fast, WINDOWS, order=2, chan=True)
+        base, rms = baseline(self.data.copy(), True, WINDOWS, order=2,
+                             header=self.header)
+        assert_allclose(fast, base.data, rtol=1e-4, atol=1e-5)
+        assert_allclose(sigma, rms.data, rtol=1e-4, atol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
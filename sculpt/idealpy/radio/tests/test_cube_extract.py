@@ -0,0 +1,56 @@
+"""
+L{cube_extract_region} from overlapping tiles, checked against the
+same region of the whole cube.
+"""
+
+from sculpt.idealpy.radio import cube_extract_region
+from sculpt.idealpy.fits import TileIndex
+from sculpt.idealpy.radio.tests.cubes import make_cube
+
+from astropy.io import fits as pyfits
+from numpy.testing import assert_array_equal
+import numpy
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+#RA/DEC box inside the cube of make_cube
+BOX = (83.77, 83.81, -5.41, -5.38)
+
+class CubeExtractRegionTest(unittest.TestCase):
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.tmpdir = tempfile.mkdtemp()
+        data, header = make_cube()
+        data[4, 3, :] = numpy.nan
+        self.whole = os.path.join(self.tmpdir, 'whole.fits')
+        pyfits.PrimaryHDU(data, header=header).writeto(self.whole)
+        #two tiles overlapping in columns 6 to 9
+        for name, x1, x2 in (('tile1', 0, 10), ('tile2', 6, 14)):
+            hdr = header.copy()
+            hdr['NAXIS2'] = x2 - x1
+            hdr['CRPIX2'] = header['CRPIX2'] - x1
+            pyfits.PrimaryHDU(data[:, x1:x2], header=hdr).writeto(
+                os.path.join(self.tmpdir, name + '.fits'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_tiles_match_whole_cube(self):
+        index = TileIndex.build(os.path.join(self.tmpdir, 'tile*.fits'))
+        self.assertEqual(len(index.query(*BOX)), 2)
+        indexfile = os.path.join(self.tmpdir, 'index.fits')
+        index.save(indexfile)
+        index = TileIndex.load(indexfile)
+        whole = TileIndex.from_headers([(self.whole, pyfits.getheader(self.whole))])
+        for chans in (None, (10, 40)):
+            tiled = cube_extract_region(index, *BOX, chans=chans)
+            single = cube_extract_region(whole, *BOX, chans=chans)
+            assert_array_equal(tiled.data, single.data)
+            for key in ('NAXIS1', 'NAXIS2', 'NAXIS3', 'CRPIX1', 'CRPIX2', 'CRPIX3'):
+                self.assertEqual(tiled.header[key], single.header[key])
+
+if __name__ == '__main__':
+    unittest.main()
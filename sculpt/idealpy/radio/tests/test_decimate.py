@@ -0,0 +1,61 @@
+"""
+Spectral decimation with L{decimate_spectra}.
+"""
+
+from sculpt.idealpy.radio import decimate_spectra
+from sculpt.idealpy.radio.transpose_cube import transpose_cube
+from sculpt.idealpy.radio.tests.cubes import make_cube
+
+from astropy.io import fits as pyfits
+from numpy.testing import assert_allclose
+import numpy
+import unittest
+import warnings
+
+def velocities(header, n):
+    return header['CRVAL1'] + (numpy.arange(1, n+1) - header['CRPIX1'])*header['CDELT1']
+
+class DecimateTest(unittest.TestCase):
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.data, self.header = make_cube()
+
+    def test_average(self):
+        out = decimate_spectra(self.data, 4, header=self.header)
+        ny, nx, nv = self.data.shape
+        expected = self.data.reshape(ny, nx, nv//4, 4).mean(axis=3)
+        assert_allclose(out.data, expected, rtol=1e-5, atol=1e-6)
+
+    def test_rebin_conserves_flux(self):
+        for factor in (2, 2.5, 3):
+            out = decimate_spectra(self.data, factor, header=self.header,
+                                   method='rebin', workers=2, maxmem=20000)
+            #the channels that fill whole output channels
+            nused = int(out.data.shape[2]*factor)
+            flux = self.data[:, :, :int(nused)].sum(axis=2, dtype=numpy.float64)
+            if nused != out.data.shape[2]*factor:
+                flux += (out.data.shape[2]*factor - nused)*self.data[:, :, nused]
+            assert_allclose(out.data.sum(axis=2)*factor, flux, rtol=1e-5)
+
+    def test_header(self):
+        for factor in (2, 2.5, 4):
+            out = decimate_spectra(self.data, factor, header=self.header,
+                                   method='rebin')
+            nnew = out.data.shape[2]
+            self.assertEqual(out.header['NAXIS1'], nnew)
+            #output channel i is centred on input channels i*f to (i+1)*f
+            vin = velocities(self.header, self.data.shape[2])
+            centres = (numpy.arange(nnew) + 0.5)*factor - 0.5
+            expected = numpy.interp(centres, numpy.arange(vin.size), vin)
+            assert_allclose(velocities(out.header, nnew), expected)
+
+    def test_transpose_smooth(self):
+        hdu = transpose_cube(pyfits.PrimaryHDU(self.data, header=self.header.copy()),
+                             origin='vxy', smooth=4)
+        out = decimate_spectra(self.data, 4, header=self.header)
+        assert_allclose(hdu.data, out.data.transpose(2, 0, 1), rtol=1e-6)
+        self.assertEqual(hdu.header['CDELT3'], out.header['CDELT1'])
+        self.assertEqual(hdu.header['CRPIX3'], out.header['CRPIX1'])
+
+if __name__ == '__main__':
+    unittest.main()
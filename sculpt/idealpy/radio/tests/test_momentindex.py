@@ -0,0 +1,75 @@
+"""
+L{MomentIndex} checked against L{momentcube}.
+"""
+
+from sculpt.idealpy.radio import (momentcube, momentmaps, MomentIndex,
+                                  channel_maps)
+from sculpt.idealpy.radio.tests.cubes import make_cube
+
+from numpy.testing import assert_allclose
+import numpy
+import unittest
+import warnings
+
+class MomentIndexTest(unittest.TestCase):
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.data, self.header = make_cube()
+        self.data[2, 3, 30:34] = numpy.nan
+
+    def test_momentmaps(self):
+        maps = momentmaps(self.data, -6, 6, header=self.header, workers=2,
+                          maxmem=20000)
+        for moment in (0, 1, 2):
+            single = momentcube(self.data, -6, 6, header=self.header,
+                                moment=moment)
+            assert_allclose(maps[moment].data, single.data, rtol=1e-5)
+
+    def test_momentmap(self):
+        index = MomentIndex(self.data, header=self.header, workers=2,
+                            maxmem=20000)
+        for v1, v2, chan in ((-6, 6, False), (-2, 9, False), (20, 45, True)):
+            for moment in (0, 1, 2):
+                fast = index.momentmap(v1, v2, chan=chan, moment=moment)
+                slow = momentcube(self.data, v1, v2, header=self.header,
+                                  chan=chan, moment=moment)
+                assert_allclose(fast.data, slow.data, rtol=1e-5, atol=1e-6)
+                self.assertEqual(fast.header['VMIN'], slow.header['VMIN'])
+
+    def test_channel_maps(self):
+        windows = [(-8, -4), (-4, 0), (0, 4)]
+        maps = channel_maps(self.data, windows, header=self.header)
+        for (v1, v2), fast in zip(windows, maps):
+            slow = momentcube(self.data, v1, v2, header=self.header)
+            assert_allclose(fast.data, slow.data, rtol=1e-5, atol=1e-6)
+
+    def test_windowmap(self):
+        index = MomentIndex(self.data, header=self.header)
+        v1 = numpy.empty(self.data.shape[:2])
+        v1.fill(25)
+        v1[4, 5] = numpy.nan
+        fast = index.windowmap(v1, 40, chan=True)
+        slow = momentcube(self.data, 25, 40, header=self.header, chan=True)
+        good = numpy.isfinite(v1)
+        assert_allclose(fast.data[good], slow.data[good], rtol=1e-5)
+        self.assertEqual(fast.data[4, 5], 0.0)
+        self.assertEqual((fast.header['VMIN'], fast.header['VMAX']), (25, 40))
+
+    def test_velocity_in_ms(self):
+        index = MomentIndex(self.data, header=self.header, kms=False)
+        for moment in (0, 1, 2):
+            fast = index.momentmap(-5000, 5000, moment=moment)
+            slow = momentcube(self.data, -5000, 5000, header=self.header,
+                              kms=False, moment=moment)
+            assert_allclose(fast.data, slow.data, rtol=1e-5)
+
+    def test_reversed_channel_window(self):
+        index = MomentIndex(self.data, header=self.header)
+        self.assertEqual(index.channels(40, 25, chan=True), (25, 41))
+        fast = index.momentmap(40, 25, chan=True, moment=1)
+        slow = momentcube(self.data, 40, 25, header=self.header, chan=True,
+                          moment=1)
+        assert_allclose(fast.data, slow.data, rtol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
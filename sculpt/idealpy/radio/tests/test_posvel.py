@@ -0,0 +1,43 @@
+"""
+Position-velocity cuts.
+"""
+
+from sculpt.idealpy.radio import extract_posvel
+from sculpt.idealpy.radio.tests.cubes import make_cube
+
+from numpy.testing import assert_allclose
+import numpy
+import unittest
+import warnings
+
+class PosvelStripTest(unittest.TestCase):
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        data, self.header = make_cube()
+        ny, nx, nv = data.shape
+        self.y0 = 6
+        #an odd and an even function of the distance from row y0
+        dy = numpy.arange(ny)[:, numpy.newaxis, numpy.newaxis] - self.y0
+        self.odd = numpy.tile(dy.astype(numpy.float32), (1, nx, nv))
+        self.even = numpy.tile(numpy.exp(-dy**2/4.).astype(numpy.float32),
+                               (1, nx, nv))
+
+    def test_symmetric_strip(self):
+        for width in (2, 3):
+            for bilinear in (False, True):
+                pv = extract_posvel(self.odd, (2., self.y0), (11., self.y0),
+                                    header=self.header, gauss_width=0,
+                                    width=width, bilinear=bilinear)
+                assert_allclose(pv.data, 0.0, atol=1e-6)
+
+    def test_strip_width(self):
+        #weights 1/2, 1, 1/2 for width 2, and 1, 1, 1 for width 3
+        e = numpy.exp(-1/4.)
+        for width, expected in ((2, (1 + e)/2.), (3, (1 + 2*e)/3.)):
+            pv = extract_posvel(self.even, (2., self.y0), (11., self.y0),
+                                header=self.header, gauss_width=0,
+                                width=width)
+            assert_allclose(pv.data, expected, rtol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+L{SmoothedCubeCache} checked against L{extract_spec}.
+"""
+
+from sculpt.idealpy.radio import SmoothedCubeCache, extract_spec
+from sculpt.idealpy.radio.baseline import baseline
+from sculpt.idealpy.radio.tests.cubes import make_cube
+
+from numpy.testing import assert_allclose
+import numpy
+import shutil
+import tempfile
+import unittest
+import warnings
+
+class SmoothedCubeCacheTest(unittest.TestCase):
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.data, self.header = make_cube()
+
+    def test_all_pixels(self):
+        self.data[4, 6, 10:20] = numpy.nan
+        self.data[8, 2, :] = numpy.nan
+        tmpdir = tempfile.mkdtemp()
+        try:
+            for cache in (SmoothedCubeCache(dtype=numpy.float64, workers=2,
+                                            maxmem=20000),
+                          SmoothedCubeCache(sidecar_dir=tmpdir,
+                                            dtype=numpy.float64)):
+                for gauss_width in (1, 2, 3):
+                    for y0 in range(self.data.shape[0]):
+                        for x0 in range(self.data.shape[1]):
+                            cached = extract_spec(self.data, x0, y0,
+                                                  header=self.header,
+                                                  gauss_width=gauss_width,
+                                                  cache=cache)
+                            plain = extract_spec(self.data, x0, y0,
+                                                 header=self.header,
+                                                 gauss_width=gauss_width)
+                            assert_allclose(cached.data, plain.data,
+                                            rtol=1e-10, atol=1e-12)
+                cache.clear()
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_cube_stays_writeable(self):
+        cache = SmoothedCubeCache()
+        extract_spec(self.data, 5, 6, header=self.header, cache=cache)
+        self.assertTrue(self.data.flags.writeable)
+        #in-place work on the cube still runs
+        baseline(self.data, True, [(0, 20), (45, 63)], order=1,
+                 header=self.header)
+
+    def test_inplace_edit_is_picked_up(self):
+        cache = SmoothedCubeCache()
+        extract_spec(self.data, 5, 6, header=self.header, cache=cache)
+        baseline(self.data, True, [(0, 20), (45, 63)], order=1,
+                 header=self.header)
+        cached = extract_spec(self.data, 5, 6, header=self.header, cache=cache)
+        plain = extract_spec(self.data, 5, 6, header=self.header)
+        assert_allclose(cached.data, plain.data, rtol=1e-5, atol=1e-5)
+
+    def test_invalidate(self):
+        cache = SmoothedCubeCache()
+        extract_spec(self.data, 5, 6, header=self.header, cache=cache)
+        self.data[6, 5] += 1.0
+        cache.invalidate(self.data)
+        cached = extract_spec(self.data, 5, 6, header=self.header, cache=cache)
+        plain = extract_spec(self.data, 5, 6, header=self.header)
+        assert_allclose(cached.data, plain.data, rtol=1e-5, atol=1e-5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+Streaming reductions of FITS files, checked against the in-memory
+reductions of the same cube.
+"""
+
+from sculpt.idealpy.radio import (momentcube, mkrmsimage, MomentIndex,
+                                  BaselineIndex, cube_extract, smooth_cube)
+from sculpt.idealpy.radio.baseline import baseline, baseline_file
+from sculpt.idealpy.radio.tiling import FITSCube
+from sculpt.idealpy.radio.tests.cubes import make_cube, write_scaled_int16
+
+from numpy.testing import assert_allclose
+import numpy
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+class ScaledInt16StreamTest(unittest.TestCase):
+    """
+    Integer cubes with BSCALE, BZERO and BLANK cannot be memory-mapped
+    by astropy, but have to stream like any other FITS file.
+    """
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'cube16.fits')
+        data, self.header = make_cube()
+        data[3, 4, 10:14] = numpy.nan
+        self.data = write_scaled_int16(self.filename, data, self.header)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_fitscube_sections(self):
+        cube = FITSCube(self.filename)
+        try:
+            self.assertEqual(cube.shape, self.data.shape)
+            assert_allclose(cube[2:7], self.data[2:7], atol=1e-6)
+            self.assertTrue(numpy.isnan(cube[3:4])[0, 4, 10:14].all())
+        finally:
+            cube.close()
+
+    def test_momentcube(self):
+        for moment in (0, 1, 2):
+            streamed = momentcube(self.filename, -5, 5, moment=moment,
+                                  maxmem=20000)
+            inmem = momentcube(self.data, -5, 5, header=self.header,
+                               moment=moment)
+            assert_allclose(streamed.data, inmem.data, rtol=1e-5)
+
+    def test_mkrmsimage(self):
+        streamed = mkrmsimage(self.filename, [(-6, 6)], maxmem=20000)
+        inmem = mkrmsimage(self.data, [(-6, 6)], header=self.header)
+        assert_allclose(streamed.data, inmem.data, rtol=1e-5)
+
+    def test_indexes(self):
+        mi = MomentIndex(self.filename, moment=1)
+        assert_allclose(mi.momentmap(-5, 5, moment=1).data,
+                        momentcube(self.data, -5, 5, header=self.header,
+                                   moment=1).data, rtol=1e-5)
+        bi = BaselineIndex(self.filename, maxorder=1)
+        rms = baseline(self.data.copy(), False, [(-15, -6), (6, 15)],
+                       order=1, header=self.header)[1]
+        assert_allclose(bi.rmsmap([(-15, -6), (6, 15)], order=1).data,
+                        rms.data, rtol=1e-4)
+
+    def test_baseline_file(self):
+        outfile = os.path.join(self.tmpdir, 'base.fits')
+        rms = baseline_file(self.filename, outfile, False, [(-15, -6), (6, 15)],
+                            order=1, maxmem=20000)
+        base, inrms = baseline(self.data.copy(), False, [(-15, -6), (6, 15)],
+                               order=1, header=self.header)
+        assert_allclose(rms.data, inrms.data, rtol=1e-4)
+        cube = FITSCube(outfile)
+        try:
+            assert_allclose(cube[:], base.data, rtol=1e-4, atol=1e-5)
+        finally:
+            cube.close()
+
+    def test_extract_and_smooth(self):
+        sub = cube_extract(self.filename, [10, 40, 2, 9, 1, 6])
+        assert_allclose(sub.data, self.data[1:6, 2:9, 10:40], atol=1e-6)
+        streamed = smooth_cube(self.filename, smooth=2, maxmem=20000)
+        inmem = smooth_cube(self.data, smooth=2, header=self.header)
+        assert_allclose(streamed.data, inmem.data, rtol=1e-5, atol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+"""
+L{transpose_cube_file} checked against L{transpose_cube}.
+"""
+
+from sculpt.idealpy.radio.transpose_cube import (transpose_cube,
+                                                 transpose_cube_file)
+from sculpt.idealpy.radio.tests.cubes import make_cube
+
+from astropy.io import fits as pyfits
+from numpy.testing import assert_array_equal
+import os
+import shutil
+import tempfile
+import unittest
+import warnings
+
+def swap_axes(header, i, j):
+    """Copy of header with FITS axes i and j exchanged"""
+    header = header.copy()
+    for key in ('NAXIS', 'CTYPE', 'CRVAL', 'CRPIX', 'CDELT'):
+        header[key+str(i)], header[key+str(j)] = header[key+str(j)], header[key+str(i)]
+    return header
+
+class TransposeTest(unittest.TestCase):
+    def setUp(self):
+        warnings.simplefilter('ignore')
+        self.tmpdir = tempfile.mkdtemp()
+        data, header = make_cube()
+        self.cubes = {'vxy': (data, header)}
+        #a xyv cube to start the other layouts from
+        hdu = transpose_cube(pyfits.PrimaryHDU(data, header=header.copy()),
+                             origin='vxy')
+        self.cubes['xyv'] = (hdu.data, hdu.header)
+        self.cubes['vyx'] = (data.transpose(1, 0, 2).copy(),
+                              swap_axes(header, 2, 3))
+        self.cubes['yxv'] = (hdu.data.transpose(0, 2, 1).copy(),
+                              swap_axes(hdu.header, 1, 2))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_transpose_cube_file(self):
+        for origin in ('xyv', 'yxv', 'vxy', 'vyx'):
+            data, header = self.cubes[origin]
+            inmem = transpose_cube(pyfits.PrimaryHDU(data, header=header.copy()),
+                                   origin=origin)
+            outfile = os.path.join(self.tmpdir, origin + '.fits')
+            transpose_cube_file(data, outfile, origin=origin,
+                                header=header.copy(), maxmem=20000, workers=2)
+            ondisk = pyfits.open(outfile)
+            try:
+                assert_array_equal(ondisk[0].data, inmem.data)
+                for key in ('CTYPE1', 'CRPIX1', 'CDELT1', 'CTYPE3', 'CRPIX3'):
+                    self.assertEqual(ondisk[0].header[key], inmem.header[key])
+            finally:
+                ondisk.close()
+
+    def test_transpose_file_to_file(self):
+        data, header = self.cubes['vxy']
+        infile = os.path.join(self.tmpdir, 'in.fits')
+        pyfits.PrimaryHDU(data, header=header).writeto(infile)
+        outfile = os.path.join(self.tmpdir, 'out.fits')
+        transpose_cube_file(infile, outfile, origin='vxy', maxmem=20000)
+        inmem = transpose_cube(pyfits.PrimaryHDU(data, header=header.copy()),
+                               origin='vxy')
+        ondisk = pyfits.open(outfile)
+        try:
+            assert_array_equal(ondisk[0].data, inmem.data)
+        finally:
+            ondisk.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+"""
+Helpers to walk a VLM cube in blocks of spatial rows.
+
+The moment, rms and baseline reductions are all independent across
+the (y, x) plane, so they can be accumulated one block of rows at a
+time. With the cube in vlm format (numpy shape (ny, nx, nv)) a block
+of rows is a contiguous piece of memory, which keeps every reduction
+a single sweep over the data.
+
+Cubes that do not fit in memory can be handed to the reductions as a
+L{FITSCube}, which memory-maps the FITS file and only reads the block
+of rows that is being worked on.
+
+Since numpy releases the GIL inside its reductions, the blocks can
+also be handed to a pool of threads with L{map_blocks}. Every block
+writes into its own rows of preallocated output images, so no
+concatenation of partial results is needed.
+"""
+
+import numpy
+from astropy.io import fits as pyfits
+from multiprocessing.pool import ThreadPool
+import threading
+import types
+import os
+
+#default working set (in bytes) of a single block of rows
+BLOCK_BYTES = 64*1024*1024
+
+def row_blocks(shape, itemsize=8, maxmem=None, minblocks=1):
+    """
+    Split a VLM cube into blocks of rows.
+
+    @param shape: numpy shape of the cube (ny, nx, nv)
+    @type shape: tuple
+    @param itemsize: number of bytes per element of the working arrays
+    @type itemsize: int
+    @param maxmem: upper limit in bytes for a single block. If None,
+        L{BLOCK_BYTES} is used. At least one row is always returned
+        per block.
+    @type maxmem: int
+    @param minblocks: minimum number of blocks to split the rows into
+        (e.g. the number of worker threads), as long as there are
+        enough rows.
+    @type minblocks: int
+    @return: list of (y1, y2) row ranges covering the cube
+    """
+    if maxmem is None:
+        maxmem = BLOCK_BYTES
+    if minblocks is None:
+        minblocks = 1
+    ny = shape[0]
+    rowbytes = max(1, itemsize*int(numpy.prod(shape[1:])))
+    nrows = max(1, int(maxmem // rowbytes))
+    nrows = min(nrows, max(1, -(-ny // minblocks)))
+    return [(y1, min(y1+nrows, ny)) for y1 in range(0, ny, nrows)]
+
+def map_blocks(func, blocks, workers=None):
+    """
+    Call func(y1, y2) for every (y1, y2) row range in blocks. func is
+    expected to write its results into preallocated output arrays.
+
+    @param func: function of two arguments (first and last+1 row)
+    @param blocks: list of (y1, y2) row ranges, as from L{row_blocks}
+    @param workers: number of threads to spread the blocks over. If None
+        or 1, the blocks are processed serially in the calling thread.
+    @type workers: int
+    """
+    if workers is None or workers <= 1 or len(blocks) <= 1:
+        for y1, y2 in blocks:
+            func(y1, y2)
+        return
+    pool = ThreadPool(min(workers, len(blocks)))
+    try:
+        pool.map(lambda block: func(*block), blocks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+def channel_ranges(vind):
+    """
+    Given a boolean channel mask, return the list of (c1, c2) half-open
+    ranges of contiguous selected channels.
+    """
+    vind = numpy.asarray(vind, dtype=bool)
+    edges = numpy.diff(numpy.concatenate(([0], vind.view(numpy.int8), [0])))
+    starts = numpy.flatnonzero(edges == 1)
+    stops = numpy.flatnonzero(edges == -1)
+    return zip(starts.tolist(), stops.tolist())
+
+def channel_slice(vind):
+    """
+    Given a boolean channel mask, return a basic slice if the selected
+    channels are contiguous (so that indexing returns a view rather
+    than a copy), otherwise the integer indices of the selected channels.
+    """
+    idx = numpy.flatnonzero(vind)
+    if idx.size and idx[-1] - idx[0] + 1 == idx.size:
+        return slice(idx[0], idx[-1]+1)
+    return idx
+
+class FITSCube(object):
+    """
+    A read-only VLM cube backed by a FITS file. Slicing a L{FITSCube}
+    returns an in-memory numpy array of just the requested section
+    (with BSCALE/BZERO applied, and BLANK values of scaled integer
+    images as NaN), so the reductions can walk a cube that is larger
+    than the available memory one block of rows at a time. The file is
+    memory-mapped unless it holds a scaled integer image, in which case
+    each section is read from it instead.
+
+    Open one by something like:
+
+        >>> cube = FITSCube('otfmap.fits')
+        >>> rows = cube[10:20]
+    """
+    def __init__(self, filename, ext=0):
+        """
+        @param filename: name of the FITS file
+        @type filename: string
+        @param ext: extension number holding the cube. Default 0
+        @type ext: Integer
+        """
+        self.filename = filename
+        self.hdulist = pyfits.open(filename, memmap=True)
+        hdu = self.hdulist[ext]
+        if any([key in hdu.header for key in ('BSCALE', 'BZERO', 'BLANK')]):
+            #scaled integer images cannot be memory-mapped, but their
+            #sections are still read (and scaled) one at a time
+            self.hdulist.close()
+            self.hdulist = pyfits.open(filename, memmap=False)
+            hdu = self.hdulist[ext]
+        self.header = hdu.header
+        self.shape = tuple(hdu.shape)
+        self.ndim = len(self.shape)
+        bitpix = hdu.header['BITPIX']
+        if bitpix in (-64, 32, 64):
+            self.dtype = numpy.dtype('float64')
+        else:
+            self.dtype = numpy.dtype('float32')
+        self._section = hdu.section
+        self._lock = threading.Lock()
+
+    def __getitem__(self, key):
+        #the underlying file object is shared, so serialize reads
+        #coming from different worker threads
+        with self._lock:
+            return self._section[key]
+
+    def close(self):
+        self.hdulist.close()
+
+def fits_cube(hdu):
+    """
+    Return a L{FITSCube} for hdu, which can either be a FITS
+    filename or already a L{FITSCube}.
+    """
+    if isinstance(hdu, FITSCube):
+        return hdu
+    return FITSCube(hdu)
+
+#types that are streamed from disk rather than read into memory
+STREAM_TYPES = types.StringTypes + (FITSCube,)
+
+def fits_output(filename, header, dtype=numpy.float32, overwrite=False):
+    """
+    Create a FITS file for header, with its data area preallocated
+    (but not written), and return it opened for update with the data
+    memory-mapped. Blocks of the result can then be written straight
+    into the file, as in
+
+        >>> hdulist = fits_output('out.fits', header)
+        >>> hdulist[0].data[y1:y2] = rows
+        >>> hdulist.close()
+
+    so that a reduction never needs to hold its whole output in memory.
+
+    @param filename: name of the FITS file to create
+    @type filename: string
+    @param header: pyfits style primary header, giving the shape of the
+        data in its NAXISn keywords. BITPIX is set from dtype, and any
+        BSCALE, BZERO and BLANK keywords are dropped.
+    @type header: pyfits header object
+    @param dtype: numpy float data type of the output
+    @param overwrite: If True, an existing file is overwritten
+    @type overwrite: Boolean
+    @return: pyfits HDUList opened in update mode
+    """
+    dtype = numpy.dtype(dtype)
+    if os.path.exists(filename):
+        if not overwrite:
+            raise IOError("File %s already exists" % filename)
+        os.remove(filename)
+    hdr = header.copy()
+    #mandatory primary header keywords, in their required order
+    hdr.set('SIMPLE', True, before=0)
+    hdr.set('BITPIX', -8*dtype.itemsize, after='SIMPLE')
+    hdr.set('NAXIS', hdr['NAXIS'], after='BITPIX')
+    for key in ('BSCALE', 'BZERO', 'BLANK'):
+        if key in hdr:
+            del hdr[key]
+    naxis = hdr['NAXIS']
+    shape = [hdr['NAXIS%d' % i] for i in range(1, naxis+1)]
+    nbytes = int(numpy.prod(shape))*dtype.itemsize
+    #FITS data areas are padded to a multiple of 2880 bytes
+    nbytes = -(-nbytes // 2880)*2880
+    hdr.tofile(filename)
+    with open(filename, 'rb+') as fobj:
+        fobj.seek(len(hdr.tostring()) + nbytes - 1)
+        fobj.write(b'\0')
+    return pyfits.open(filename, mode='update', memmap=True)
@@ -4,8 +4,19 @@ import os
 import sys
 import numpy
 import copy
-from sculpt.idealpy.utils.congrid import congrid
+import types
+import astropy.io
 from sculpt.utils import SculptArgumentError
+from sculpt.idealpy.radio.tiling import row_blocks, map_blocks, fits_cube, fits_output, STREAM_TYPES
+from sculpt.idealpy.radio.decimate import decimate_axis, decimate_header
+from sculpt.idealpy.radio.blanking import get_blank
+
+#numpy axis permutation done by transpose_data for each origin
+PERMUTATIONS = {'vxy': (2, 0, 1), 'vyx': (2, 1, 0),
+                'xyv': (1, 2, 0), 'yxv': (2, 1, 0)}
+
+#size in bytes of the tiles copied at a time by transpose_cube_file
+TILE_BYTES = 512*1024
 
 def transpose_data(data, origin='vxy'):
     """always transposes vxy to xyv
@@ -51,12 +62,15 @@ def transpose_header(header, origin='vxy'):
     axis2->axis1, axis3->axis2."""
     cards = header.cards
     keepattr = {}
-    for attr in ('NAXIS', 'CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CROTA'):
+    #keywords missing from the header (e.g. CROTAn) are left out
+    attrs = [attr for attr in ('NAXIS', 'CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CROTA')
+             if all(['%s%d' % (attr, i) in header for i in range(1, 4)])]
+    for attr in attrs:
         keepattr[attr] = {}
         for i in range(1, 4):
             keepattr[attr][i] = copy.copy(cards['%s%d' % (attr,i)])
     if origin == 'vxy':
-        for attr in ('NAXIS', 'CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CROTA'):
+        for attr in attrs:
             #1->3
             copycard(cards['%s3' % attr], keepattr[attr][1])
             #2->1
@@ -66,15 +80,15 @@ def transpose_header(header, origin='vxy'):
         dest = 'xyv'
         header.add_history('Tranposing from %s format to %s format' % (origin, dest))
     elif origin == 'vyx':
-        for attr in ('NAXIS', 'CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CROTA'):
+        for attr in attrs:
             #1->3
             copycard(cards['%s3' % attr], keepattr[attr][1])
             #3->1
             copycard(cards['%s1' % attr], keepattr[attr][3])
-            dest = 'xyv'
-            header.add_history('Tranposing from %s format to %s format' % (origin, dest))
+        dest = 'xyv'
+        header.add_history('Tranposing from %s format to %s format' % (origin, dest))
     elif origin == 'xyv':
-        for attr in ('NAXIS', 'CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CROTA'):
+        for attr in attrs:
             #1->2
             copycard(cards['%s2' % attr], keepattr[attr][1])
             #2->3
@@ -84,7 +98,7 @@ def transpose_header(header, origin='vxy'):
         dest = 'vxy'
         header.add_history('Tranposing from %s format to %s format' % (origin, dest))
     elif origin == 'yxv':
-        for attr in ('NAXIS', 'CTYPE', 'CRVAL', 'CDELT', 'CRPIX', 'CROTA'):
+        for attr in attrs:
             #3->1
             copycard(cards['%s1' % attr], keepattr[attr][3])
             #1->3
@@ -131,42 +145,29 @@ def smooth_spec(f, y, window_len=5, window='hanning'):
     data = y[window_len-1:-window_len+1]
     return data
 
-def smooth(data, header, smooth_factor, origin='vxy'):
+def _velocity_axis(origin):
+    """
+    Return the numpy axis and the FITS axis number of the velocity
+    axis of a cube with layout origin.
+    """
     if origin[0] == 'v':
-        shape = copy.copy(data.shape)
-        vdim = int(round(shape[0]/float(smooth_factor)))
-        new_shape = (vdim, shape[1], shape[2])
-        data = congrid(data, new_shape)
-        cards = header.cards
-        card = cards['NAXIS3']
-        card.value = vdim
-        card = cards['CDELT3']
-        card.value = card.value*smooth_factor
-        header.add_history('Smoothing velocity axis by %d' % smooth_factor)
-        return data, header
-    else:
-        shape = copy.copy(data.shape)
-        vdim = int(round(shape[0]/float(smooth_factor)))
-        new_shape = (shape[1], shape[2], vdim)
-        data = congrid(data, new_shape)
-        cards = header.cards
-        card = cards['NAXIS1']
-        card.value = vdim
-        card = cards['CDELT1']
-        card.value = card.value*smooth_factor
-        header.add_history('Smoothing velocity axis by %d' % smooth_factor)
-        return data, header        
-    
-def transpose_cube(hdu, origin='xyv',
-                   smooth=None):
+        return 2, 1
+    return 0, 3
+
+def smooth(data, header, smooth_factor, origin='vxy', method='average'):
     """
-    Given a HDU this function transposes from origin (xyv, yxv, vxy or vyx)
-    and makes a new hdu into  vxy or xyv cube
-    If smooth is an integer the velocity axis is also smoothed 
-    by the integral value
+    Decimate the velocity axis of a cube transposed by
+    L{transpose_data} from origin by smooth_factor (see
+    L{decimate_axis} for the methods). The header is updated in place.
     """
-    header = hdu.header
-    data = hdu.data
+    #the output of the transpose has velocity at the other end
+    axis, vaxis = _velocity_axis('xyv' if origin[0] == 'v' else 'vxy')
+    data = decimate_axis(data, smooth_factor, axis, method=method,
+                         blank=get_blank(header))
+    header = decimate_header(header, smooth_factor, vaxis, method=method)
+    return data, header
+
+def _check_origin(header, origin):
     if origin not in ('xyv', 'yxv', 'vxy', 'vyx'):
         raise SculptArgumentError('transpose_cube', 'Origin should be one of xyv, yxv, vxy or vxy')
     if origin[2] == 'v':
@@ -175,13 +176,104 @@ def transpose_cube(hdu, origin='xyv',
     else:
         if header.get('CTYPE1') not in ('VELO-LSR', 'VELOCITY'):
             raise SculptArgumentError('header', 'Input Cube does not have Velocity in 1st axis')
+
+def transpose_cube(hdu, origin='xyv',
+                   smooth=None, method='average'):
+    """
+    Given a HDU this function transposes from origin (xyv, yxv, vxy or vyx)
+    and makes a new hdu into  vxy or xyv cube
+    If smooth is an integer the velocity axis is also decimated
+    by the integral value, with method 'average', 'hanning' or 'rebin'
+    (see L{decimate_axis}). The decimation is done before the transpose,
+    on the velocity axis of the input cube.
+    """
+    header = hdu.header
+    data = hdu.data
+    _check_origin(header, origin)
+    if smooth is not None:
+        axis, vaxis = _velocity_axis(origin)
+        data = decimate_axis(data, smooth, axis, method=method,
+                             blank=get_blank(header))
+        header = decimate_header(header, smooth, vaxis, method=method)
     data1 = transpose_data(data, origin=origin)
     header1 = transpose_header(header, origin=origin)
-    if smooth is not None:
-        data1, header1 = smooth(data1, header1, smooth,
-                                origin=origin)
     return pyfits.PrimaryHDU(data=data1, header=header1)
 
+def transpose_cube_file(hdu, outfile, origin='xyv', header=None,
+                        overwrite=False, maxmem=None, workers=None):
+    """
+    Out-of-core version of L{transpose_cube} (without smoothing): the
+    transposed cube is written straight into outfile rather than built
+    in memory. The input is read one block along its slowest axis at a
+    time, and each block is copied into the output in tiles of about
+    L{TILE_BYTES}, which fit in the processor cache, so neither the
+    input nor the output ever has to fit in memory. The header is
+    transposed by L{transpose_header}.
+
+    @param hdu: input pyfits style HDU (header data unit), numpy data
+        cube (in which case header should also be passed in), or FITS
+        filename / L{FITSCube} to stream the cube from
+    @type hdu: pyfits HDU, numpy array, FITS filename or L{FITSCube}
+    @param outfile: name of the FITS file to write the transposed cube to
+    @type outfile: string
+    @param origin: axis order of the input (xyv, yxv, vxy or vyx).
+        vxy and vyx cubes are transposed to xyv, and xyv and yxv cubes
+        to vxy.
+    @type origin: string
+    @param header: pyfits style header object if hdu is a numpy array
+    @param overwrite: If True, an existing outfile is overwritten
+    @type overwrite: Boolean
+    @param maxmem: upper limit in bytes for a block of the input
+    @type maxmem: int
+    @param workers: number of threads to copy the blocks with
+    @type workers: int
+    """
+    if isinstance(hdu, astropy.io.fits.hdu.image.PrimaryHDU):
+        #get data and header from the hdu
+        data = hdu.data
+        header = hdu.header
+    elif isinstance(hdu, numpy.ndarray):
+        if header is None or not isinstance(header, astropy.io.fits.header.Header):
+            raise SculptArgumentError('header', "Since you passed in data that is a numpy array, set header to a pyfits header type")
+        data = hdu
+    elif isinstance(hdu, STREAM_TYPES):
+        #stream the cube from a memory-mapped FITS file
+        data = fits_cube(hdu)
+        header = data.header
+    else:
+        raise SculptArgumentError('hdu', "can only be one of pyfits.PrimaryHDU type, numpy ndarray or FITS filename")
+    try:
+        _check_origin(header, origin)
+        perm = PERMUTATIONS[origin]
+        dtype = numpy.result_type(data.dtype, numpy.float32)
+        header1 = transpose_header(header.copy(), origin=origin)
+        hdulist = fits_output(outfile, header1, dtype, overwrite=overwrite)
+        out = hdulist[0].data
+        #edge of a cubic tile of TILE_BYTES
+        edge = max(1, int(round((TILE_BYTES/float(dtype.itemsize))**(1/3.))))
+
+        def _copy_block(a1, a2):
+            block = numpy.asarray(data[a1:a2])
+            shape = block.shape
+            for i1 in range(0, shape[0], edge):
+                for j1 in range(0, shape[1], edge):
+                    for k1 in range(0, shape[2], edge):
+                        src = (slice(i1, i1+edge), slice(j1, j1+edge),
+                               slice(k1, k1+edge))
+                        #the same tile, in the coordinates of the input cube
+                        tile = (slice(a1+i1, min(a1+i1+edge, a2)),) + src[1:]
+                        out[tuple([tile[p] for p in perm])] = block[src].transpose(perm)
+
+        blocks = row_blocks(data.shape, dtype.itemsize, maxmem,
+                            minblocks=workers)
+        try:
+            map_blocks(_copy_block, blocks, workers=workers)
+        finally:
+            hdulist.close()
+    finally:
+        if isinstance(hdu, types.StringTypes):
+            data.close()
+
 if __name__ == '__main__':
     parser = OptionParser()
     parser.add_option("-f", "--file", dest="filename",
@@ -0,0 +1,152 @@
+"""
+Compiled channel windows shared by the radio reductions.
+
+L{momentcube}, L{mkrmsimage} and L{baseline} all select channels from
+a list of (v1, v2) windows given either in channels or in velocity. A
+L{WindowSpec} does that selection once for a given velocity axis and
+holds the resulting channel mask, the contiguous channel ranges and
+the number of channels, so it can be passed to any of them in place
+of the windows. L{compile_windows} caches the WindowSpec objects, so
+repeated interactive calls with the same cube and windows skip the
+setup work altogether.
+"""
+
+from sculpt.idealpy.fits import getaxes
+from sculpt.utils import SculptArgumentError
+from tiling import channel_ranges, channel_slice
+
+import numpy
+from collections import OrderedDict
+import types
+
+#number of compiled windows kept by compile_windows
+CACHE_SIZE = 32
+
+_cache = OrderedDict()
+
+class WindowSpec(object):
+    """
+    Channel selection compiled from a list of (v1, v2) windows.
+    Both limits of every window are included. Channel windows select
+    channels v1 to v2, and velocity windows select every channel with
+    a velocity between v1 and v2.
+
+    Useful attributes are:
+
+      - mask: boolean array, True for the channels inside the windows
+      - ranges: list of (c1, c2) half-open ranges of contiguous channels
+      - slice: a slice (if the channels are contiguous) or integer index
+        array to select the channels along the velocity axis with
+      - nchan: number of channels inside the windows
+      - vmin, vmax: lowest and highest limit of all the windows
+      - velax: the velocity axis the windows were compiled against
+    """
+    def __init__(self, header, windows, chan=False, kms=True):
+        """
+        @param header: pyfits style header of a cube in vlm format
+        @type header: pyfits header object
+        @param windows: list of tuples (pairs) of channels/velocity.
+            A single (v1, v2) pair is also accepted.
+        @param chan: If True, windows are treated as channels. If False,
+            they are treated as velocity
+        @type chan: Boolean
+        @param kms: If True velocity units is in kms.
+        @type kms: Boolean
+        """
+        windows = _window_tuple(windows)
+        self.windows = windows
+        self.chan = chan
+        self.kms = kms
+        self.velax = getaxes(header, 1, kms=kms)
+        mask = numpy.zeros(self.velax.shape, dtype=bool)
+        for v1, v2 in windows:
+            v1, v2 = sorted((v1, v2))
+            if chan:
+                mask[max(int(v1), 0):max(int(v2)+1, 0)] = True
+            else:
+                mask |= numpy.logical_and(self.velax >= v1, self.velax <= v2)
+        self._set_mask(mask)
+        if windows:
+            self.vmin = min([min(w) for w in windows])
+            self.vmax = max([max(w) for w in windows])
+        else:
+            self.vmin = self.vmax = None
+        self._complement = None
+
+    def _set_mask(self, mask):
+        self.mask = mask
+        self.ranges = channel_ranges(mask)
+        self.slice = channel_slice(mask)
+        self.nchan = int(mask.sum())
+
+    def complement(self):
+        """
+        Return a WindowSpec selecting all the channels outside the
+        windows, e.g. the line-free channels used for the rms.
+        """
+        if self._complement is None:
+            comp = WindowSpec.__new__(WindowSpec)
+            comp.__dict__.update(self.__dict__)
+            comp._set_mask(numpy.logical_not(self.mask))
+            comp._complement = self
+            self._complement = comp
+        return self._complement
+
+    def vorc(self):
+        """Return 'CHANNEL' or 'VELOCITY', for header comments"""
+        if self.chan:
+            return 'CHANNEL'
+        return 'VELOCITY'
+
+    def __repr__(self):
+        return "WindowSpec(%s, chan=%s, nchan=%d)" % (repr(list(self.windows)),
+                                                     self.chan, self.nchan)
+
+def _window_tuple(windows):
+    """
+    Check windows and return them as a hashable tuple of pairs.
+    """
+    if type(windows) not in (types.ListType, types.TupleType, numpy.ndarray):
+        raise SculptArgumentError('window', 'has to be a List Type or Tuple Type')
+    if len(windows) == 2 and numpy.isscalar(windows[0]) and numpy.isscalar(windows[1]):
+        #a single (v1, v2) pair
+        windows = [windows]
+    out = []
+    for win in windows:
+        try:
+            v1, v2 = win
+        except (TypeError, ValueError):
+            raise SculptArgumentError('window', "Each element in the window list must be a 2-tuple")
+        out.append((v1, v2))
+    return tuple(out)
+
+def compile_windows(header, windows, chan=False, kms=True):
+    """
+    Return the L{WindowSpec} of windows for the velocity axis described
+    by header. WindowSpecs are cached on the velocity axis keywords of
+    the header and the windows, so compiling the same windows for the
+    same cube again is free. If windows already is a WindowSpec it is
+    returned as is.
+
+    @param header: pyfits style header of a cube in vlm format
+    @type header: pyfits header object
+    @param windows: list of tuples (pairs) of channels/velocity
+    @param chan: If True, windows are treated as channels
+    @type chan: Boolean
+    @param kms: If True velocity units is in kms.
+    @type kms: Boolean
+    @return: L{WindowSpec} instance
+    """
+    if isinstance(windows, WindowSpec):
+        return windows
+    key = (tuple([header.get('%s1' % attr) for attr in
+                  ('NAXIS', 'CRVAL', 'CRPIX', 'CDELT', 'CTYPE')]),
+           _window_tuple(windows), bool(chan), bool(kms))
+    if key in _cache:
+        spec = _cache.pop(key)
+    else:
+        spec = WindowSpec(header, windows, chan=chan, kms=kms)
+    _cache[key] = spec
+    while len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
+    return spec
@@ -1,2 +1,2 @@
 from outvar import OutVar
-from liang_barsky import line_rectangle_intersection
+from liang_barsky import line_rectangle_intersection, line_rectangle_intersections
@@ -3,6 +3,7 @@ straight line with rectangle.
 http://www.cs.helsinki.fi/group/goa/viewing/leikkaus/intro.html
 """
 import math
+import numpy
 
 def yofline(m, a, b, x):
     """given slope m, and point (a,b) that line
@@ -119,6 +120,59 @@ def line_rectangle_intersection(L, R, B, T, a, b, angle):
     maxP = ((x1 + (x2-x1)*tmax), (y1+(y2-y1)*tmax))
     return minP, maxP
     
+def line_rectangle_intersections(L, R, B, T, a, b, angles):
+    """Vectorized version of L{line_rectangle_intersection}: clips
+    the lines through the point (a, b) at every angle of angles to
+    the rectangle at once. The lines are parametrized by their
+    direction vectors (cos(angle), sin(angle)) rather than by their
+    slopes, so vertical lines are clipped correctly too.
+    @param L: left edge of rectangle in pixels
+    @type L: float
+    @param R: right edge of rectangle in pixels
+    @type R: float
+    @param B: bottom edge of rectangle in pixels
+    @type B: float
+    @param T: top edge of rectangle in pixels
+    @type T: float
+    @param a: x point of lines
+    @type a: float
+    @param b: y point of lines
+    @type b: float
+    @param angles: angles with respect to x-xaxis in degrees
+    @type angles: numpy array, list or float
+    @return two tuples of (x,y) arrays of intersecting points, the
+        first on the -(cos, sin) side of (a, b) and the second on the
+        +(cos, sin) side. Lines that miss the rectangle give NaN.
+    """
+    angles = numpy.radians(numpy.atleast_1d(numpy.asarray(angles, dtype=float)))
+    ux = numpy.cos(angles)
+    uy = numpy.sin(angles)
+    tmin = numpy.empty(angles.shape)
+    tmin.fill(-numpy.inf)
+    tmax = numpy.empty(angles.shape)
+    tmax.fill(numpy.inf)
+    #clip the parameter t of (a, b) + t*(ux, uy) against each pair of edges
+    for p, u, lo, hi in ((float(a), ux, float(L), float(R)),
+                         (float(b), uy, float(B), float(T))):
+        parallel = numpy.abs(u) < 1e-12
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            t1 = (lo - p)/u
+            t2 = (hi - p)/u
+        #lines parallel to the edges are either all inside or all outside
+        if lo <= p <= hi:
+            t1[parallel] = -numpy.inf
+        else:
+            t1[parallel] = numpy.inf
+        t2[parallel] = numpy.inf
+        tmin = numpy.maximum(tmin, numpy.minimum(t1, t2))
+        tmax = numpy.minimum(tmax, numpy.maximum(t1, t2))
+    miss = tmin > tmax
+    tmin[miss] = numpy.nan
+    tmax[miss] = numpy.nan
+    minP = (a + tmin*ux, b + tmin*uy)
+    maxP = (a + tmax*ux, b + tmax*uy)
+    return minP, maxP
+
 if __name__ == "__main__":
     i1, i2 = line_rectangle_intersection(0.0, 180., 0.0, 150., 75., 80., -89.9999999)
     print i1, i2